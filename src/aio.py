@@ -0,0 +1,534 @@
+"""
+asyncio server engine for Replica.
+
+Selected with Replica(..., engine='asyncio'). One event loop serves every client and peer connection with an
+asyncio.start_server stream handler instead of one thread per connection, and talks to other replicas over pipelined
+(protocol v1) connections without blocking. The frame protocol is exactly the same as the threaded engine's, so existing
+clients and threaded replicas interoperate with it.
+
+Handlers that only touch local state never block, so they run inline on the loop by calling the threaded Replica method.
+Handlers that talk to peers have async versions here. Any request type without an async version falls back to the
+threaded handler in the loop's default executor.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+from struct import pack, unpack
+
+from msg_utils import *
+import article_codec
+import id_set
+from id_lease import ID_BLOCK, COUNT, RANGE, decode_range
+from group_commit import AsyncGroupCommit
+from repl_log import POSITION, TAIL_IDLE
+from fanout import agather, split_deadline
+from election import StaleEpoch
+
+LISTEN_BACKLOG = 1024
+CONNECT_TIMEOUT = 10 # Same as the threaded engine, a coordinator that doesn't answer in time triggers a leader election
+
+# FRAME I/O
+######################
+
+async def recv_frame(reader):
+    '''Async Frame.recv: returns None if the peer disconnected cleanly before sending anything'''
+    try:
+        header = await reader.readexactly(Frame.HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError('Peer closed the connection part way through a frame header.')
+    word, length = unpack('>QQ', header)
+    version, flags, request = Frame.parse_word(word)
+    deadline, epoch = Frame.parse_deadline(word), Frame.parse_epoch(word)
+    request_id = 0
+    if version >= PROTOCOL_V1:
+        request_id, = unpack('>Q', await reader.readexactly(8))
+    if flags & FLAG_COMPRESSED:
+        inflater = Inflater(length)
+        while True:
+            nbytes, = unpack('>I', await reader.readexactly(4))
+            if nbytes == 0:
+                break
+            inflater.feed(await reader.readexactly(nbytes))
+        return Frame(request, inflater.finish(), version=version, request_id=request_id, flags=flags & ~FLAG_COMPRESSED, deadline=deadline, epoch=epoch)
+    return Frame(request, await reader.readexactly(length), version=version, request_id=request_id, flags=flags, deadline=deadline, epoch=epoch)
+
+# Writes wire pieces (Frame.pieces / reply_pieces), yielding to the loop for flow control between compressed chunks
+async def write_pieces(writer, pieces):
+    for buffers in pieces:
+        writer.writelines(buffers)
+        await writer.drain()
+
+
+class AsyncReplyChannel(ReplyChannel):
+    '''ReplyChannel over an asyncio StreamWriter, usable from the loop itself or from an executor thread'''
+    def __init__(self, writer, frame, write_lock, loop, compress_threshold=COMPRESS_THRESHOLD):
+        super().__init__(writer, frame, write_lock, compress_threshold)
+        self.loop = loop
+        self._queued = []
+
+    async def areply(self, payload):
+        self.replied = True
+        async with self.write_lock:
+            await write_pieces(self.sock, reply_pieces(self.frame, payload, self.should_compress(payload)))
+
+    # Sync reply, as called through send_reply by the threaded handlers
+    def reply(self, payload):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            # Inline handler on the loop can't await, so queue the write behind the connection's lock. flush() waits for it.
+            self._queued.append(asyncio.ensure_future(self.areply(payload)))
+        else:
+            asyncio.run_coroutine_threadsafe(self.areply(payload), self.loop).result()
+
+    async def flush(self):
+        queued, self._queued = self._queued, []
+        await asyncio.gather(*queued)
+
+# OUTBOUND
+######################
+
+class AsyncPipeline:
+    '''Async counterpart of pipeline.PipelinedConnection: many v1 requests in flight on one connection'''
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._send_lock = asyncio.Lock()
+        self._read_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls, address, timeout=CONNECT_TIMEOUT):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+        return cls(address, reader, writer)
+
+    async def request(self, frame):
+        if self.closed:
+            raise ConnectionError(f'Pipelined connection to {self.address} is closed.')
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        tagged = Frame(frame.request, frame.body, version=PROTOCOL_V1, request_id=request_id, flags=frame.flags, deadline=frame.deadline, epoch=frame.epoch)
+        try:
+            async with self._send_lock:
+                await write_pieces(self.writer, tagged.pieces())
+        except OSError as e:
+            self._fail_all(e)
+            raise
+        return await future
+
+    async def _read_loop(self):
+        try:
+            while True:
+                frame = await recv_frame(self.reader)
+                if frame is None:
+                    raise ConnectionError(f'Replica {self.address} closed the pipelined connection.')
+                future = self._pending.pop(frame.request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(memoryview(frame.body))
+        except (OSError, ValueError) as e:
+            self._fail_all(e)
+
+    def _fail_all(self, error):
+        self.closed = True
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Lost connection to {self.address}: {error}'))
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+class AsyncPeerPool:
+    '''One shared AsyncPipeline per peer, reopened when it dies'''
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self._pipelines = {}
+        self._opening = {}
+
+    async def pipeline(self, address):
+        address = tuple(address)
+        pipe = self._pipelines.get(address)
+        if pipe is not None and not pipe.closed:
+            return pipe
+        # Concurrent callers share one connection attempt (shielded, one caller's deadline shouldn't cancel it for everyone)
+        if address not in self._opening:
+            self._opening[address] = asyncio.ensure_future(AsyncPipeline.open(address, self.connect_timeout))
+        try:
+            pipe = self._pipelines[address] = await asyncio.shield(self._opening[address])
+        finally:
+            self._opening.pop(address, None)
+        return pipe
+
+    async def _request(self, address, frame):
+        return await (await self.pipeline(address)).request(frame)
+
+    # Bounded by the frame's deadline, like conn_pool.ConnectionPool.request
+    async def request(self, address, frame):
+        try:
+            reply = await asyncio.wait_for(self._request(address, frame), frame.remaining())
+        except asyncio.TimeoutError:
+            if frame.expired():
+                raise DeadlineExceeded(f'No reply to {frame} from {address} before its deadline.')
+            raise
+        if reply == DEADLINE_EXCEEDED: # The peer dropped it
+            raise DeadlineExceeded(f'{frame} expired at {address}.')
+        return reply
+
+    def discard(self, address):
+        pipe = self._pipelines.pop(tuple(address), None)
+        if pipe is not None:
+            pipe.close()
+
+# ENGINE
+######################
+
+class AsyncEngine:
+    def __init__(self, replica):
+        self.replica = replica
+        self.peers = AsyncPeerPool()
+        self.loop = None
+        self._id_lock = None
+        self._lease_lock = None
+        self.group_commit = AsyncGroupCommit(self.commit_posts)
+        # Peer-facing handlers get async versions, purely local ones run inline
+        self.handlers = {
+            REQUEST_TYPE.POST: self.execute_post,
+            REQUEST_TYPE.READ: self.execute_read,
+            REQUEST_TYPE.r_SYNC: self.execute_sync,
+            REQUEST_TYPE.r_GET_ID: self.execute_get_id,
+            REQUEST_TYPE.r_WRITE: self.inline(replica.execute_write),
+            REQUEST_TYPE.r_READ: self.inline(replica.execute_read_data),
+            REQUEST_TYPE.r_BACKUPDATE: self.inline(replica.execute_backup_state_update),
+            REQUEST_TYPE.r_HELLO: self.inline(replica.execute_hello),
+            REQUEST_TYPE.r_HEARTBEAT: self.inline(replica.execute_heartbeat),
+            REQUEST_TYPE.r_DIGEST: self.inline(replica.execute_digest),
+            REQUEST_TYPE.r_IDS: self.inline(replica.execute_ids),
+            REQUEST_TYPE.r_FETCH: self.inline(replica.execute_fetch),
+            REQUEST_TYPE.r_APPEND: self.inline(replica.execute_append),
+            REQUEST_TYPE.r_TAIL: self.execute_tail,
+            REQUEST_TYPE.r_NEWLEADER: self.inline(replica.execute_new_leader),
+            REQUEST_TYPE.r_LEASE: self.inline(replica.execute_lease),
+            # r_NOMINATE and r_VOTE block on election fan-outs, elections are rare enough for the threaded path
+        }
+        if replica.multicast is not None or replica.relay_fanout: # Broadcasts (and the waits/NACKs/relays behind them) go through the threaded path
+            del self.handlers[REQUEST_TYPE.r_SYNC]
+
+    @staticmethod
+    def inline(handler):
+        async def run(channel, frame):
+            handler(channel, frame)
+            await channel.flush()
+        return run
+
+    # Runs the event loop on its own thread, like the threaded engine's run() returns right away
+    def start(self):
+        ready = threading.Event()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve(ready)))
+        self.thread.start()
+        ready.wait()
+
+    async def serve(self, ready=None):
+        self.loop = asyncio.get_running_loop()
+        self._id_lock = asyncio.Lock()
+        self._lease_lock = asyncio.Lock()
+        host, port = self.replica.connections[self.replica.replica_id]
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=LISTEN_BACKLOG, reuse_address=True)
+        print(f"Node {self.replica.replica_id} listening on {port} (asyncio)")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        print(f"Node {self.replica.replica_id} connected by {writer.get_extra_info('peername')}")
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    frame = await recv_frame(reader)
+                except (ConnectionError, ValueError):
+                    frame = None
+                if frame is None:
+                    break
+                channel = AsyncReplyChannel(writer, frame, write_lock, self.loop, self.replica.compress_threshold)
+                if frame.request == REQUEST_TYPE.r_TAIL: # The stream keeps this connection for good, the follower confirms on it
+                    confirming = asyncio.ensure_future(self.read_confirmations(reader))
+                    try:
+                        await self.dispatch(channel, frame)
+                    finally:
+                        confirming.cancel()
+                    break
+                if frame.version == PROTOCOL_V0:
+                    await self.dispatch(channel, frame)
+                else:
+                    # Pipelined requests run concurrently and reply out of order
+                    task = asyncio.ensure_future(self.dispatch(channel, frame))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            writer.close()
+
+    async def dispatch(self, channel, frame):
+        handler = self.handlers.get(frame.request)
+        try:
+            if frame.expired():
+                print(f'Dropping expired {frame}')
+                await channel.areply(DEADLINE_EXCEEDED)
+            elif self.replica.election.fenced(frame):
+                print(f'Fencing off {frame} from epoch {frame.epoch}')
+                await channel.areply(self.replica.election.stale_reply())
+            elif handler is not None:
+                await handler(channel, frame)
+            else:
+                await self.loop.run_in_executor(None, self.replica.dispatch, channel, frame)
+        except DeadlineExceeded as e:
+            print(f'[!] {e}')
+            await channel.areply(DEADLINE_EXCEEDED)
+        except StaleEpoch as e:
+            print(f'[!] {e}')
+            await channel.areply(self.replica.election.stale_reply())
+        except Exception as e: # Still answered, or the sender would wait for a reply forever
+            print(f'[!] Error handling {frame}: {e!r}')
+            if not channel.replied:
+                await channel.areply(error_reply(e))
+
+    # Peer helpers
+    ##############
+
+    async def peer_features(self, address, deadline=None):
+        address = tuple(address)
+        cache = self.replica._peer_features
+        if address not in cache:
+            reply = await self.peers.request(address, Frame(REQUEST_TYPE.r_HELLO, json.dumps({'features': SUPPORTED_FEATURES}).encode('utf-8'), deadline=deadline))
+            try:
+                cache[address] = set(load_json(reply).get('features', []))
+            except (ValueError, AttributeError):
+                cache[address] = set()
+        return cache[address]
+
+    async def board_flags(self, address, deadline=None):
+        features = await self.peer_features(address, deadline)
+        return (FLAG_BINARY if 'binary' in features else 0) | (FLAG_ACCEPT_COMPRESSED if 'zlib' in features else 0)
+
+    async def fetch_board(self, address, deadline=None):
+        flags = await self.board_flags(address)
+        reply = await self.peers.request(address, Frame(REQUEST_TYPE.r_READ, flags=flags, deadline=deadline))
+        return self.replica.decode_board(reply, flags)
+
+    async def fetch_changes(self, address, deadline=None):
+        frame = self.replica.sync_read_frame(address, await self.peer_features(address), await self.board_flags(address), deadline)
+        return self.replica.decode_sync_read(await self.peers.request(address, frame), frame)
+
+    async def fetch_articles(self, address, ids, deadline=None):
+        flags = await self.board_flags(address)
+        reply = await self.peers.request(address, Frame(REQUEST_TYPE.r_FETCH, id_set.encode(ids), flags=flags, deadline=deadline))
+        return self.replica.decode_board(reply, flags)
+
+    async def catch_up(self, token, deadline=None):
+        replica = self.replica
+        coordinator = replica.connections[replica.coordinator_index]
+        if not replica.caught_up(coordinator, token):
+            await self.pull(coordinator, deadline)
+        if not replica.caught_up(coordinator, token): # From a replaced coordinator, see Replica.pull_majority
+            others, need = replica.majority_pull_targets()
+            replica.check_majority(await agather(others, lambda c: self.pull(c, deadline), deadline, need=need), need)
+
+    async def pull(self, address, deadline=None):
+        frame = self.replica.pull_frame(address, await self.board_flags(address), deadline)
+        self.replica.merge_pull(address, await self.peers.request(address, frame), frame)
+
+    async def fetch_digest(self, address, deadline=None):
+        return article_codec.decode_digest(await self.peers.request(address, Frame(REQUEST_TYPE.r_DIGEST, deadline=deadline)))
+
+    async def forward_to_coordinator(self, message):
+        replica = self.replica
+        coordinator, coord_address, frame = replica.coordinator_request(message)
+        try:
+            return replica.election.check(await self.peers.request(coord_address, frame))
+        except StaleEpoch as e:
+            print(f'[NOTICE!] {coord_address} IS NO LONGER COORDINATOR: {e}')
+        except (OSError, asyncio.TimeoutError):
+            print('[NOTICE!] COORDINATOR HAS DIED. ELECTING NEW COORDINATOR...')
+            self.peers.discard(coord_address)
+            await self.loop.run_in_executor(None, replica.execute_leader_election, coordinator)
+        _, coord_address, frame = replica.coordinator_request(message)
+        return await self.peers.request(coord_address, frame)
+
+    async def get_article_ids(self, count=1):
+        replica = self.replica
+        async with self._id_lock:
+            ceiling = replica.ceiling_for(count)
+            if ceiling is not None: # Durable on the backup before anyone sees its ids
+                replica.election.check(await self.peers.request(replica.connections[replica.backup_index], replica.backup_frame(ceiling)))
+                replica._id_ceiling = ceiling
+            return replica.take_ids(count)
+
+    async def leased_article_id(self, deadline=None):
+        lease = self.replica.id_lease
+        async with self._lease_lock:
+            new_id = lease.take()
+            if new_id is None:
+                lease.refill(*decode_range(await self.forward_to_coordinator(self.replica.lease_request(deadline))))
+                new_id = lease.take()
+        return new_id
+
+    # Handlers
+    ##############
+
+    async def execute_get_id(self, conn, message):
+        if message.body:
+            count = max(1, min(COUNT.unpack(message.body)[0], ID_BLOCK))
+            await conn.areply(RANGE.pack(await self.get_article_ids(count), count))
+        else:
+            await conn.areply(pack('>Q', await self.get_article_ids()))
+
+    async def execute_post(self, conn, message):
+        replica = self.replica
+        if replica.replica_id != replica.coordinator_index:
+            if replica.mode == 'sequential':
+                new_id = await self.leased_article_id(message.deadline)
+                return_message = await self.forward_to_coordinator(replica.leased_post(message, new_id))
+            else:
+                return_message = await self.forward_to_coordinator(message)
+            await conn.areply(return_message)
+            return
+
+        await conn.areply(await self.group_commit.submit(replica.decode_article(message), message.deadline))
+
+    async def commit_posts(self, articles, deadline=None):
+        replica = self.replica
+        epoch = replica.election.epoch
+        board = replica.number_posts(articles, await self.get_article_ids(len(articles)))
+        if replica.writes_to_quorum():
+            written = await self.quorum_write(board, deadline, epoch)
+            if written != b'ACK':
+                return written
+        reply = replica.apply_posts(board)
+        if replica.mode == 'sequential': # Confirmations are read on the loop, so wait for them off it
+            await self.loop.run_in_executor(None, replica.await_followers, replica.log.end, deadline)
+        return reply
+
+    # Replica.quorum_write on the event loop
+    async def quorum_write(self, board, deadline=None, epoch=None):
+        replica = self.replica
+        frames = {}
+        async def write(c):
+            try:
+                frame = replica.batch_frame(frames, await self.board_flags(c, deadline), board, deadline, epoch)
+                return replica.election.check(await self.peers.request(c, frame))
+            except (OSError, DeadlineExceeded, asyncio.TimeoutError): # Handed off later
+                replica.hints.add(c, list(board.values()))
+                raise
+        return replica.quorum_write_reply(await agather(replica.write_targets(), write, deadline, need=replica.write_quorum_size() - 1), board)
+
+    # Same as Replica.read_confirmations
+    async def read_confirmations(self, reader):
+        while True:
+            try:
+                frame = await recv_frame(reader)
+            except (ConnectionError, ValueError):
+                return
+            if frame is None:
+                return
+            self.replica.log.confirm(*POSITION.unpack(frame.body))
+
+    # Same as Replica.execute_tail, woken by the log's appends instead of blocking on them
+    async def execute_tail(self, conn, message):
+        replica = self.replica
+        log_id, offset = POSITION.unpack(message.body)
+        appended = asyncio.Event()
+        wake = lambda: self.loop.call_soon_threadsafe(appended.set)
+        replica.log.listen(wake)
+        try:
+            while replica.coordinator_flag:
+                appended.clear()
+                offset, articles = replica.log.batch(log_id, offset, replica.data)
+                log_id = replica.log.id
+                await conn.areply(POSITION.pack(log_id, offset) + replica.encode_board(articles, message.flags))
+                if offset >= replica.log.end:
+                    try:
+                        await asyncio.wait_for(appended.wait(), TAIL_IDLE)
+                    except asyncio.TimeoutError:
+                        pass
+        except OSError as e:
+            print(f'Log stream ended: {e}')
+        finally:
+            replica.log.unlisten(wake)
+
+    async def execute_read(self, conn, message):
+        replica = self.replica
+        if replica.replica_id != replica.coordinator_index:
+            token = session_token(message.body) if replica.mode == 'read_your_write' else None
+            if replica.mode == 'sequential':
+                await conn.areply(replica.encode_board(replica.data.copy(), message.flags))
+            elif token is not None: # Served here once we've seen the session's writes
+                await self.catch_up(token, message.deadline)
+                await conn.areply(replica.encode_board(replica.data.copy(), message.flags))
+            else:
+                await conn.areply(await self.forward_to_coordinator(message))
+        elif replica.mode == 'quorum':
+            await self.execute_read_quorum(conn, message)
+        else:
+            replica.execute_read_coordinator(conn, message) # sequential / read-your-write reads are local
+            await conn.flush()
+
+    async def execute_read_quorum(self, conn, message):
+        replica = self.replica
+        if replica.read_lease.held(): # Answered from our own board (see read_lease.py)
+            await conn.areply(replica.encode_board(replica.data.copy(), message.flags))
+            return
+        digests = await agather(replica.quorum_read_targets(), lambda c: self.fetch_digest(c, message.deadline), message.deadline)
+        for candidate in replica.read_candidates(digests):
+            board = replica.held_board(candidate)
+            if board is None:
+                try:
+                    board = await self.fetch_board(candidate.address, message.deadline)
+                except (OSError, ValueError) as e:
+                    print(f"[!] Read from {candidate.address} failed: {e!r}")
+                    continue
+            await conn.areply(replica.encode_board(board, message.flags))
+            replica.repair_stale(digests, candidate, board)
+            return
+        await conn.areply(b"Nuthin")
+
+    async def execute_sync(self, conn, message):
+        replica = self.replica
+        if replica.replica_id != replica.coordinator_index:
+            await conn.areply(await self.forward_to_coordinator(message))
+            return
+
+        await self.sync_replicas(message.deadline)
+        await conn.areply(b'ACK')
+
+    async def sync_replicas(self, deadline=None):
+        replica = self.replica
+        read_deadline = split_deadline(deadline) # The writes need the other half
+        reads = await agather(replica.connections, lambda c: self.fetch_changes(c, read_deadline), read_deadline)
+        haves, fetches = replica.merge_sync(reads)
+        fetch_deadline = split_deadline(deadline)
+        replica.merge_fetches(haves, await agather(list(fetches), lambda c: self.fetch_articles(c, fetches[c], fetch_deadline), fetch_deadline))
+
+        version = replica.data.version
+        reachable = [o.address for o in reads if o.ok]
+        if replica.broadcasting: # Multicast and relay trees are threaded
+            writes = await self.loop.run_in_executor(None, replica.broadcast_sync_write, reachable, deadline)
+        else:
+            frames = replica.sync_write_frames(reachable, {c: await self.peer_features(c) for c in reachable}, haves, deadline)
+            async def write_board(c):
+                if frames[c] is None: # Nothing new for it
+                    return b'ACK'
+                return replica.election.check(await self.peers.request(c, frames[c]))
+            writes = await agather(reachable, write_board, deadline)
+        return replica.finish_sync(reachable, writes, version)
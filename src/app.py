@@ -2,8 +2,10 @@
 Basic Client-side app for interacting with our replicated bulletin board service
 """
 
-from core import create_client, Modes
 from msg_utils import *
+from pipeline import PipelinedConnection
+from article_codec import ArticleBatch
+from election import STALE
 import streamlit as st
 from replica import TEST_CONNECTION_LIST
 import random
@@ -16,19 +18,48 @@ import random
 
 SERVERS = TEST_CONNECTION_LIST
 
+REQUEST_DEADLINE = 10 # Seconds a post/read gets end to end, forwarding hops included, before we give up on it
+
 def connect(choice):
     print("Running connection code")
-    # Opens a TCP connection to a server
+    # Opens a pipelined TCP connection to a server, which stays open across requests (no reconnect after every op)
     try:
         print(f"Attempting to connect to server at {choice}...")
-        c = create_client(choice[0], choice[1], mode=Modes.TCP, block=True)
-        print(f"Connected to server using new TCP port:", c)
+        c = PipelinedConnection(choice)
+        print(f"Connected to server using new TCP port:", c.sock)
         st.session_state["SERVER_CONNECTION"] = (choice, c) # This will be the actual client connection, if connection was successful
+
+        # Ask for the binary article codec and compressed replies, falls back to plain JSON if the replica doesn't speak them
+        hello = c.request(Frame(REQUEST_TYPE.r_HELLO, json.dumps({"features": ["binary", "zlib"]}).encode('utf-8')))
+        try:
+            features = load_json(hello).get("features", [])
+        except (ValueError, AttributeError): # UNSUPPORTED, BUSY, an ERROR... anything but a JSON answer means plain JSON
+            features = []
+        st.session_state["READ_FLAGS"] = (FLAG_BINARY if "binary" in features else 0) | (FLAG_ACCEPT_COMPRESSED if "zlib" in features else 0)
     except OSError as e:
         print(f'Could not connect to server at {choice}. Maybe it has not been initialized or has gone down?', e)
 
-def disconnect(sock):
-    sock.sendall(b'DEL')
+# Why a reply is a failure instead of an answer, None if it is an answer. Only the start is looked at, a board can be big.
+def reply_problem(reply):
+    head = bytes(reply[:len(DEADLINE_EXCEEDED)])
+    if head == BUSY:
+        return "The replica is overloaded right now, try again in a moment (or connect to another one)."
+    if head.startswith(STALE):
+        return "The replicas were changing coordinator, try again."
+    if head.startswith(PARTIAL):
+        return "Some replicas didn't answer, try again (or connect to another one)."
+    if head.startswith(ERROR):
+        return f"The replica failed: {bytes(reply[len(ERROR) + 1:]).decode('utf-8', 'replace')}"
+    return None
+
+def disconnect(conn):
+    conn.close()
+
+# Read-your-write replicas ACK a post with a session token, our next READs carry it so any replica shows us our posts
+def remember_session(ack):
+    token = session_token(ack)
+    if token is not None:
+        st.session_state["SESSION_TOKEN"] = token
 
 def perform_reply(reply, parent):
     # request_type = pack('>Q', int(REQUEST_TYPE.REPLY))
@@ -41,15 +72,15 @@ def perform_reply(reply, parent):
                                 "content": reply,
                                 "user": THIS_USER}).encode('utf-8') # bytes
 
-        length = pack('>Q', len(payload))
-        request_type = pack('>Q', int(REQUEST_TYPE.POST))
         # Send POST
-        st.session_state["SERVER_CONNECTION"][1].sendall(request_type+length+payload)
-
-        ack = st.session_state["SERVER_CONNECTION"][1].recv(1000)
+        try:
+            ack = bytes(st.session_state["SERVER_CONNECTION"][1].request(Frame(REQUEST_TYPE.POST, payload, deadline=deadline_in(REQUEST_DEADLINE))))
+        except DeadlineExceeded:
+            st.error("The replicas took too long to accept your reply, try again.")
+            return
+        remember_session(ack)
 
         st.write(ack, ':sparkles:')
-        connect(st.session_state["SERVER_CONNECTION"][0])
 
 
 # By default el is just the normal st context, otherwise our form is built on the given element el
@@ -86,15 +117,13 @@ def gen_post_form(user):
                                         "content": post,
                                         "user": user}).encode('utf-8') # bytes
 
-                    length = pack('>Q', len(payload))
-                    request_type = pack('>Q', int(REQUEST_TYPE.POST))
                     # Send POST
-                    st.session_state["SERVER_CONNECTION"][1].sendall(request_type+length+payload)
-
-                    ack = st.session_state["SERVER_CONNECTION"][1].recv(1000)
-
-                    st.write(ack, ':sparkles:')
-                    connect(st.session_state["SERVER_CONNECTION"][0])
+                    try:
+                        ack = bytes(st.session_state["SERVER_CONNECTION"][1].request(Frame(REQUEST_TYPE.POST, payload, deadline=deadline_in(REQUEST_DEADLINE))))
+                        remember_session(ack)
+                        st.write(ack, ':sparkles:')
+                    except DeadlineExceeded:
+                        st.error("The replicas took too long to accept your post, try again.")
 
             else:
                 st.write("No active replica connection... Are there any server replicas running?")
@@ -102,38 +131,41 @@ def gen_post_form(user):
 def perform_read():
     if st.session_state["SERVER_CONNECTION"] is not None:
 
-        length = pack('>Q', 0)
-        request_type = pack('>Q', int(REQUEST_TYPE.READ))
-
-        # Send READ
-        st.session_state["SERVER_CONNECTION"][1].sendall(request_type+length)
-
-        # Wait for the biiiiiiig message of all the returned articles
-        ret = read(st.session_state["SERVER_CONNECTION"][1]).decode('utf-8')
-        # ret = st.session_state["SERVER_CONNECTION"][1].recv(1000)
-        print(f"Return from read in perform: {ret}")
-        if ret == "Nuthin":
+        # Send READ and wait for the biiiiiiig message of all the returned articles
+        flags = st.session_state.get("READ_FLAGS", 0)
+        token = st.session_state.get("SESSION_TOKEN")
+        body = json.dumps({"token": token}).encode('utf-8') if token is not None else b''
+        try:
+            ret = st.session_state["SERVER_CONNECTION"][1].request(Frame(REQUEST_TYPE.READ, body, flags=flags, deadline=deadline_in(REQUEST_DEADLINE)))
+        except DeadlineExceeded:
+            st.warning("The replicas took too long to answer, try again (or connect to another one).")
+            return
+        print(f"Return from read in perform: {len(ret)} bytes")
+        problem = reply_problem(ret)
+        if bytes(ret) == b"Nuthin":
             st.write("Oopsies... no articles yet :persevere: :sob: :poop:")
+        elif problem is not None:
+            st.warning(problem)
+        elif flags & FLAG_BINARY:
+            st.session_state["ARTICLES"] = ArticleBatch(ret).to_dict()
         else:
-            st.session_state["ARTICLES"] = json.loads(ret)
-        connect(st.session_state["SERVER_CONNECTION"][0])
+            st.session_state["ARTICLES"] = load_json(ret)
 
 def perform_sync():
     if st.session_state["SERVER_CONNECTION"] is not None:
 
         # Send a sync command and wait to get an ack, and then finally perform a read once I get that ack
-        length = pack('>Q', 0)
-        request_type = pack('>Q', int(REQUEST_TYPE.r_SYNC))
-
-        # Send SYNC
-        st.session_state["SERVER_CONNECTION"][1].sendall(request_type+length)
-
-        # Recieve sync ack
-        # ack = read(st.session_state["SERVER_CONNECTION"][1]).decode('utf-8')
-        ack = st.session_state["SERVER_CONNECTION"][1].recv(1000).decode('utf-8')
-
-        # REFRESH THE CONNECTION!!!!!        
-        connect(st.session_state["SERVER_CONNECTION"][0])
+        # Send SYNC and recieve sync ack
+        try:
+            ack = bytes(st.session_state["SERVER_CONNECTION"][1].request(Frame(REQUEST_TYPE.r_SYNC, deadline=deadline_in(REQUEST_DEADLINE))))
+        except DeadlineExceeded:
+            st.warning("The replicas took too long to sync, try again (or connect to another one).")
+            return
+        problem = reply_problem(ack)
+        if problem is not None:
+            st.warning(problem)
+            if not ack.startswith(PARTIAL): # Still synced with the replicas that answered
+                return
 
         perform_read()
 
@@ -168,6 +200,7 @@ if __name__=="__main__":
             connect(choice)
         elif client_state[0] != choice:
             print(f"Currently connected to server {client_state[0]} via TCP socket at {client_state[1]}")
+            disconnect(client_state[1])
             connect(choice)
 
         # print("CURRENT STATE: ", st.session_state)
@@ -0,0 +1,101 @@
+"""
+Compact binary article encoding, negotiated as an alternative to JSON on the wire.
+
+A batch is [1 byte flags][4 byte article count] followed by one record per article:
+    [8 byte id][8 byte parent][4 byte title length][4 byte content length][4 byte user length][title][content][user]
+Ids/parents are signed so a missing id (an article that hasn't been assigned one yet) round trips as -1 -> None.
+Strings are raw UTF-8 and are only decoded when an article is actually accessed.
+
+A board digest is [8 byte max id][8 byte article count][8 byte hash], enough to tell which replica is freshest (and
+whether two replicas hold the same articles) without shipping the board itself.
+"""
+
+import zlib
+from struct import Struct
+
+BATCH_HEADER = Struct('>BI')
+RECORD_HEADER = Struct('>qqIII')
+
+BATCH_REPLACE = 0x01 # The batch is a full board that replaces the receiver's data, instead of articles to merge in
+
+DIGEST = Struct('>qQQ')
+
+FIELDS = ('title', 'content', 'user')
+
+def _int_or_none(value):
+    return -1 if value is None else int(value)
+
+def encode_articles(articles, replace=False):
+    '''Encode an iterable of article dicts as one batch'''
+    parts = [None]
+    count = 0
+    for article in articles:
+        strings = [(article.get(f) or '').encode('utf-8') for f in FIELDS]
+        parts.append(RECORD_HEADER.pack(_int_or_none(article.get('id')), _int_or_none(article.get('parent')), *map(len, strings)))
+        parts.extend(strings)
+        count += 1
+    parts[0] = BATCH_HEADER.pack(BATCH_REPLACE if replace else 0, count)
+    return b''.join(parts)
+
+def encode_board(data, replace=False):
+    '''Encode a whole {id: article} board'''
+    return encode_articles(data.values(), replace=replace)
+
+
+class ArticleBatch:
+    '''Lazily decoded batch: construction only walks the fixed width record headers, strings are decoded on access'''
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        flags, count = BATCH_HEADER.unpack_from(self.buf, 0)
+        self.replace = bool(flags & BATCH_REPLACE)
+        self._records = [] # (id, parent, offset of title, title length, content length, user length)
+        offset = BATCH_HEADER.size
+        for _ in range(count):
+            article_id, parent, *lengths = RECORD_HEADER.unpack_from(self.buf, offset)
+            offset += RECORD_HEADER.size
+            self._records.append((article_id, parent, offset, *lengths))
+            offset += sum(lengths)
+        if offset != len(self.buf):
+            raise ValueError(f'Malformed article batch: expected {offset} bytes, got {len(self.buf)}.')
+
+    def __len__(self):
+        return len(self._records)
+
+    # Only touches the record headers
+    def ids(self):
+        return [r[0] for r in self._records]
+
+    def max_id(self):
+        return max((r[0] for r in self._records), default=0)
+
+    def article(self, i):
+        article_id, parent, offset, *lengths = self._records[i]
+        article = {'id': None if article_id < 0 else article_id, 'parent': None if parent < 0 else parent}
+        for field, length in zip(FIELDS, lengths):
+            article[field] = str(self.buf[offset:offset+length], 'utf-8')
+            offset += length
+        return article
+
+    def __iter__(self):
+        for i in range(len(self._records)):
+            yield self.article(i)
+
+    def to_dict(self):
+        return {a['id']: a for a in self}
+
+
+def article_hash(article):
+    h = zlib.crc32(RECORD_HEADER.pack(_int_or_none(article.get('id')), _int_or_none(article.get('parent')), 0, 0, 0))
+    for f in FIELDS:
+        h = zlib.crc32((article.get(f) or '').encode('utf-8'), h)
+    return h
+
+def board_digest(data):
+    '''(max id, count, hash) of a {id: article} board. The hash is a sum, so it doesn't depend on dict order.'''
+    return max(map(int, data), default=0), len(data), sum(map(article_hash, data.values())) & 0xFFFFFFFFFFFFFFFF
+
+def encode_digest(digest):
+    return DIGEST.pack(*digest)
+
+def decode_digest(buf):
+    return DIGEST.unpack(bytes(buf))
@@ -0,0 +1,131 @@
+"""
+Versioned article board, so SYNC only has to move what changed.
+
+A replica's board is a plain {id: article} dict that also stamps every change with a local version number. Another
+replica can then ask for "everything changed since version v" instead of the whole board. The board's incarnation is
+random per process, so a restarted replica (whose versions start over) is never mistaken for one that is up to date.
+
+A delta r_READ carries [8 byte incarnation][8 byte version] and is answered with the replica's own
+[8 byte incarnation][8 byte version] followed by the changed articles. If the incarnation doesn't match the replica's,
+it sends everything. A peer that has never been read is asked for its id set (r_IDS, see id_set.py) instead, so the
+coordinator only pulls and pushes the articles each side is missing.
+"""
+
+import random
+import threading
+from struct import Struct
+
+MARK = Struct('>QQ')
+
+class VersionedBoard(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.incarnation = random.getrandbits(63)
+        self.version = 0
+        self._changed = {} # id -> version of its last change, kept in version order
+        self._lock = threading.RLock()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, article):
+        with self._lock:
+            if self.get(key, self) == article:
+                return
+            super().__setitem__(key, article)
+            self.version += 1
+            self._changed.pop(key, None)
+            self._changed[key] = self.version
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self._changed.pop(key, None)
+
+    def pop(self, key, *default):
+        with self._lock:
+            self._changed.pop(key, None)
+            return super().pop(key, *default)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._changed.clear()
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            for key, article in dict(*args, **kwargs).items():
+                self[key] = article
+
+    # Plain {id: article} snapshot, taken under the lock so writers can't change the board halfway through. Encoders
+    # and other threads get one of these instead of the live board.
+    def copy(self):
+        with self._lock:
+            return dict.copy(self)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    # Becomes exactly `data`, only stamping articles that actually changed
+    def replace(self, data):
+        with self._lock:
+            for key in [k for k in self if k not in data]:
+                del self[key]
+            self.update(data)
+
+    # {id: article} of everything changed after `version`, newest changes are at the end so this stops early
+    def changes_since(self, version):
+        with self._lock:
+            changed = []
+            for key, stamp in reversed(self._changed.items()):
+                if stamp <= version:
+                    break
+                changed.append(key)
+            return {key: dict.__getitem__(self, key) for key in reversed(changed)}
+
+    # (incarnation, version, ids) at one instant, what an r_IDS reply advertises
+    def have(self):
+        with self._lock:
+            return self.incarnation, self.version, list(self)
+
+    # Answer to a delta read: (incarnation, version, changes) since the requester's mark
+    def delta(self, incarnation, version):
+        with self._lock:
+            if incarnation != self.incarnation:
+                version = 0
+            return self.incarnation, self.version, self.changes_since(version)
+
+
+class SyncMarks:
+    '''What the coordinator knows about each peer between SYNCs'''
+    def __init__(self):
+        self.read = {}  # address -> (incarnation, version) of the peer's board we have read up to
+        self.write = {} # address -> version of our board the peer has been sent up to
+        self._lock = threading.Lock()
+
+    # None until the peer has been read once
+    def read_mark(self, address):
+        with self._lock:
+            return self.read.get(tuple(address))
+
+    def write_mark(self, address):
+        with self._lock:
+            return self.write.get(tuple(address), 0)
+
+    # The peer has been read up to (incarnation, version). A new incarnation lost whatever we had sent it.
+    def set_read(self, address, incarnation, version):
+        address = tuple(address)
+        with self._lock:
+            if self.read.get(address, (incarnation,))[0] != incarnation:
+                self.write.pop(address, None)
+            self.read[address] = (incarnation, version)
+
+    def set_write(self, address, version):
+        with self._lock:
+            self.write[tuple(address)] = max(version, self.write.get(tuple(address), 0))
+
+    def forget(self, address):
+        with self._lock:
+            self.read.pop(tuple(address), None)
+            self.write.pop(tuple(address), None)
@@ -0,0 +1,193 @@
+"""
+Persistent TCP connections between replicas.
+
+Every replica keeps a small pool of long lived sockets to each peer instead of opening (and TIME_WAIT-ing) a fresh
+socket per message. Sockets are health checked when checked out, and broken ones are thrown away and reconnected.
+"""
+
+import socket
+import select
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from msg_utils import recv_length, recv_reply_body, PROTOCOL_V0, DEADLINE_EXCEEDED, DeadlineExceeded
+from pipeline import PipelinedConnection
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# An idle request/response socket should never be readable. If it is, the peer either closed it (EOF) or left junk behind.
+def is_healthy(sock):
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError): # closed / invalid file descriptor
+        return False
+    return not readable
+
+# Read one length prefixed reply, but unlike read() treat a closed socket as an error so the pool can retry
+def read_reply(sock):
+    length = recv_length(sock)
+    if length is None:
+        raise ConnectionError(f'Peer {sock.getpeername()} closed the connection before replying.')
+    return recv_reply_body(sock, length)
+
+
+class ConnectionPool:
+    '''Up to `max_size` long lived connections to a single peer address'''
+    def __init__(self, address, max_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.address = tuple(address)
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size) # Bounds sockets checked out + idle
+
+    def _connect(self, timeout):
+        sock = socket.create_connection(self.address, timeout=timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Small request frames shouldn't sit in Nagle's buffer
+        return sock
+
+    # Returns (socket, reused) so callers know if a failure might just be a stale pooled connection.
+    # `timeout` (a request's remaining deadline) can only shorten the connect timeout.
+    def acquire(self, timeout=None):
+        timeout = self.connect_timeout if timeout is None else min(timeout, self.connect_timeout)
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f'All {self.max_size} pooled connections to {self.address} are busy.')
+        with self._lock:
+            while self._idle:
+                sock = self._idle.pop()
+                if is_healthy(sock):
+                    return sock, True
+                sock.close()
+        try:
+            return self._connect(timeout), False
+        except OSError:
+            self._slots.release()
+            raise
+
+    def release(self, sock, broken=False):
+        if broken:
+            sock.close()
+        else:
+            with self._lock:
+                self._idle.append(sock)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        sock, _ = self.acquire()
+        try:
+            yield sock
+        except BaseException:
+            self.release(sock, broken=True)
+            raise
+        self.release(sock)
+
+    # One request/response round trip. A reused socket that fails is reconnected and the request retried once.
+    # The frame's deadline bounds connecting, sending and waiting for the reply. Running out raises DeadlineExceeded
+    # (a plain timeout still means the peer itself is unresponsive).
+    def request(self, frame, expect_reply=True):
+        if frame.version != PROTOCOL_V0: # Pooled sockets are strictly one request/response at a time
+            frame = frame.retag(frame.request)
+        while True:
+            if frame.expired():
+                raise DeadlineExceeded(f'{frame} expired before it could be sent to {self.address}.')
+            try:
+                sock, reused = self.acquire(frame.remaining())
+            except TimeoutError:
+                if frame.expired():
+                    raise DeadlineExceeded(f'{frame} expired while connecting to {self.address}.')
+                raise
+            try:
+                sock.settimeout(frame.remaining())
+                frame.send(sock)
+                reply = read_reply(sock) if expect_reply else None
+                sock.settimeout(None)
+            except OSError:
+                self.release(sock, broken=True) # A late reply would be read as the answer to the next request
+                if frame.expired():
+                    raise DeadlineExceeded(f'No reply to {frame} from {self.address} before its deadline.')
+                if reused:
+                    continue
+                raise
+            self.release(sock)
+            if reply == DEADLINE_EXCEEDED: # The peer dropped it
+                raise DeadlineExceeded(f'{frame} expired at {self.address}.')
+            return reply
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+class PeerPool:
+    '''One ConnectionPool per peer address, created lazily since the membership can change at runtime'''
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self._pools = {}
+        self._pipelines = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, address):
+        address = tuple(address)
+        with self._lock:
+            if address not in self._pools:
+                self._pools[address] = ConnectionPool(address, self.max_size, self.connect_timeout)
+            return self._pools[address]
+
+    def request(self, address, frame, expect_reply=True):
+        return self[address].request(frame, expect_reply=expect_reply)
+
+    def connection(self, address):
+        return self[address].connection()
+
+    # Shared pipelined connection to a peer (reopened if it died), for firing many requests without waiting on each.
+    # `timeout` (a request's remaining deadline) can only shorten the connect timeout.
+    def pipeline(self, address, timeout=None):
+        address = tuple(address)
+        with self._lock:
+            pipe = self._pipelines.get(address)
+        if pipe is not None and not pipe.closed:
+            return pipe
+        timeout = self.connect_timeout if timeout is None else min(timeout, self.connect_timeout)
+        pipe = PipelinedConnection(address, timeout) # Connect outside the lock, a dead peer can take a while
+        with self._lock:
+            current = self._pipelines.get(address)
+            if current is not None and not current.closed: # Somebody else won the race
+                pipe.close()
+                return current
+            self._pipelines[address] = pipe
+            return pipe
+
+    # Returns a Future for the reply body. Like request(), the frame's deadline bounds connecting.
+    def submit(self, address, frame):
+        if frame.expired():
+            raise DeadlineExceeded(f'{frame} expired before it could be sent to {tuple(address)}.')
+        try:
+            pipe = self.pipeline(address, frame.remaining())
+        except OSError:
+            if frame.expired():
+                raise DeadlineExceeded(f'{frame} expired while connecting to {tuple(address)}.')
+            raise
+        return pipe.submit(frame)
+
+    # Drop every pooled socket to a peer, e.g. once it has been declared dead
+    def discard(self, address):
+        with self._lock:
+            pool = self._pools.pop(tuple(address), None)
+            pipe = self._pipelines.pop(tuple(address), None)
+        if pool is not None:
+            pool.close()
+        if pipe is not None:
+            pipe.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+            pipes, self._pipelines = list(self._pipelines.values()), {}
+        for pool in pools + pipes:
+            pool.close()
@@ -24,6 +24,7 @@ SERVER_TCP_PORT = 54345
 
 class Modes:
     TCP = socket.SOCK_STREAM
+    UDP = socket.SOCK_DGRAM
 
 # Set up our classes and helper functions
 
@@ -65,23 +66,25 @@ def prepend(chunks):
 # SEND AND RECEIVE FUNCTIONS
 ############################
 
+def recv_into(c, view, address=None):
+    '''Fill the writable memoryview `view` completely from socket `c`, returning the number of bytes read'''
+    nread = 0
+    length = len(view)
+    while nread < length:
+        if address is None:
+            n = c.recv_into(view[nread:], length - nread)
+        else:
+            n, _ = c.recvfrom_into(view[nread:], length - nread)
+        if n == 0: # Peer went away part way through a message
+            raise ConnectionError(f'Socket closed after {nread} of {length} bytes received.')
+        nread += n
+    return nread
+
 def recvall(c, length, chunk_size=4096, address=None):
     '''Convenience function to read large amounts of data (> N bytes)'''
-    data = b''
-
-    if address is None:
-        # This assumes we already determined chunk length from initial message from client
-        while len(data) < length:
-            remaining = length - len(data)
-            data += c.recv(min(remaining, chunk_size))
-
-    else:
-        # This assumes we already determined chunk length from initial message from client
-        while len(data) < length:
-            remaining = length - len(data)
-            buf, _ = c.recvfrom(min(remaining, chunk_size))
-            data += buf
-
+    # Single preallocated buffer filled in place, chunk_size is kept for compatibility only
+    data = bytearray(length)
+    recv_into(c, memoryview(data), address=address)
     return data
 
 # takes a socket and bytes object as argument
@@ -0,0 +1,243 @@
+"""
+Epoch-numbered leader election over a fixed membership table.
+
+Replicas are known by id for good (their position in the connection list never changes), and every replica keeps the set
+of ids it believes down. Leadership is held for an epoch. When the coordinator is suspected, the suspecting replica asks
+the first live replica after it in id order to take over (r_NOMINATE). The candidate asks every live replica for its
+vote in epoch + 1 at once (r_VOTE); a replica votes for one candidate per epoch, and only for epochs newer than its own,
+so there is at most one coordinator per epoch, and not while it has promised the coordinator a read lease (see
+read_lease.py). With a majority of the membership it becomes coordinator, carries on above the highest article id any
+voter knew of, tells everyone in parallel (r_NEWLEADER) and then syncs everyone's boards in the background, for writes
+the old coordinator got to some replicas but not to the new one.
+
+Peer writes the coordinator makes (r_WRITE, r_BACKUPDATE) and requests forwarded to it are stamped with the sender's
+epoch in the frame header. A replica that has seen a newer epoch refuses them with STALE and its {"epoch", "leader",
+"down"}, so a deposed coordinator that comes back can't change anything, and whoever gets a STALE follows the newer
+leader instead.
+
+Every wait is bounded: VOTE_TIMEOUT for the votes and ANNOUNCE_TIMEOUT for the announcement, so a candidate that is
+up answers its nomination within NOMINATE_TIMEOUT, and an unreachable one is marked down and the next one asked.
+How long each failover took, from the last sign of life of the old coordinator to a new one, is kept in `failovers`.
+"""
+
+import json
+import threading
+import time
+
+from msg_utils import *
+from fanout import successes, failures
+from id_lease import ID_BLOCK
+
+FIRST_EPOCH = 1 # Epoch 0 on a frame means it isn't fenced
+VOTE_TIMEOUT = 0.25 # Seconds a candidate waits for votes
+ANNOUNCE_TIMEOUT = 0.25 # Seconds a new coordinator waits for the replicas to acknowledge it
+NOMINATE_TIMEOUT = VOTE_TIMEOUT + ANNOUNCE_TIMEOUT + 0.25 # Seconds to wait for a candidate's outcome
+RECONCILE_TIMEOUT = 10 # Seconds a new coordinator's sync of everyone's boards may take
+
+STALE = b'STALE' # Reply prefix to a fenced frame, followed by a space and the replica's election state as JSON
+
+
+class StaleEpoch(Exception):
+    '''A peer has seen a newer epoch than the one we acted in, we have followed its leader meanwhile'''
+
+
+def stale_state(reply):
+    '''Election state from a STALE reply, None for any other reply'''
+    reply = bytes(reply)
+    if not reply.startswith(STALE):
+        return None
+    return load_json(reply[len(STALE) + 1:])
+
+
+class Membership:
+    '''Replica id -> address, which never changes, and the ids believed down'''
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.down = set()
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def majority(self):
+        return len(self.addresses) // 2 + 1
+
+    # Live ids after `replica_id`, in ring order
+    def successors(self, replica_id):
+        n = len(self.addresses)
+        return [i % n for i in range(replica_id + 1, replica_id + n) if i % n not in self.down]
+
+
+class Election:
+    def __init__(self, replica):
+        self.replica = replica
+        self.members = Membership(replica.connections)
+        self.epoch = FIRST_EPOCH
+        self.voted = {} # epoch -> the candidate we voted for
+        self.promised = (None, 0.0) # (leader, time.monotonic() until which we vote for no one else), see read_lease.py
+        self.failovers = [] # Seconds from the old coordinator's last sign of life to a new one, per failover seen through here
+        self._lock = threading.Lock() # One election at a time from here
+        self._state_lock = threading.Lock() # Epoch, leader and votes
+
+    def state(self):
+        return {'epoch': self.epoch, 'leader': self.replica.coordinator_index, 'down': sorted(self.members.down)}
+
+    def stale_reply(self):
+        return STALE + b' ' + json.dumps(self.state()).encode('utf-8')
+
+    # True if `frame` was sent in an epoch older than ours
+    def fenced(self, frame):
+        return 0 < frame.epoch < (self.epoch & Frame.EPOCH_MASK)
+
+    # Follows the leader of a newer epoch, True if it was newer
+    def adopt(self, state):
+        replica = self.replica
+        with self._state_lock:
+            if state['epoch'] <= self.epoch:
+                return False
+            stepped_down = replica.coordinator_flag and state['leader'] != replica.replica_id
+            self.epoch = state['epoch']
+            self.members.down.update(i for i in state.get('down', []) if i != replica.replica_id)
+            self.members.down.discard(state['leader'])
+            self.voted = {e: c for e, c in self.voted.items() if e > self.epoch}
+            replica.coordinator_index = state['leader']
+        if stepped_down:
+            print(f'[NOTICE!] STEPPING DOWN, replica {state["leader"]} is coordinator for epoch {state["epoch"]}')
+        return True
+
+    # Passes a peer's reply through, unless it is a STALE: then we follow the newer leader and raise StaleEpoch
+    def check(self, reply):
+        state = stale_state(reply)
+        if state is not None:
+            self.adopt(state)
+            raise StaleEpoch(f'Replica {state["leader"]} is coordinator for epoch {state["epoch"]}.')
+        return reply
+
+    # Replaces coordinator `suspected`, unless someone already has. `since` is when it was last known alive.
+    def replace(self, suspected, since=None):
+        replica = self.replica
+        since = time.monotonic() if since is None else since
+        with self._lock:
+            if replica.coordinator_index != suspected:
+                return
+            epoch = self.epoch
+            self.members.down.add(suspected)
+            self.nominate_successor(suspected, epoch + 1)
+            if replica.coordinator_index == suspected:
+                # Replicas that granted it a read lease don't vote until the lease has run out (see read_lease.py)
+                time.sleep(replica.read_lease.duration)
+                self.nominate_successor(suspected, epoch + 1)
+            if replica.coordinator_index == suspected:
+                print(f'No new coordinator for epoch {epoch + 1} yet')
+                self.members.down.discard(suspected) # Still the coordinator as far as we know
+                return
+            self.failovers.append(time.monotonic() - since)
+            print(f'[NOTICE!] Replica {replica.coordinator_index} is coordinator for epoch {self.epoch}, {self.failovers[-1] * 1000:.0f} ms after {suspected} was last heard from')
+
+    # Asks the first live replica after `suspected` that answers to stand in `epoch`
+    def nominate_successor(self, suspected, epoch):
+        replica = self.replica
+        for candidate in self.members.successors(suspected):
+            if replica.coordinator_index != suspected: # An announcement got here first
+                return
+            if candidate == replica.replica_id:
+                self.stand(epoch)
+                return
+            nomination = Frame(REQUEST_TYPE.r_NOMINATE, json.dumps({'epoch': epoch, 'down': sorted(self.members.down)}).encode('utf-8'), deadline=deadline_in(NOMINATE_TIMEOUT))
+            try:
+                self.adopt(load_json(replica.pool.request(self.members.addresses[candidate], nomination)))
+                return
+            except (OSError, ValueError, DeadlineExceeded) as e:
+                print(f'Candidate {candidate} did not answer its nomination: {e}')
+                self.members.down.add(candidate)
+
+    # Asks everyone for their vote in `epoch`, and becomes coordinator with a majority. True if we did.
+    def stand(self, epoch):
+        replica = self.replica
+        me = replica.replica_id
+        with self._state_lock:
+            if self.epoch >= epoch or self.bound(me) or self.voted.setdefault(epoch, me) != me:
+                return False
+        request = Frame(REQUEST_TYPE.r_VOTE, json.dumps({'epoch': epoch, 'candidate': me}).encode('utf-8'), deadline=deadline_in(VOTE_TIMEOUT))
+        voters = [self.members.addresses[i] for i in self.members.successors(me)]
+        votes = successes(replica.fanout.gather(voters, lambda c: load_json(replica.pool.request(c, request)), request.deadline))
+        granted = 1 + sum(1 for vote in votes if vote['granted'])
+        if granted < self.members.majority():
+            print(f'Lost the election for epoch {epoch} with {granted} of {len(self.members)} votes')
+            for vote in votes: # Someone may have won it
+                self.adopt(vote['state'])
+            return False
+        with self._state_lock:
+            if self.epoch >= epoch:
+                return False
+            self.epoch = epoch
+            replica.article_id = self.first_free_id([self.ballot()] + votes)
+            replica._id_ceiling = 0
+            replica.coordinator_index = me
+        print(f'Elected coordinator for epoch {epoch} with {granted} of {len(self.members)} votes')
+        self.announce()
+        # Writes the old coordinator got to some replicas but not to us are merged in the background
+        threading.Thread(target=self.reconcile, daemon=True).start()
+        return True
+
+    def reconcile(self):
+        try:
+            self.replica.sync_replicas(deadline_in(RECONCILE_TIMEOUT))
+        except (OSError, DeadlineExceeded, StaleEpoch) as e:
+            print(f'[!] Sync after the election for epoch {self.epoch} failed: {e}')
+
+    # Tells every replica about us in parallel, live ones are waited for up to ANNOUNCE_TIMEOUT
+    def announce(self):
+        replica = self.replica
+        frame = Frame(REQUEST_TYPE.r_NEWLEADER, json.dumps(self.state()).encode('utf-8'), deadline=deadline_in(ANNOUNCE_TIMEOUT))
+        targets = [address for i, address in enumerate(self.members.addresses) if i != replica.replica_id]
+        live = [self.members.addresses[i] for i in self.members.successors(replica.replica_id)]
+        if replica.broadcasting:
+            outcomes = replica.broadcast(frame, targets)
+        else:
+            outcomes = replica.fanout.gather(targets, lambda c: replica.pool.request(c, frame), frame.deadline, need=len(live))
+        for failure in failures(outcomes):
+            if tuple(failure.address) in map(tuple, live):
+                print(f'[!] {failure.address} missed the announcement for epoch {self.epoch}: {failure.error}')
+
+    # r_NOMINATE: take over as coordinator for at least `epoch`, returns our state afterwards
+    def nominate(self, request):
+        replica = self.replica
+        with self._lock:
+            self.members.down.update(i for i in request.get('down', []) if i != replica.replica_id)
+            if self.epoch < request['epoch']:
+                self.stand(max(request['epoch'], self.epoch + 1))
+        return self.state()
+
+    # What a voter knows about ids in use: its id counter (the id ceiling, on the old coordinator's backup) and the
+    # highest id on its board
+    def ballot(self):
+        return {'article_id': self.replica.article_id, 'max_id': max(map(int, self.replica.data.copy()), default=0)}
+
+    # Where a new coordinator's ids carry on. The old backup's ceiling is above every id handed out; without it, the
+    # highest id seen plus a whole block, since the old coordinator may have handed out ids that no voter holds yet.
+    @staticmethod
+    def first_free_id(ballots):
+        ceiling = max(ballot['article_id'] for ballot in ballots)
+        seen = max(ballot['max_id'] for ballot in ballots)
+        return ceiling if ceiling >= seen else seen + ID_BLOCK
+
+    # Promises to vote for no one but `leader` until `until`, if it's our leader in `epoch` and we haven't voted in a
+    # newer one. True if we did.
+    def promise(self, leader, epoch, until):
+        with self._state_lock:
+            if epoch != self.epoch or leader != self.replica.coordinator_index or any(e > self.epoch for e in self.voted):
+                return False
+            self.promised = (leader, until)
+            return True
+
+    # True while a promise to someone other than `candidate` runs, called holding _state_lock
+    def bound(self, candidate):
+        leader, until = self.promised
+        return leader != candidate and time.monotonic() < until
+
+    # r_VOTE: one vote per epoch, only for epochs newer than ours and not while we promised a lease to someone else
+    def vote(self, request):
+        with self._state_lock:
+            epoch, candidate = request['epoch'], request['candidate']
+            granted = epoch > self.epoch and not self.bound(candidate) and self.voted.setdefault(epoch, candidate) == candidate
+            return dict(self.ballot(), granted=granted, state=self.state())
@@ -0,0 +1,128 @@
+"""
+Heartbeats to the coordinator and a phi accrual failure detector on top of them.
+
+Every replica but the coordinator sends it an r_HEARTBEAT every HEARTBEAT_INTERVAL over one persistent connection, and
+keeps the intervals between the replies that came back. Instead of a fixed timeout, suspicion is phi: -log10 of the
+probability that a heartbeat would still be on its way after this long, given the mean and spread of recent intervals
+(Hayashibara et al., "The phi accrual failure detector"). Once phi crosses PHI_THRESHOLD the replica starts a leader
+election right away, so failover takes a fraction of a second and no client request has to time out to trigger it.
+
+Phi 8 means one false suspicion in 10^8 heartbeats if intervals really are that distribution. With the defaults a
+coordinator that stops answering is suspected after about half a second, a jittery one later. Until MIN_SAMPLES
+intervals have been seen there is no distribution to go by, so a coordinator is suspected after BOOTSTRAP_TIMEOUT
+without a heartbeat instead, counted from when we started watching it. That covers a coordinator that is already dead
+when we start, or a new leader that dies right after its election.
+"""
+
+import math
+import socket
+import threading
+import time
+from collections import deque
+
+from msg_utils import *
+from election import stale_state
+
+HEARTBEAT_INTERVAL = 0.1 # Seconds between heartbeats
+PHI_THRESHOLD = 8.0 # Suspicion at which the coordinator is considered dead
+MIN_STD = 0.05 # Seconds, keeps a very regular peer from being suspected on the first late heartbeat
+ACCEPTABLE_PAUSE = 0.1 # Seconds added to the mean interval, e.g. for a GC pause
+HISTORY = 100 # Intervals kept
+MIN_SAMPLES = 3 # Intervals needed before phi is used
+BOOTSTRAP_TIMEOUT = 0.5 # Seconds without a heartbeat before a peer is suspected while there are fewer intervals than that
+
+
+class PhiAccrual:
+    '''Suspicion level of one peer from the arrival times of its heartbeats'''
+    def __init__(self, history=HISTORY, min_std=MIN_STD, acceptable_pause=ACCEPTABLE_PAUSE, min_samples=MIN_SAMPLES, bootstrap_timeout=BOOTSTRAP_TIMEOUT, now=None):
+        self.intervals = deque(maxlen=history)
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.min_samples = min(min_samples, history)
+        self.bootstrap_timeout = bootstrap_timeout
+        self.started = time.monotonic() if now is None else now # When we started watching the peer
+        self.last = None # time.monotonic() of the last heartbeat, None before the first
+
+    def heartbeat(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    # Last time we heard from the peer, or when we started watching it if we never have
+    def last_heard(self):
+        return self.started if self.last is None else self.last
+
+    def phi(self, now=None):
+        now = time.monotonic() if now is None else now
+        if len(self.intervals) < self.min_samples: # Too few intervals to go by, a fixed timeout instead
+            return float('inf') if now - self.last_heard() > self.bootstrap_timeout else 0.0
+        mean = sum(self.intervals) / len(self.intervals)
+        std = max(self.min_std, math.sqrt(sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)))
+        mean += self.acceptable_pause
+        # Logistic approximation of the normal distribution's tail, as in Akka's detector
+        y = (now - self.last - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        tail = e / (1.0 + e) if now - self.last > mean else 1.0 - 1.0 / (1.0 + e)
+        return -math.log10(max(tail, 1e-300))
+
+
+class HeartbeatMonitor:
+    '''Heartbeats the coordinator while we aren't it, and elects a new one as soon as it is suspected'''
+    def __init__(self, replica, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD):
+        self.replica = replica
+        self.interval = interval
+        self.threshold = threshold
+        self.detector = PhiAccrual()
+        self._coordinator = None # Index the detector is tracking
+        self._sock = None
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        replica = self.replica
+        while True:
+            tick = time.monotonic()
+            coordinator = replica.coordinator_index
+            if coordinator != self._coordinator: # New coordinator, new history
+                self._close()
+                self.detector = PhiAccrual()
+                self._coordinator = coordinator
+            if not replica.coordinator_flag:
+                self._beat(replica.connections[coordinator])
+                phi = self.detector.phi()
+                if phi > self.threshold:
+                    print(f'[NOTICE!] COORDINATOR {coordinator} SUSPECTED (phi {phi:.1f}). ELECTING NEW COORDINATOR...')
+                    self._close()
+                    try:
+                        replica.execute_leader_election(coordinator, self.detector.last_heard())
+                    except OSError as e:
+                        print(f'Leader election failed: {e}')
+            time.sleep(max(0.0, tick + self.interval - time.monotonic()))
+
+    # One heartbeat round trip, recorded if it came back in time
+    def _beat(self, address):
+        try:
+            if self._sock is None:
+                self._sock = socket.create_connection(address, timeout=self.interval)
+                self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Stamped with our epoch and carrying our id, so a coordinator that has been replaced meanwhile tells us who by
+            Frame(REQUEST_TYPE.r_HEARTBEAT, pack('>Q', self.replica.replica_id), epoch=self.replica.election.epoch).send(self._sock)
+            reply = read(self._sock)
+            if not reply:
+                raise ConnectionError(f'{address} closed the heartbeat connection.')
+            self.detector.heartbeat()
+            state = stale_state(reply)
+            if state is not None:
+                self.replica.election.adopt(state)
+        except OSError: # Refused, reset or too slow, phi keeps rising until it answers again
+            self._close()
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,119 @@
+"""
+Scatter-gather for coordinator fan-out.
+
+Runs one request per target at the same time and gathers every outcome under a single deadline, so a fan-out costs
+about one round trip to the slowest peer rather than one round trip per peer. A peer that fails or runs past the
+deadline becomes a failed Outcome instead of aborting the whole fan-out, the caller decides what is good enough.
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from msg_utils import DeadlineExceeded
+
+DEFAULT_FANOUT_WORKERS = 32
+REPLY_MARGIN = 0.05 # Seconds of a deadline left over for answering with whatever was gathered
+
+# How long to gather for: stop a little before the deadline, so the reply can still make it back in time
+def gather_timeout(deadline):
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic() - REPLY_MARGIN)
+
+# Part way to the deadline, for requests that fan out twice (reads, then writes) and must leave time for the second
+def split_deadline(deadline, fraction=0.5):
+    if deadline is None:
+        return None
+    now = time.monotonic()
+    return now + max(0.0, deadline - now) * fraction
+
+class Outcome(namedtuple('Outcome', ['address', 'result', 'error'])):
+    '''Result of one target's request, `error` is the exception if it failed'''
+    @property
+    def ok(self):
+        return self.error is None
+
+def successes(outcomes):
+    return [o.result for o in outcomes if o.ok]
+
+def failures(outcomes):
+    return [o for o in outcomes if not o.ok]
+
+def all_expired(outcomes):
+    '''Nothing succeeded and every failure was the deadline, i.e. the whole request ran out of time'''
+    return bool(outcomes) and all(isinstance(o.error, DeadlineExceeded) for o in outcomes)
+
+
+def _enough(done, targets, need):
+    '''True once `need` requests succeeded, or so many failed that `need` can't be reached anymore'''
+    ok = sum(1 for f in done if f.exception() is None)
+    return ok >= need or len(done) - ok > len(targets) - need
+
+# Outcomes for finished requests. Unfinished ones either ran out of time, or are left running once a quorum is reached.
+def _outcomes(targets, futures, left_running):
+    outcomes = []
+    for address, future in zip(targets, futures):
+        if not future.done():
+            if left_running:
+                continue
+            future.cancel() # Late results are simply dropped
+            outcomes.append(Outcome(address, None, DeadlineExceeded(f'{address} did not answer before the deadline.')))
+        elif future.exception() is not None:
+            outcomes.append(Outcome(address, None, future.exception()))
+        else:
+            outcomes.append(Outcome(address, future.result(), None))
+    return outcomes
+
+
+class FanOut:
+    '''Shared worker threads for fanning requests out to peers'''
+    def __init__(self, max_workers=DEFAULT_FANOUT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='fanout')
+
+    # Calls request(address) for every target concurrently. Returns an Outcome per target, in target order.
+    # With `need`, returns as soon as that many have succeeded (or can't anymore): the others keep running in the
+    # background and are left out of the result.
+    def gather(self, targets, request, deadline=None, need=None):
+        futures = [self.executor.submit(request, address) for address in targets]
+        timeout = gather_timeout(deadline)
+        if need is None:
+            wait(futures, timeout)
+            return _outcomes(targets, futures, False)
+        end = None if timeout is None else time.monotonic() + timeout
+        done, pending = set(), set(futures)
+        while pending and not _enough(done, targets, need):
+            finished, pending = wait(pending, None if end is None else max(0.0, end - time.monotonic()), FIRST_COMPLETED)
+            if not finished: # Out of time
+                break
+            done |= finished
+        return _outcomes(targets, futures, _enough(done, targets, need))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+_background = set() # Quorum stragglers the event loop would otherwise only hold weakly
+
+# asyncio counterpart of FanOut.gather, `request(address)` is a coroutine function
+async def agather(targets, request, deadline=None, need=None):
+    timeout = gather_timeout(deadline)
+    tasks = [asyncio.ensure_future(request(address)) for address in targets]
+    if not tasks:
+        return []
+    if need is None:
+        await asyncio.wait(tasks, timeout=timeout)
+        return _outcomes(targets, tasks, False)
+    end = None if timeout is None else time.monotonic() + timeout
+    done, pending = set(), set(tasks)
+    while pending and not _enough(done, targets, need):
+        finished, pending = await asyncio.wait(pending, timeout=None if end is None else max(0.0, end - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+        if not finished:
+            break
+        done |= finished
+    left_running = _enough(done, targets, need)
+    if left_running:
+        for task in pending:
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+    return _outcomes(targets, tasks, left_running)
@@ -0,0 +1,124 @@
+"""
+Group commit of POSTs at the coordinator.
+
+Concurrent POSTs are collected into a batch, until GROUP_SIZE of them are waiting or GROUP_WINDOW has passed since the
+first, and the batch is committed in one go: ids for all of it at once, one r_WRITE for all of it per replica (in
+quorum mode), then the same reply to every waiting client. While a batch is being committed the next one fills up, so under
+bursty posting the coordinator does one round of replication per batch instead of one per POST, and a quiet
+coordinator adds at most GROUP_WINDOW to a POST.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from msg_utils import DeadlineExceeded
+
+GROUP_WINDOW = 0.002 # Seconds the first POST of a batch waits for company
+GROUP_SIZE = 64 # POSTs committed together, at most
+
+# Fails the POSTs that ran out of time waiting for their batch, returns the rest and the deadline to commit them by
+def _live(batch):
+    now = time.monotonic()
+    live = []
+    for item, deadline, future in batch:
+        if future.done(): # The client went away
+            continue
+        if deadline is not None and deadline <= now:
+            future.set_exception(DeadlineExceeded('POST expired waiting for its group commit.'))
+        else:
+            live.append((item, deadline, future))
+    # The batch keeps going until its last client gives up
+    deadlines = [deadline for _, deadline, _ in live]
+    return live, None if None in deadlines or not deadlines else max(deadlines)
+
+
+class GroupCommit:
+    '''Batches submit() calls from many threads into commit(items, deadline) calls on one committer thread'''
+    def __init__(self, commit, window=GROUP_WINDOW, max_batch=GROUP_SIZE):
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    # Blocks until the batch holding `item` is committed, returns the commit's reply or raises its exception
+    def submit(self, item, deadline=None):
+        future = Future()
+        self._queue.put((item, deadline, future))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            end = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, end - time.monotonic())))
+                except queue.Empty:
+                    break
+            live, deadline = _live(batch)
+            if not live:
+                continue
+            try:
+                reply = self.commit([item for item, _, _ in live], deadline)
+            except Exception as e:
+                for _, _, future in live:
+                    future.set_exception(e)
+            else:
+                for _, _, future in live:
+                    future.set_result(reply)
+
+
+class AsyncGroupCommit:
+    '''asyncio counterpart of GroupCommit, `commit` is a coroutine function'''
+    def __init__(self, commit, window=GROUP_WINDOW, max_batch=GROUP_SIZE):
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+
+    async def submit(self, item, deadline=None):
+        if self._queue is None: # Made on the event loop it will run on
+            self._queue = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, deadline, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            end = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            live, deadline = _live(batch)
+            if not live:
+                continue
+            try:
+                reply = await self.commit([item for item, _, _ in live], deadline)
+            except Exception as e:
+                for _, _, future in live:
+                    if not future.done(): # The client may have gone away
+                        future.set_exception(e)
+            else:
+                for _, _, future in live:
+                    if not future.done():
+                        future.set_result(reply)
@@ -0,0 +1,116 @@
+"""
+Hinted handoff for writes to unreachable replicas.
+
+When a write to a peer fails, the coordinator keeps the articles as hints for that peer instead of failing the request,
+and a background thread keeps trying to hand them over in batches (merging r_WRITEs) until the peer is back. Hints are
+bounded per peer: once a peer has missed more than that, or missed a whole board (a SYNC), only a flag is kept and the
+coordinator's full board is merged into the peer when it returns.
+
+Handoff writes carry our epoch and their replies are checked like any other write, so a coordinator that has been
+replaced is fenced off. It then drops its hints, since the new coordinator syncs every board once it is elected.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from msg_utils import *
+from election import StaleEpoch
+import article_codec
+
+MAX_HINTS = 1024 # Articles kept per unreachable peer
+REPLAY_INTERVAL = 1.0 # Seconds between handoff attempts
+REPLAY_BATCH = 64 # Articles per handoff write
+REPLAY_DEADLINE = 5 # Seconds a single handoff write may take
+
+
+class _PeerHints:
+    def __init__(self):
+        self.articles = OrderedDict() # id -> article, oldest first
+        self.full = False # Missed too much, hand over the whole board
+
+
+class HintedHandoff:
+    def __init__(self, replica, max_hints=MAX_HINTS, interval=REPLAY_INTERVAL, batch=REPLAY_BATCH):
+        self.replica = replica
+        self.max_hints = max_hints
+        self.interval = interval
+        self.batch = batch
+        self._peers = {}
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(h.articles) for h in self._peers.values())
+
+    # Remember articles a peer missed. With no articles, the peer missed a whole board.
+    def add(self, address, articles=None):
+        address = tuple(address)
+        with self._lock:
+            hints = self._peers.setdefault(address, _PeerHints())
+            if articles is None:
+                hints.full = True
+            elif not hints.full:
+                for article in articles:
+                    hints.articles[int(article['id'])] = article
+                    hints.articles.move_to_end(int(article['id']))
+                if len(hints.articles) > self.max_hints:
+                    print(f'[!] Too many hints for {address}, it will get the full board instead')
+                    hints.articles.clear()
+                    hints.full = True
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        print(f'Hinted {"a full board" if articles is None else f"{len(articles)} articles"} for unreachable {address}')
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                addresses = list(self._peers)
+            for address in addresses:
+                try:
+                    self.replay(address)
+                except (OSError, DeadlineExceeded) as e: # Still down, try again next round
+                    print(f'Handoff to {address} failed: {e}')
+                except StaleEpoch as e:
+                    print(f'Handoff to {address} fenced off: {e}')
+            if not self.replica.coordinator_flag:
+                self.clear()
+
+    # Forget every hint, e.g. once we're not the coordinator anymore
+    def clear(self):
+        with self._lock:
+            dropped, self._peers = len(self._peers), {}
+        if dropped:
+            print(f'Dropped the hints for {dropped} peers, we are no longer coordinator')
+
+    # Hand a peer's hints over, a batch at a time. Hints are only dropped once the peer acknowledged them.
+    def replay(self, address):
+        replica = self.replica
+        binary = bool(replica.board_flags(address, deadline_in(REPLAY_DEADLINE)) & FLAG_BINARY)
+        while replica.coordinator_flag:
+            epoch = replica.election.epoch
+            with self._lock:
+                hints = self._peers.get(address)
+                if hints is None:
+                    return
+                full = hints.full
+                articles = list(replica.data.copy().values()) if full else list(hints.articles.values())[:self.batch]
+                if not articles and not full:
+                    del self._peers[address]
+                    return
+            if binary:
+                replica.election.check(replica.pool.request(address, Frame(REQUEST_TYPE.r_WRITE, article_codec.encode_articles(articles), flags=FLAG_BINARY, deadline=deadline_in(REPLAY_DEADLINE), epoch=epoch)))
+            else: # JSON writes carry one article each
+                for article in articles:
+                    replica.election.check(replica.pool.request(address, Frame(REQUEST_TYPE.r_WRITE, json.dumps(article).encode('utf-8'), deadline=deadline_in(REPLAY_DEADLINE), epoch=epoch)))
+            print(f'Handed {len(articles)} hinted articles over to {address}')
+            with self._lock:
+                if full:
+                    hints.full = False
+                for article in articles:
+                    # The full board covers every hint up to now, otherwise keep a hint that was replaced meanwhile
+                    if full or hints.articles.get(int(article['id'])) is article:
+                        hints.articles.pop(int(article['id']), None)
@@ -0,0 +1,38 @@
+"""
+Article ids handed out in blocks instead of one round trip at a time.
+
+The coordinator only records a high-water mark with its backup once every ID_BLOCK ids. A backup that takes over
+carries on above that mark, so ids stay unique across a failover (the rest of the old block is simply never used).
+Other replicas lease LEASE_SIZE ids at a time with an r_GET_ID whose body is the count, answered with
+[8 byte first id][8 byte count], and number their sequential posts from the lease without asking again.
+"""
+
+from struct import Struct
+
+ID_BLOCK = 1024 # Ids the coordinator reserves with its backup at a time
+LEASE_SIZE = 32 # Ids a replica leases from the coordinator at a time
+
+COUNT = Struct('>Q')
+RANGE = Struct('>QQ') # first id, count
+
+# (first id, count) from an r_GET_ID reply
+def decode_range(reply):
+    if len(reply) == COUNT.size: # Coordinators without leases hand out a single id
+        return COUNT.unpack(reply)[0], 1
+    return RANGE.unpack(reply)
+
+
+class IdLease:
+    '''Leased ids not used yet, callers serialize take() and refill()'''
+    def __init__(self):
+        self.next = 0
+        self.end = 0
+
+    def take(self):
+        if self.next >= self.end:
+            return None
+        self.next += 1
+        return self.next - 1
+
+    def refill(self, first, count):
+        self.next, self.end = first, first + count
@@ -0,0 +1,80 @@
+"""
+Run-length encoded article id sets, for merging boards by what each replica has rather than by the boards themselves.
+
+Article ids come from a single counter, so a replica's ids are a few long runs of consecutive integers and a set of a
+million articles is usually a handful of [8 byte first id][8 byte run length] pairs on the wire. Sets are sorted numpy
+int64 arrays when numpy is installed, so unions and differences across thousands of replicas are vectorized; without it
+they are plain python sets, which is fine for small clusters.
+"""
+
+from struct import Struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RUN = Struct('>qq') # first id, number of consecutive ids
+
+def of(ids):
+    '''Id set of any iterable of ids (e.g. a board's keys)'''
+    if np is not None:
+        return np.unique(np.fromiter((int(i) for i in ids), dtype=np.int64))
+    return {int(i) for i in ids}
+
+def encode(ids):
+    if np is not None:
+        ids = of(ids) if not isinstance(ids, np.ndarray) else ids
+        if not ids.size:
+            return b''
+        breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+        firsts = ids[np.r_[0, breaks]]
+        lasts = ids[np.r_[breaks - 1, ids.size - 1]]
+        runs = np.empty((firsts.size, 2), dtype='>i8')
+        runs[:, 0], runs[:, 1] = firsts, lasts - firsts + 1
+        return runs.tobytes()
+    runs = []
+    for i in sorted(ids):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return b''.join(RUN.pack(*run) for run in runs)
+
+def decode(buf):
+    if len(buf) % RUN.size:
+        raise ValueError(f'Id set of {len(buf)} bytes is not a whole number of runs.')
+    if np is not None:
+        runs = np.frombuffer(buf, dtype='>i8').reshape(-1, 2).astype(np.int64)
+        firsts, lengths = runs[:, 0], runs[:, 1]
+        if (lengths < 0).any():
+            raise ValueError('Negative run length in id set.')
+        # Every id is its run's first id plus its position within the run
+        starts = np.cumsum(lengths) - lengths
+        return np.repeat(firsts - starts, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+    ids = set()
+    for first, length in RUN.iter_unpack(buf):
+        if length < 0:
+            raise ValueError('Negative run length in id set.')
+        ids.update(range(first, first + length))
+    return ids
+
+def union(sets):
+    sets = list(sets)
+    if np is not None:
+        return np.unique(np.concatenate(sets)) if sets else np.empty(0, dtype=np.int64)
+    return set().union(*sets)
+
+def difference(a, b):
+    '''Ids in `a` that aren't in `b`'''
+    if np is not None:
+        return np.setdiff1d(a, b, assume_unique=True)
+    return a - b
+
+def intersection(a, b):
+    if np is not None:
+        return np.intersect1d(a, b, assume_unique=True)
+    return a & b
+
+def to_list(ids):
+    return [int(i) for i in ids]
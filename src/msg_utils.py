@@ -2,6 +2,8 @@
 from struct import pack, unpack
 import json
 import uuid
+import zlib
+import time
 from enum import IntEnum
 
 # Constants
@@ -9,6 +11,66 @@ CHUNK_SIZE = 512
 SERVER_DEFAULT_ADDR = '' # on windows this should probably be changed to localhost? Or the actual host address...
 SERVER_TCP_PORT = 54345
 
+# Protocol versions, carried in the top byte of the 8 byte request type field so old clients (always 0) keep working
+PROTOCOL_V0 = 0 # [type][length][body], one request at a time per connection, replies are [length][body]
+PROTOCOL_V1 = 1 # [type][length][request id][body], many requests in flight per connection, replies are v1 frames with the same id
+
+# Frame flags, carried in the second byte of the request type field
+FLAG_BINARY = 0x01 # Articles in the body (and in the reply) use article_codec instead of JSON
+FLAG_COMPRESSED = 0x02 # Body is a stream of zlib chunks, the length field still holds the uncompressed size
+FLAG_ACCEPT_COMPRESSED = 0x04 # Sender can take a compressed reply
+FLAG_DELTA = 0x08 # r_READ/r_WRITE of only the articles changed since a sync mark, see board.py
+
+# Optional wire features, agreed per peer/client with an r_HELLO exchange
+SUPPORTED_FEATURES = ['binary', 'zlib', 'delta']
+
+# Reply sent instead of queueing a request when a replica is overloaded, the client should back off or try another replica
+BUSY = b'BUSY'
+
+# Reply prefix when a fan-out only partly succeeded, followed by a space and {"failed": [[host, port], ...]} as JSON
+PARTIAL = b'PARTIAL'
+
+# Read-your-write POSTs are ACKed with a space and {"token": [incarnation, version]} after the ACK: the coordinator's
+# board version that includes the post. A READ whose body is {"token": ...} sees at least that version.
+def session_ack(incarnation, version):
+    return b'ACK ' + json.dumps({'token': [incarnation, version]}).encode('utf-8')
+
+def session_token(body):
+    '''(incarnation, version) from a POST's ACK or a READ's body, None if it carries no token'''
+    body = bytes(body)
+    if body.startswith(b'ACK '):
+        body = body[len(b'ACK '):]
+    try:
+        incarnation, version = load_json(body)['token']
+        return int(incarnation), int(version)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+# Deadlines travel in the 2 reserved bytes of the request type field as the milliseconds the sender has left (0 = none).
+# A relative budget needs no synchronised clocks, each hop turns it back into a local time.monotonic() deadline.
+MAX_DEADLINE_MS = 0xFFFF
+DEADLINE_EXCEEDED = b'DEADLINE_EXCEEDED' # Reply for work dropped because its deadline passed
+ERROR = b'ERROR' # Reply prefix when a handler failed, followed by a space and the error
+
+def error_reply(error):
+    return ERROR + b' ' + repr(error).encode('utf-8')
+
+class DeadlineExceeded(Exception):
+    '''The request's deadline passed before we (or a peer we were waiting on) could finish it'''
+
+# Local deadline `seconds` from now, for building frames
+def deadline_in(seconds):
+    return time.monotonic() + seconds
+
+# Compression (only ever used once negotiated through r_HELLO)
+COMPRESS_THRESHOLD = 4096 # Bodies smaller than this aren't worth compressing
+COMPRESS_CHUNK = 64 * 1024 # Uncompressed bytes fed to zlib per streamed chunk
+COMPRESS_LEVEL = 6
+REPLY_COMPRESSED = 1 << 63 # v0 replies have no flags, so a compressed one sets the top bit of its length
+
+def compression_flag(size, threshold=COMPRESS_THRESHOLD):
+    return FLAG_COMPRESSED if size >= threshold else 0
+
 #Enums
 class REQUEST_TYPE(IntEnum):
     POST = 1
@@ -23,6 +85,18 @@ class REQUEST_TYPE(IntEnum):
     r_READ = 10
     r_BACKUPDATE = 11
     r_NEWLEADER = 12
+    r_HELLO = 13
+    r_NACK = 14
+    r_MCAST_WAIT = 15
+    r_DIGEST = 16
+    r_IDS = 17
+    r_FETCH = 18
+    r_TAIL = 19
+    r_APPEND = 20
+    r_RELAY = 21
+    r_HEARTBEAT = 22
+    r_VOTE = 23
+    r_LEASE = 24
 
 # MSG MANIPULATION
 ######################
@@ -32,6 +106,10 @@ def pack_msg(msg_str):
 def unpack_msg(msg_bytes):
     return msg_bytes.decode('utf-8')
 
+# json.loads doesn't take memoryviews, but str() can decode one without an intermediate bytes copy
+def load_json(buf):
+    return json.loads(str(buf, 'utf-8'))
+
 # These chunking and unchunking funcs are basically my only junky protocol I suppose
 def chunk_msg(msg, chunk_size):
     # Assume we've already got a bytes object (not string) and we'll send the length prior to chunking
@@ -62,24 +140,31 @@ def prepend(chunks):
 # SEND AND RECEIVE FUNCTIONS
 ############################
 
-def recvall(c, length, chunk_size=4096, address=None):
-    '''Convenience function to read large amounts of data (> N bytes)'''
-    data = b''
-
-    if address is None:
-        # This assumes we already determined chunk length from initial message from client
-        while len(data) < length:
-            remaining = length - len(data)
-            data += c.recv(min(remaining, chunk_size))
+def recv_into(c, view, address=None):
+    '''Fill the writable memoryview `view` completely from socket `c`, returning the number of bytes read'''
+    nread = 0
+    length = len(view)
+    while nread < length:
+        if address is None:
+            n = c.recv_into(view[nread:], length - nread)
+        else:
+            n, _ = c.recvfrom_into(view[nread:], length - nread)
+        if n == 0: # Peer went away part way through a message
+            raise ConnectionError(f'Socket closed after {nread} of {length} bytes received.')
+        nread += n
+    return nread
 
-    else:
-        # This assumes we already determined chunk length from initial message from client
-        while len(data) < length:
-            remaining = length - len(data)
-            buf, _ = c.recvfrom(min(remaining, chunk_size))
-            data += buf
+def recv_view(c, length, address=None):
+    '''Read exactly `length` bytes into one preallocated buffer and hand back a memoryview over it (no extra copies)'''
+    view = memoryview(bytearray(length))
+    recv_into(c, view, address=address)
+    return view
 
-    return data
+def recvall(c, length, chunk_size=4096, address=None):
+    '''Convenience function to read large amounts of data (> N bytes)'''
+    # chunk_size is kept for compatibility only, recv_into fills the preallocated buffer as fast as the socket allows.
+    # Returning the underlying bytearray keeps .decode() and json.loads() working for existing callers.
+    return recv_view(c, length, address=address).obj
 
 # takes a socket and bytes object as argument
 def send(sock, data, address=None, send_length=True):
@@ -120,21 +205,288 @@ def send_chunked(sock, data, address=None):
         except:
             print(Warning(f'Paired socket at address {address} could not be found.'))
 
+def recv_length(sock, address=None):
+    # Returns None on a clean disconnect before any header bytes arrived
+    header = memoryview(bytearray(8))
+    try:
+        recv_into(sock, header, address=address)
+    except ConnectionError:
+        return None
+    length, = unpack('>Q', header)
+    return length
+
 # takes socket as argument and optionally a client address if meant to run in UDP mode
 def read(sock, address=None):
     if address is None:
-        nbytes_msg = sock.recv(8) # 8 bytes for 64bit integer message length
-        print(nbytes_msg)
-        if nbytes_msg == b'': # Case for a disconnecting Client socket
-            return nbytes_msg
-        length, = unpack('>Q', nbytes_msg)
-        return recvall(sock, length, chunk_size=512) # Note we're not unpacking this result - leave that to server logic
+        length = recv_length(sock) # 8 bytes for 64bit integer message length
+        if length is None: # Case for a disconnecting Client socket
+            return b''
+        return recvall(sock, length) # Note we're not unpacking this result - leave that to server logic
     else:
         try:
-            nbytes_msg = sock.recvfrom(8)[0] # 8 bytes for 64bit integer
-            if nbytes_msg == b'': # Case for a disconnecting Client socket
-                return nbytes_msg
-            length, = unpack('>Q', nbytes_msg)
-            return recvall(sock, length, chunk_size=512, address=address) # Note we're not unpacking this result - leave that to server logic
+            length = recv_length(sock, address=address) # 8 bytes for 64bit integer
+            if length is None: # Case for a disconnecting Client socket
+                return b''
+            return recvall(sock, length, address=address) # Note we're not unpacking this result - leave that to server logic
         except:
-            print(Warning(f'Paired socket at address {address} could not be found.'))
\ No newline at end of file
+            print(Warning(f'Paired socket at address {address} could not be found.'))
+
+# Same as read, but returns a memoryview so large payloads can be sliced and parsed without copying.
+# Also understands compressed replies to requests that set FLAG_ACCEPT_COMPRESSED.
+def read_view(sock):
+    length = recv_length(sock)
+    if length is None:
+        return memoryview(b'')
+    return recv_reply_body(sock, length)
+
+def recv_reply_body(sock, length):
+    if length & REPLY_COMPRESSED:
+        return recv_decompressed(sock, length & ~REPLY_COMPRESSED)
+    return recv_view(sock, length)
+
+# COMPRESSION
+######################
+# A compressed body is streamed as [4 byte chunk length][zlib chunk]... and ends with a 4 byte zero.
+# Chunks are compressed and sent (or received and inflated) one at a time, so the whole compressed copy never exists.
+
+# Yields lists of buffers to send back to back: the header plus each compressed chunk as soon as zlib produces it
+def compressed_pieces(header, body, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level)
+    buffers = [header]
+    for i in range(0, len(body), COMPRESS_CHUNK):
+        chunk = compressor.compress(body[i:i+COMPRESS_CHUNK])
+        if chunk: # zlib may still be buffering
+            yield buffers + [pack('>I', len(chunk)), chunk]
+            buffers = []
+    chunk = compressor.flush()
+    yield buffers + [pack('>I', len(chunk)), chunk, pack('>I', 0)]
+
+def send_compressed(sock, header, body, level=COMPRESS_LEVEL):
+    for buffers in compressed_pieces(header, body, level):
+        send_buffers(sock, buffers)
+
+# Inflates chunks straight into a preallocated buffer of the known uncompressed length
+class Inflater:
+    def __init__(self, length):
+        self.length = length
+        self.view = memoryview(bytearray(length))
+        self.nwritten = 0
+        self._decompressor = zlib.decompressobj()
+
+    def feed(self, chunk):
+        data = self._decompressor.decompress(chunk, self.length - self.nwritten + 1)
+        if self.nwritten + len(data) > self.length or self._decompressor.unconsumed_tail:
+            raise ValueError(f'Compressed body inflates past its declared {self.length} bytes.')
+        self.view[self.nwritten:self.nwritten+len(data)] = data
+        self.nwritten += len(data)
+
+    def finish(self):
+        if self.nwritten != self.length:
+            raise ValueError(f'Compressed body inflated to {self.nwritten} of {self.length} bytes.')
+        return self.view
+
+def decompress_stream(recv, length):
+    inflater = Inflater(length)
+    while True:
+        nbytes, = unpack('>I', recv(4))
+        if nbytes == 0:
+            return inflater.finish()
+        inflater.feed(recv(nbytes))
+
+def recv_decompressed(sock, length):
+    return decompress_stream(lambda n: recv_view(sock, n), length)
+
+# Gather-send a list of buffers with as few syscalls as possible (one sendmsg when the kernel takes it all)
+def send_buffers(sock, buffers):
+    views = [memoryview(b) for b in buffers if len(b)]
+    if not hasattr(sock, 'sendmsg'): # e.g. Windows, fall back to one sendall per buffer (still no concatenation)
+        for v in views:
+            sock.sendall(v)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop whatever the kernel accepted and retry with the remainder
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+# Wire pieces (see compressed_pieces) of a reply to `frame`: [length][payload] for v0, a tagged frame for v1
+def reply_pieces(frame, payload, compress=False):
+    if frame is not None and frame.version != PROTOCOL_V0:
+        return frame.response(payload, compress=compress).pieces()
+    if compress:
+        return compressed_pieces(pack('>Q', len(payload) | REPLY_COMPRESSED), payload)
+    return [[pack('>Q', len(payload)), payload]]
+
+# Replies are just [8 byte length][payload], sent without building a joined copy of the payload
+def send_reply(sock, payload, compress=False):
+    if isinstance(sock, ReplyChannel): # Replies to a received frame are formatted by the channel
+        sock.reply(payload)
+    else:
+        for buffers in reply_pieces(None, payload, compress):
+            send_buffers(sock, buffers)
+
+# Where a handler's reply goes, handed to handlers in place of the raw socket. It knows the request frame, so it can
+# answer in the right format: v0 replies are [length][payload], v1 replies are tagged with the request id (written under a
+# per-connection lock so pipelined handlers can finish in any order), and large replies get compressed if the requester
+# said it can take that.
+class ReplyChannel:
+    def __init__(self, sock, frame, write_lock, compress_threshold=COMPRESS_THRESHOLD):
+        self.sock = sock
+        self.frame = frame
+        self.write_lock = write_lock
+        self.compress_threshold = compress_threshold
+        self.replied = False # Set once a reply went out, so a failing handler isn't answered twice
+
+    def should_compress(self, payload):
+        return bool(self.frame.flags & FLAG_ACCEPT_COMPRESSED) and len(payload) >= self.compress_threshold
+
+    def reply(self, payload):
+        self.replied = True
+        with self.write_lock:
+            for buffers in reply_pieces(self.frame, payload, self.should_compress(payload)):
+                send_buffers(self.sock, buffers)
+
+# FRAMES
+######################
+# Requests on the wire are [8 byte request type][8 byte body length](v1 only: [8 byte request id])[body]
+# The request type field is [1 byte version][1 byte flags][2 byte deadline budget in ms][2 byte epoch][2 byte REQUEST_TYPE]
+class Frame:
+    HEADER_SIZE = 16
+    VERSION_SHIFT = 56
+    FLAGS_SHIFT = 48
+    BUDGET_SHIFT = 32
+    EPOCH_SHIFT = 16
+    EPOCH_MASK = 0xFFFF
+    TYPE_MASK = 0xFFFF
+
+    def __init__(self, request, body=b'', version=PROTOCOL_V0, request_id=0, flags=0, deadline=None, epoch=0):
+        self.request = int(request)
+        self.body = memoryview(body) # Always a view, so slicing and re-tagging never copies the payload
+        self.version = version
+        self.request_id = request_id
+        self.flags = flags
+        self.deadline = deadline # Local time.monotonic() deadline, or None for no deadline
+        self.epoch = epoch & self.EPOCH_MASK # Leader epoch the sender acted in (see election.py), 0 if it isn't fenced
+
+    # Seconds left before the deadline (never negative), None if there is no deadline
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def __len__(self):
+        return len(self.body)
+
+    def __repr__(self):
+        try:
+            name = REQUEST_TYPE(self.request).name
+        except ValueError:
+            name = str(self.request)
+        if self.version == PROTOCOL_V0:
+            return f'Frame({name}, {len(self.body)} bytes)'
+        return f'Frame({name}, {len(self.body)} bytes, v{self.version} id={self.request_id})'
+
+    # The budget is worked out when the header is built, so time spent on this hop is already subtracted
+    def budget(self):
+        if self.deadline is None:
+            return 0
+        return min(MAX_DEADLINE_MS, max(1, int(self.remaining() * 1000))) # 1ms rather than 0 (no deadline) once expired
+
+    def header(self):
+        word = (self.version << self.VERSION_SHIFT) | (self.flags << self.FLAGS_SHIFT) | (self.budget() << self.BUDGET_SHIFT) | (self.epoch << self.EPOCH_SHIFT) | self.request
+        if self.version == PROTOCOL_V0:
+            return pack('>QQ', word, len(self.body))
+        return pack('>QQQ', word, len(self.body), self.request_id)
+
+    # Same body buffer under a new request type, used when forwarding. Request ids are per connection, so they're dropped,
+    # but flags describe the body and the deadline covers every hop, so they travel with it (and so does the epoch unless
+    # the forwarder stamps its own).
+    def retag(self, request, epoch=None):
+        return Frame(request, self.body, flags=self.flags, deadline=self.deadline, epoch=self.epoch if epoch is None else epoch)
+
+    # Reply to this frame: v1 replies echo the request type, id and flags
+    def response(self, payload, compress=False):
+        flags = (self.flags & ~FLAG_COMPRESSED) | (FLAG_COMPRESSED if compress else 0)
+        return Frame(self.request, payload, version=self.version, request_id=self.request_id, flags=flags)
+
+    # The frame as one buffer, exactly what send() puts on the wire (compressed if FLAG_COMPRESSED is set)
+    def encode(self):
+        return b''.join(b for buffers in self.pieces() for b in buffers)
+
+    @classmethod
+    def parse_word(cls, word):
+        version = word >> cls.VERSION_SHIFT
+        if version > PROTOCOL_V1:
+            raise ValueError(f'Unsupported protocol version {version}.')
+        return version, (word >> cls.FLAGS_SHIFT) & 0xFF, word & cls.TYPE_MASK
+
+    @classmethod
+    def parse_epoch(cls, word):
+        return (word >> cls.EPOCH_SHIFT) & cls.EPOCH_MASK
+
+    # Local deadline for a request type field that was just received
+    @classmethod
+    def parse_deadline(cls, word):
+        budget = (word >> cls.BUDGET_SHIFT) & 0xFFFF
+        return deadline_in(budget / 1000) if budget else None
+
+    @classmethod
+    def decode(cls, buf):
+        buf = memoryview(buf)
+        word, length = unpack('>QQ', buf[:cls.HEADER_SIZE])
+        version, flags, request = cls.parse_word(word)
+        deadline, epoch = cls.parse_deadline(word), cls.parse_epoch(word)
+        offset, request_id = cls.HEADER_SIZE, 0
+        if version >= PROTOCOL_V1:
+            request_id, = unpack('>Q', buf[offset:offset+8])
+            offset += 8
+        if flags & FLAG_COMPRESSED:
+            cursor = [offset]
+            def take(n):
+                cursor[0] += n
+                return buf[cursor[0]-n:cursor[0]]
+            return cls(request, decompress_stream(take, length), version=version, request_id=request_id, flags=flags & ~FLAG_COMPRESSED, deadline=deadline, epoch=epoch)
+        return cls(request, buf[offset:offset+length], version=version, request_id=request_id, flags=flags, deadline=deadline, epoch=epoch)
+
+    # Blocks for one full frame, returns None if the peer disconnected cleanly before sending anything
+    @classmethod
+    def recv(cls, sock):
+        header = memoryview(bytearray(cls.HEADER_SIZE))
+        try:
+            recv_into(sock, header)
+        except ConnectionError:
+            return None
+        word, length = unpack('>QQ', header)
+        version, flags, request = cls.parse_word(word)
+        deadline, epoch = cls.parse_deadline(word), cls.parse_epoch(word)
+        request_id = 0
+        if version >= PROTOCOL_V1:
+            request_id, = unpack('>Q', recv_view(sock, 8))
+        if flags & FLAG_COMPRESSED: # Received bodies are always plain, the flag only describes the wire
+            return cls(request, recv_decompressed(sock, length), version=version, request_id=request_id, flags=flags & ~FLAG_COMPRESSED, deadline=deadline, epoch=epoch)
+        return cls(request, recv_view(sock, length), version=version, request_id=request_id, flags=flags, deadline=deadline, epoch=epoch)
+
+    # Lists of buffers to write back to back, a single [header, body] unless the body gets compressed on the way out
+    def pieces(self):
+        if self.flags & FLAG_COMPRESSED:
+            return compressed_pieces(self.header(), self.body)
+        return [[self.header(), self.body]]
+
+    # Header and body go out in one vectored send, or as a compressed chunk stream if FLAG_COMPRESSED is set
+    def send(self, sock):
+        for buffers in self.pieces():
+            send_buffers(sock, buffers)
+
+    def text(self):
+        return str(self.body, 'utf-8')
+
+    def json(self):
+        return load_json(self.body)
@@ -0,0 +1,213 @@
+"""
+UDP multicast fan-out for coordinator -> replica broadcasts.
+
+Instead of writing the same frame to every replica over its own TCP connection, the coordinator sends it once to a
+multicast group. The encoded frame is cut into fixed size fragments (like chunk_msg), each one a datagram:
+    [4 byte session][8 byte sequence number][2 byte fragment index][2 byte fragment count][fragment]
+The session is random per sender, so a restarted coordinator starts a fresh sequence instead of looking like a replay.
+
+Receivers reassemble the fragments and hand complete frames to the replica strictly in sequence order. UDP can drop
+datagrams, so after multicasting the coordinator sends every target a small r_MCAST_WAIT over TCP, which blocks until
+that sequence number has been delivered and replies with the handler's reply. A receiver that is missing a message by
+then asks the sender for it with r_NACK, which retransmits the whole encoded frame over the normal TCP path.
+"""
+
+import json
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from struct import Struct, pack
+
+from msg_utils import *
+
+DATAGRAM_HEADER = Struct('>IQHH')
+FRAGMENT_SIZE = 1400 # Keeps datagrams under a typical Ethernet MTU, so IP never has to fragment them itself
+MAX_FRAGMENTS = 0xFFFF
+RETAIN = 256 # Broadcasts the sender keeps around to answer NACKs
+MULTICAST_TTL = 1 # Stay on the LAN
+RECV_BUFFER = 4 * 1024 * 1024 # Room for a whole burst of fragments while the receiver thread catches up
+NACK_DELAY = 0.05 # How long a wait gives the datagrams to show up before NACKing
+WAIT_TIMEOUT = 10 # Upper bound on a wait without a deadline
+GONE = b'GONE' # NACK reply for a message the sender no longer has
+
+def fragments(payload, size=FRAGMENT_SIZE):
+    view = memoryview(payload)
+    return [view[i:i+size] for i in range(0, len(view), size)] or [view]
+
+def membership(group, interface):
+    return pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface))
+
+
+class DeliveryChannel(ReplyChannel):
+    '''Stands in for a connection when a replica handles a multicast frame, keeping the reply for the r_MCAST_WAIT'''
+    def __init__(self, frame):
+        super().__init__(None, frame, None)
+        self.payload = b'ACK'
+
+    def reply(self, payload):
+        self.replied = True
+        self.payload = bytes(payload)
+
+
+class MulticastSender:
+    def __init__(self, group, port, interface='0.0.0.0', ttl=MULTICAST_TTL, fragment_size=FRAGMENT_SIZE, retain=RETAIN):
+        self.group = (group, port)
+        self.fragment_size = fragment_size
+        self.retain = retain
+        self.session = random.getrandbits(32)
+        self._seq = 0
+        self._sent = OrderedDict() # seq -> encoded frame, for retransmission
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # Replicas on this host (ourselves included) are members too
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+
+    # Multicasts one frame, returns its sequence number
+    def send(self, frame):
+        payload = frame.encode() # Compressed frames stay compressed
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._sent[seq] = payload
+            while len(self._sent) > self.retain:
+                self._sent.popitem(last=False)
+        chunks = fragments(payload, self.fragment_size)
+        if len(chunks) > MAX_FRAGMENTS: # Receivers will NACK the whole thing over TCP instead
+            print(f'Broadcast {seq} is too big to multicast ({len(payload)} bytes), receivers will fetch it over TCP')
+            return seq
+        for index, chunk in enumerate(chunks):
+            try:
+                self.sock.sendmsg([DATAGRAM_HEADER.pack(self.session, seq, index, len(chunks)), chunk], [], 0, self.group)
+            except OSError as e: # Same as a lost datagram, NACKs recover it
+                print(f'Multicast of {seq} failed: {e}')
+                break
+        return seq
+
+    def retransmit(self, seq):
+        with self._lock:
+            return self._sent.get(seq)
+
+    def close(self):
+        self.sock.close()
+
+
+class _Stream:
+    '''Receive state for one sender session'''
+    def __init__(self, delivered):
+        self.delivered = delivered      # every seq up to here has been handed to the replica
+        self.partial = {}               # seq -> {fragment index: bytes}
+        self.complete = {}              # seq -> encoded frame (None if it can't be recovered), waiting for earlier seqs
+        self.replies = OrderedDict()    # seq -> reply of the handler, for r_MCAST_WAIT
+
+
+class MulticastReceiver:
+    '''Joins the group and delivers each sender's frames, in order, to `dispatch(conn, frame)`'''
+    def __init__(self, group, port, dispatch, interface='0.0.0.0', retain=RETAIN):
+        self.dispatch = dispatch
+        self.retain = retain
+        self._streams = {}
+        self._cond = threading.Condition()
+        self._deliver_lock = threading.Lock() # One frame handled at a time, so delivery order is handling order
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Every replica on the host binds the same port
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+        try:
+            self.sock.bind((group, port)) # Only this group's traffic where the OS supports it
+        except OSError:
+            self.sock.bind(('', port))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership(group, interface))
+        threading.Thread(target=self._recv_loop, daemon=True).start()
+
+    # A stream starts right before the first seq we hear about, whether that's a datagram or a wait
+    def _stream(self, session, seq):
+        if session not in self._streams:
+            self._streams[session] = _Stream(seq - 1)
+        return self._streams[session]
+
+    def _recv_loop(self):
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        while True:
+            try:
+                n = self.sock.recv_into(buf)
+                session, seq, index, count = DATAGRAM_HEADER.unpack_from(buf)
+            except OSError:
+                return
+            except ValueError: # Runt datagram, not ours
+                continue
+            with self._cond:
+                stream = self._stream(session, seq)
+                if seq <= stream.delivered or seq in stream.complete:
+                    continue
+                parts = stream.partial.setdefault(seq, {})
+                parts[index] = bytes(view[DATAGRAM_HEADER.size:n])
+                if len(parts) == count:
+                    del stream.partial[seq]
+                    stream.complete[seq] = b''.join(parts[i] for i in range(count))
+            self._deliver(session)
+
+    # Hands every frame that is next in line to the replica
+    def _deliver(self, session):
+        with self._deliver_lock:
+            while True:
+                with self._cond:
+                    stream = self._streams[session]
+                    seq = stream.delivered + 1
+                    if seq not in stream.complete:
+                        return
+                    payload = stream.complete.pop(seq)
+                reply = GONE
+                if payload is not None:
+                    frame = Frame.decode(payload)
+                    channel = DeliveryChannel(frame)
+                    self.dispatch(channel, frame)
+                    reply = channel.payload
+                with self._cond:
+                    stream.delivered = seq
+                    stream.replies[seq] = reply
+                    while len(stream.replies) > self.retain:
+                        stream.replies.popitem(last=False)
+                    for s in [s for s in stream.partial if s <= seq]:
+                        del stream.partial[s]
+                    self._cond.notify_all()
+
+    def _recovered(self, session, seq, payload):
+        with self._cond:
+            stream = self._streams[session]
+            if seq > stream.delivered and seq not in stream.complete:
+                stream.partial.pop(seq, None)
+                stream.complete[seq] = payload
+        self._deliver(session)
+
+    # Blocks until `seq` of `session` has been delivered and returns the reply it produced. Anything still missing after
+    # a short grace period is fetched with `nack(seq)` (the encoded frame, or GONE if the sender dropped it).
+    def wait(self, session, seq, nack, deadline=None):
+        deadline = deadline_in(WAIT_TIMEOUT) if deadline is None else deadline
+        nack_at = time.monotonic() + NACK_DELAY
+        while True:
+            with self._cond:
+                stream = self._stream(session, seq)
+                self._cond.wait_for(lambda: stream.delivered >= seq, max(0.0, min(nack_at, deadline) - time.monotonic()))
+                if stream.delivered >= seq:
+                    return stream.replies.get(seq, b'ACK')
+                missing = [s for s in range(stream.delivered + 1, seq + 1) if s not in stream.complete]
+            if time.monotonic() >= deadline:
+                raise DeadlineExceeded(f'Multicast {seq} was not delivered in time.')
+            for s in missing:
+                try:
+                    payload = bytes(nack(s))
+                except (OSError, DeadlineExceeded) as e:
+                    print(f'NACK for multicast {s} failed: {e}')
+                    payload = GONE
+                self._recovered(session, s, None if payload == GONE else payload)
+            nack_at = time.monotonic() + NACK_DELAY
+
+    def close(self):
+        self.sock.close()
+
+# Body of an r_MCAST_WAIT, the address is where NACKs go
+def wait_body(session, seq, sender):
+    return json.dumps({'session': session, 'seq': seq, 'sender': list(sender)}).encode('utf-8')
@@ -0,0 +1,92 @@
+"""
+Pipelined (protocol v1) client connection.
+
+Every request gets a request id in its frame header, so many requests can be in flight on one socket and the replica
+may answer them in any order. A background reader thread matches replies back up with the waiting Futures.
+"""
+
+import socket
+import itertools
+import threading
+from concurrent.futures import Future
+
+from msg_utils import Frame, PROTOCOL_V1, DEADLINE_EXCEEDED, DeadlineExceeded
+
+# Waits for a submitted frame's reply, but no longer than the frame's deadline allows
+def wait_reply(future, frame, timeout=None):
+    remaining = frame.remaining()
+    if remaining is not None and (timeout is None or remaining <= timeout):
+        try:
+            reply = future.result(remaining)
+        except TimeoutError:
+            raise DeadlineExceeded(f'No reply to {frame} before its deadline.')
+    else:
+        reply = future.result(timeout)
+    if reply == DEADLINE_EXCEEDED: # The peer dropped it
+        raise DeadlineExceeded(f'{frame} expired at the peer.')
+    return reply
+
+class PipelinedConnection:
+    def __init__(self, address, connect_timeout=10):
+        self.address = tuple(address)
+        self.sock = socket.create_connection(self.address, timeout=connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}                  # request id -> Future waiting on its reply
+        self._lock = threading.Lock()       # guards _pending and closed
+        self._send_lock = threading.Lock()  # whole frames only, never interleaved
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    # Send a frame without waiting, the returned Future resolves to the reply body (a memoryview)
+    def submit(self, frame):
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise ConnectionError(f'Pipelined connection to {self.address} is closed.')
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        tagged = Frame(frame.request, frame.body, version=PROTOCOL_V1, request_id=request_id, flags=frame.flags, deadline=frame.deadline, epoch=frame.epoch)
+        try:
+            with self._send_lock:
+                tagged.send(self.sock)
+        except OSError as e:
+            self._fail_all(e)
+            raise
+        return future
+
+    # Blocking round trip, other threads can keep submitting on the same connection meanwhile
+    def request(self, frame, timeout=None):
+        return wait_reply(self.submit(frame), frame, timeout)
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame = Frame.recv(self.sock)
+                if frame is None:
+                    raise ConnectionError(f'Replica {self.address} closed the pipelined connection.')
+                with self._lock:
+                    future = self._pending.pop(frame.request_id, None)
+                if future is not None: # Unknown ids are replies nobody waits on anymore
+                    future.set_result(frame.body)
+        except (OSError, ValueError) as e:
+            self._fail_all(e)
+
+    def _fail_all(self, error):
+        with self._lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Lost connection to {self.address}: {error}'))
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,101 @@
+"""
+Read leases for the quorum-mode coordinator.
+
+A quorum READ normally asks every replica for its digest and reads the freshest board. While the coordinator holds a
+lease from a majority it answers from its own board instead, since every acknowledged POST is applied there (and only
+once W replicas, counting the coordinator, have it). The coordinator asks every live replica for a grant (r_LEASE) every LEASE_RENEW seconds. A replica
+grants only its leader of the epoch the request was stamped with, and then votes for no one else for LEASE_DURATION
+from when the request reached it. The coordinator counts the lease from when it sent the request, minus CLOCK_DRIFT,
+so its lease always runs out before the last grant behind it does. No new coordinator can be elected, and no
+other coordinator can get an acknowledged write in, while the lease is held.
+
+Before its first lease in an epoch, the coordinator syncs every board. The sync has to read a majority of replicas
+that had granted in that epoch, which means they had already stopped taking the old coordinator's writes. So a write
+the old coordinator got acknowledged can't be missing from our board.
+
+r_LEASE body: the coordinator's {"epoch", "leader", "down"} as JSON
+Reply: {"granted": true/false} as JSON
+"""
+
+import json
+import threading
+import time
+
+from msg_utils import *
+from fanout import successes
+from election import StaleEpoch
+
+LEASE_DURATION = 0.5 # Seconds a grant binds the replica that gave it, about as long as the failure detector takes anyway
+LEASE_RENEW = 0.1 # Seconds between renewals
+CLOCK_DRIFT = 0.01 # Fraction of the lease the coordinator gives up in case its clock runs slower than a grantor's
+LEASE_SYNC_TIMEOUT = 1 # Seconds for the sync before the first lease in an epoch, retried every round until it succeeds
+
+
+class ReadLease:
+    '''The coordinator's read lease, and the r_LEASE grants every replica gives'''
+    def __init__(self, replica, duration=LEASE_DURATION, renew=LEASE_RENEW):
+        self.replica = replica
+        self.duration = duration
+        self.renew_interval = renew
+        self.epoch = None # Epoch our lease is for
+        self.expires = 0.0 # time.monotonic() our lease runs out
+        self.synced = None # Epoch whose boards we synced with a majority of grantors
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    # True while we may answer reads from our own board
+    def held(self):
+        replica = self.replica
+        return replica.coordinator_flag and self.epoch == replica.election.epoch and time.monotonic() < self.expires
+
+    def _run(self):
+        while True:
+            tick = time.monotonic()
+            if self.replica.coordinator_flag:
+                try:
+                    self.renew()
+                except (OSError, DeadlineExceeded, StaleEpoch) as e:
+                    print(f'[!] Read lease renewal failed: {e}')
+            time.sleep(max(0.0, tick + self.renew_interval - time.monotonic()))
+
+    # One round of grants, True if we hold the lease afterwards
+    def renew(self):
+        replica = self.replica
+        election = replica.election
+        epoch = election.epoch
+        start = time.monotonic()
+        granted = self.request_grants(epoch)
+        if len(granted) + 1 < election.members.majority():
+            return False
+        if self.synced != epoch:
+            read = {tuple(c) for c in replica.sync_replicas(deadline_in(LEASE_SYNC_TIMEOUT))}
+            if len(read & granted) + 1 < election.members.majority(): # Try again next round
+                print(f'Read lease for epoch {epoch} waits for a sync with a majority, read {len(read)} boards')
+                return False
+            self.synced = epoch
+            print(f'Synced boards for read leases in epoch {epoch}')
+        if not replica.coordinator_flag or election.epoch != epoch:
+            return False
+        self.epoch, self.expires = epoch, start + self.duration * (1 - CLOCK_DRIFT)
+        return True
+
+    # Addresses of the replicas that granted us a lease in `epoch`
+    def request_grants(self, epoch):
+        replica = self.replica
+        election = replica.election
+        frame = Frame(REQUEST_TYPE.r_LEASE, json.dumps(election.state()).encode('utf-8'), deadline=deadline_in(self.duration / 2), epoch=epoch)
+        def ask(c):
+            return tuple(c) if load_json(election.check(replica.pool.request(c, frame)))['granted'] else None
+        others = [election.members.addresses[i] for i in election.members.successors(replica.replica_id)]
+        grants = replica.fanout.gather(others, ask, frame.deadline, need=election.members.majority() - 1)
+        return {c for c in successes(grants) if c is not None}
+
+    # r_LEASE: grant our leader a lease, if the request is from it in our epoch
+    def grant(self, request):
+        election = self.replica.election
+        election.adopt(request)
+        return {'granted': election.promise(request['leader'], request['epoch'], time.monotonic() + self.duration)}
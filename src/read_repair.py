@@ -0,0 +1,94 @@
+"""
+Background read repair for quorum mode.
+
+When a quorum read sees replicas whose digest differs from the board it answered with, the coordinator schedules a
+repair for each of them. A single worker thread asks the stale replica which article ids it holds (r_IDS, a run-length
+encoded id set, see id_set.py) and pushes only the missing articles to it with a merging r_WRITE. Repairs never hold up
+the read itself, a replica already waiting for a repair isn't queued twice, and a token bucket caps how many run per
+second so a badly diverged cluster can't turn every read into a write storm. Every repair has REPAIR_DEADLINE to
+finish, so a peer that hangs can't stop the ones after it, and its writes carry our epoch so a coordinator that has been
+replaced meanwhile is fenced off (and stops repairing) like for any other write.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from msg_utils import *
+from board import MARK
+from election import StaleEpoch
+from pipeline import wait_reply
+import article_codec
+import id_set
+
+REPAIR_RATE = 10 # Repairs started per second, at most
+REPAIR_BURST = 10
+MAX_PENDING = 64 # Stale replicas waiting for a repair, more are dropped (the next read reschedules them)
+REPAIR_DEADLINE = 5 # Seconds one repair (its id set read and writes) may take
+
+
+class ReadRepair:
+    def __init__(self, replica, rate=REPAIR_RATE, burst=REPAIR_BURST, max_pending=MAX_PENDING, timeout=REPAIR_DEADLINE):
+        self.replica = replica
+        self.rate = rate
+        self.burst = burst
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._pending = OrderedDict() # address -> freshest board seen for it
+        self._cond = threading.Condition()
+        self._worker = None
+
+    # Non-blocking, called on the read path. Returns False if the repair was dropped.
+    def schedule(self, address, board):
+        address = tuple(address)
+        with self._cond:
+            if address not in self._pending and len(self._pending) >= self.max_pending:
+                return False
+            self._pending[address] = board # A newer board replaces one that is still waiting
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return True
+
+    def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                address, board = self._pending.popitem(last=False)
+            if not self.replica.coordinator_flag: # Repairs are the coordinator's writes, a deposed one drops them
+                continue
+            self._take_token()
+            try:
+                self.repair(address, board)
+            except (OSError, ValueError, DeadlineExceeded, StaleEpoch) as e:
+                print(f'[!] Read repair of {address} failed: {e!r}')
+
+    # Pushes the articles of `board` that the replica at `address` doesn't have
+    def repair(self, address, board):
+        replica = self.replica
+        deadline = deadline_in(self.timeout)
+        held = id_set.decode(bytes(replica.pool.request(address, Frame(REQUEST_TYPE.r_IDS, deadline=deadline)))[MARK.size:])
+        board = {int(article_id): article for article_id, article in board.copy().items()}
+        missing = [board[i] for i in id_set.to_list(id_set.difference(id_set.of(board), held))]
+        if not missing:
+            return
+        print(f'Read repair: sending {len(missing)} articles to {address}')
+        epoch = replica.election.epoch
+        if replica.board_flags(address, deadline) & FLAG_BINARY:
+            writes = [Frame(REQUEST_TYPE.r_WRITE, article_codec.encode_articles(missing), flags=FLAG_BINARY, deadline=deadline, epoch=epoch)]
+        else: # JSON writes carry one article each
+            writes = [Frame(REQUEST_TYPE.r_WRITE, json.dumps(a).encode('utf-8'), deadline=deadline, epoch=epoch) for a in missing]
+        for frame, reply in [(frame, replica.pool.submit(address, frame)) for frame in writes]:
+            replica.election.check(wait_reply(reply, frame))
@@ -0,0 +1,53 @@
+"""
+Broadcast over a k-ary relay tree, so the coordinator's own fan-out stays at k however many replicas there are.
+
+The coordinator splits the targets into k contiguous subtrees and sends the first replica of each an r_RELAY holding
+the frame and the rest of its subtree. A relay handles the frame itself, does the same with what is left of its
+subtree, and answers with the replicas below it that didn't get the frame, and what those that handled it answered
+when it wasn't ACK (a STALE, say). A broadcast takes about log_k(N) hops, and the coordinator still learns per replica
+whether it was delivered and accepted. A relay that can't reach a subtree's first replica marks it failed and hands the
+subtree to the next one instead.
+
+r_RELAY body: [4 byte header length][{"targets": [[host, port], ...], "fanout": k} as JSON][the relayed frame, v0 wire format]
+Reply: {"failed": [[host, port], ...], "refused": [[[host, port], reply as latin-1], ...]} as JSON
+"""
+
+import json
+from struct import Struct
+
+from msg_utils import Frame
+
+HEADER = Struct('>I')
+
+
+class Refused(Exception):
+    '''A replica handled a relayed (or multicast) frame but didn't answer ACK, `reply` is what it answered'''
+    def __init__(self, address, reply):
+        super().__init__(f'{address} answered {bytes(reply[:80])!r}')
+        self.reply = reply
+
+# Up to `fanout` contiguous subtrees of about the same size
+def split(targets, fanout):
+    size = -(-len(targets) // max(1, fanout))
+    return [targets[i:i + size] for i in range(0, len(targets), size)] if targets else []
+
+def encode_relay(frame, subtree, fanout):
+    header = json.dumps({'targets': [list(t) for t in subtree], 'fanout': fanout}).encode('utf-8')
+    return HEADER.pack(len(header)) + header + frame.encode()
+
+# (frame, subtree, fanout) from an r_RELAY body
+def decode_relay(body):
+    body = memoryview(body)
+    length, = HEADER.unpack_from(body)
+    header = json.loads(str(body[HEADER.size:HEADER.size + length], 'utf-8'))
+    return Frame.decode(body[HEADER.size + length:]), [tuple(t) for t in header['targets']], header['fanout']
+
+# `refused` is {address: reply}, latin-1 carries any reply bytes through the JSON unchanged
+def encode_failed(failed, refused=None):
+    refused = [[list(address), str(reply, 'latin-1')] for address, reply in (refused or {}).items()]
+    return json.dumps({'failed': [list(address) for address in failed], 'refused': refused}).encode('utf-8')
+
+# (failed, {address: reply}) from an r_RELAY reply
+def decode_failed(reply):
+    reply = json.loads(str(reply, 'utf-8'))
+    return [tuple(address) for address in reply['failed']], {tuple(address): r.encode('latin-1') for address, r in reply.get('refused', [])}
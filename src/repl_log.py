@@ -0,0 +1,150 @@
+"""
+Replicated append-only log for sequential mode.
+
+The coordinator appends every write, its own POSTs and the ones other replicas number from their id leases (r_APPEND),
+to an offset-addressed in-memory log, which puts all writes in a single order. Every other replica tails it over one
+persistent connection: it sends an r_TAIL with the [8 byte log id][8 byte offset] of the next entry it needs, and from
+then on the coordinator streams v0 replies of [8 byte log id][8 byte next offset][articles] on that connection as
+entries are appended, up to TAIL_BATCH entries each, which the follower applies in one go. An idle stream sends an
+empty batch every TAIL_IDLE seconds so both ends notice a dead connection.
+
+A follower asking for an offset the log no longer holds, or for another coordinator's log, gets the coordinator's whole
+board once and carries on from the end of the log.
+
+After applying a batch the follower confirms it on the same stream, with an r_TAIL of the [log id][next offset] it has
+now. The coordinator ACKs its own POSTs only once some follower confirmed them (or fails them with DEADLINE_EXCEEDED
+after CONFIRM_TIMEOUT or the client's deadline), so an acknowledged post is on at least two replicas and the new
+coordinator's sync finds it after a failover. Posts numbered from a follower's id lease are on that follower already.
+"""
+
+import random
+import select
+import socket
+import threading
+import time
+from struct import Struct
+
+from msg_utils import *
+
+LOG_SIZE = 65536 # Entries kept, followers further behind get the board instead
+TAIL_BATCH = 256 # Entries per streamed reply, at most
+TAIL_IDLE = 5 # Seconds between heartbeats on an idle stream
+TAIL_RETRY = 1 # Seconds before a follower reconnects
+TAIL_POLL = 0.1 # Seconds between checks for a new coordinator while the stream is quiet
+CONFIRM_TIMEOUT = 3 # Seconds a POST waits for a follower to confirm it, unless the client's deadline is sooner
+
+POSITION = Struct('>QQ') # log id, offset
+
+
+class ReplicationLog:
+    def __init__(self, size=LOG_SIZE):
+        self.id = random.getrandbits(63)
+        self.size = size
+        self.start = 0 # Offset of entries[0]
+        self.entries = []
+        self.confirmed = 0 # Offset some follower confirmed it has everything before
+        self._cond = threading.Condition()
+        self._listeners = set() # Called on every append, from the appending thread
+
+    @property
+    def end(self):
+        return self.start + len(self.entries)
+
+    # Appends articles in order, returns the offset after them
+    def append(self, articles):
+        with self._cond:
+            self.entries.extend(articles)
+            if len(self.entries) > 2 * self.size: # Trimmed in bulk, not on every append
+                drop = len(self.entries) - self.size
+                del self.entries[:drop]
+                self.start += drop
+            self._cond.notify_all()
+            end = self.end
+        for listener in list(self._listeners):
+            listener()
+        return end
+
+    def listen(self, callback):
+        self._listeners.add(callback)
+
+    def unlisten(self, callback):
+        self._listeners.discard(callback)
+
+    # Blocks until there are entries at or past `offset`, or `timeout` runs out. True if there are.
+    def wait(self, offset, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.end > offset, timeout)
+
+    # A follower has everything in log `log_id` before `offset`
+    def confirm(self, log_id, offset):
+        with self._cond:
+            if log_id == self.id and offset > self.confirmed:
+                self.confirmed = offset
+                self._cond.notify_all()
+
+    # Blocks until some follower confirmed everything before `offset`, or `timeout` runs out. True if one did.
+    def wait_confirmed(self, offset, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.confirmed >= offset, timeout)
+
+    # What a follower at (log_id, offset) gets next: (next offset, {id: article}). A follower that isn't on this log, or
+    # is further behind than it reaches, gets `board` instead and carries on from the end.
+    def batch(self, log_id, offset, board, limit=TAIL_BATCH):
+        with self._cond:
+            if log_id != self.id or not self.start <= offset <= self.end:
+                # Articles are put on the board before they are appended, so the copy holds everything up to the end
+                return self.end, board.copy()
+            entries = self.entries[offset - self.start:offset - self.start + limit]
+            return offset + len(entries), {int(article['id']): article for article in entries}
+
+
+class LogTailer:
+    '''Follows the coordinator's log while we aren't the coordinator'''
+    def __init__(self, replica):
+        self.replica = replica
+        self.log_id = 0 # Unknown, the first batch is the coordinator's board
+        self.offset = 0
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        replica = self.replica
+        while True:
+            if not replica.coordinator_flag:
+                coordinator = replica.connections[replica.coordinator_index]
+                try:
+                    self.tail(coordinator)
+                    continue # Someone else is coordinator now, follow them right away
+                except (OSError, ValueError) as e:
+                    print(f'Log tail from {coordinator} broke off: {e}')
+            time.sleep(TAIL_RETRY)
+
+    # Applies the coordinator's log as it streams in, until it fails or someone else becomes coordinator
+    def tail(self, address):
+        replica = self.replica
+        flags = replica.board_flags(address) & FLAG_BINARY
+        with socket.create_connection(address, timeout=3 * TAIL_IDLE) as sock:
+            Frame(REQUEST_TYPE.r_TAIL, POSITION.pack(self.log_id, self.offset), flags=flags).send(sock)
+            heard = time.monotonic()
+            while tuple(replica.connections[replica.coordinator_index]) == tuple(address):
+                # Wait for the next batch a little at a time, so a new coordinator is followed right away even when this
+                # one hangs instead of closing the stream
+                if not select.select([sock], [], [], TAIL_POLL)[0]:
+                    if time.monotonic() - heard > 3 * TAIL_IDLE:
+                        raise socket.timeout(f'Nothing from coordinator {address} for {3 * TAIL_IDLE} seconds.')
+                    continue
+                heard = time.monotonic()
+                reply = read(sock)
+                if not reply:
+                    raise ConnectionError(f'Coordinator {address} closed the log stream.')
+                reply = bytes(reply)
+                log_id, offset = POSITION.unpack_from(reply)
+                articles = replica.decode_board(reply[POSITION.size:], flags)
+                replica.data.update(articles)
+                self.log_id, self.offset = log_id, offset
+                if articles: # The coordinator ACKs its posts once a follower has them
+                    Frame(REQUEST_TYPE.r_TAIL, POSITION.pack(log_id, offset)).send(sock)
@@ -1,12 +1,30 @@
 import jsonschema.exceptions
 from msg_utils import *
-from core import send_chunked, recvall
+from conn_pool import PeerPool, DEFAULT_POOL_SIZE
+from pipeline import wait_reply
+from multicast import MulticastSender, MulticastReceiver, DeliveryChannel, wait_body
+import relay
+from read_repair import ReadRepair
+from hints import HintedHandoff
+from board import VersionedBoard, SyncMarks, MARK
+from fanout import FanOut, Outcome, successes, failures, all_expired, split_deadline
+from group_commit import GroupCommit
+from repl_log import ReplicationLog, LogTailer, POSITION, TAIL_IDLE, CONFIRM_TIMEOUT
+from failure_detector import HeartbeatMonitor
+from election import Election, StaleEpoch
+from read_lease import ReadLease
+from worker_pool import WorkerPool, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+import article_codec
+import id_set
+from id_lease import IdLease, ID_BLOCK, LEASE_SIZE, COUNT, RANGE, decode_range
+from aio import AsyncEngine
 import random
 import jsonschema
 import socket, threading
 import sys
 
 TEST_CONNECTION_LIST = [('127.0.0.1', 5001), ('127.0.0.1', 5002), ('127.0.0.1', 5003)]
+TEST_MULTICAST_GROUP = ('239.255.77.1', 5007)
 
 JSON_SCHEMA = {
   "$schema": "http://json-schema.org/draft-04/schema#",
@@ -50,15 +68,55 @@ def validate_payload_schema(msg_payload):
 
 
 class Replica:
-    def __init__(self, replica_id, connections, mode='sequential'):
+    def __init__(self, replica_id, connections, mode='sequential', pool_size=DEFAULT_POOL_SIZE, compress_threshold=COMPRESS_THRESHOLD, engine='threaded', workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH, multicast=None, write_quorum=None, relay_fanout=None):
         self.replica_id = int(replica_id)
         self.connections = connections      #list of (addr, port) tuples for all replicas
         self.consistency_mode = mode        #string that describes mode
         self._coordinator_index = 0
-        self._backup_index = (self.coordinator_index + 1) % len(connections)
-        self.data = {}                      #dict to hold all post data, metadata, etc.
+        self.election = Election(self)      #epoch, membership table and votes (see election.py)
+        self._data = VersionedBoard()       #dict to hold all post data, metadata, etc. (see board.py)
         self.article_id = 0
+        self._id_ceiling = 0                #ids up to here are recorded with the backup (see id_lease.py)
+        self.id_lease = IdLease()           #ids leased from the coordinator for sequential posts here
+        self._lease_lock = threading.Lock()
         self.mode = mode
+        self._id_lock = threading.Lock()
+        self._peer_features = {}            #address -> features negotiated with that peer
+        self.compress_threshold = compress_threshold #payloads at least this big get compressed for peers/clients that negotiated zlib
+        self.pool = PeerPool(max_size=pool_size) # long lived sockets to every peer, max pool_size per peer
+        self.fanout = FanOut()              # concurrent requests to many peers at once (SYNC, quorum reads)
+        if engine not in ('threaded', 'asyncio'):
+            raise ValueError(f"engine must be 'threaded' or 'asyncio', not {engine!r}")
+        self.engine = engine                #'threaded' (a thread per connection) or 'asyncio' (see aio.py)
+        self.workers = workers              #threads handling requests for the threaded engine
+        self.queue_depth = queue_depth      #client requests allowed to wait before we start replying BUSY
+        self.multicast = multicast          #(group, port) to broadcast to replicas over UDP multicast, None for TCP only (see multicast.py)
+        self.mcast_sender = None
+        self.mcast_receiver = None
+        self.relay_fanout = relay_fanout    #k, to broadcast down a k-ary relay tree instead of to every replica ourselves (see relay.py)
+        self.write_quorum = write_quorum    #W, replicas that must confirm a quorum POST before the client gets its ACK (None for a majority)
+        self.read_repair = ReadRepair(self) #pushes missing articles to replicas a quorum read found stale, in the background
+        self.hints = HintedHandoff(self)    #writes for unreachable replicas, handed over once they're back
+        self.sync_marks = SyncMarks()       #how far each peer's board has been read and written by our SYNCs
+        self.group_commit = GroupCommit(self.commit_posts) #batches concurrent POSTs while we're the coordinator
+        self.log = ReplicationLog()         #sequential mode: every write in order, while we're the coordinator (see repl_log.py)
+        self.tailer = LogTailer(self)       #sequential mode: applies the coordinator's log while we aren't
+        self.monitor = HeartbeatMonitor(self) #heartbeats the coordinator and elects a new one once it's suspected (see failure_detector.py)
+        self.read_lease = ReadLease(self)   #quorum mode: lets the coordinator answer reads from its own board (see read_lease.py)
+
+    #The board, assigning to it replaces its contents so every change keeps its version stamp
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data.replace(data)
+
+    #True if SYNC writes and leader changes go out as one broadcast (multicast or a relay tree) rather than to each replica
+    @property
+    def broadcasting(self):
+        return self.mcast_sender is not None or bool(self.relay_fanout)
 
     #Sets coordinator flag
     @property
@@ -73,33 +131,36 @@ class Replica:
     @coordinator_index.setter
     def coordinator_index(self, ind):
         self._coordinator_index = ind
-        self._backup_index = (self.coordinator_index + 1) % len(self.connections)
+
+    #The first live replica after the coordinator, which keeps the id ceiling and is the first to take over
+    @property
+    def backup_index(self):
+        return next(iter(self.election.members.successors(self.coordinator_index)), self.coordinator_index)
     
     # Forward messages and wait to recevie ack
     def forward_to_coordinator(self, message):
-        coord_host, coord_port = self.connections[self.coordinator_index]
+        coordinator, coord_address, frame = self.coordinator_request(message)
 
-        coord_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)        
-        coord_socket.settimeout(10) # Need the timeout in order to trigger the leader election
-        
-        # Try/Except around connection to catch 
+        # The heartbeat monitor normally replaces a dead coordinator before any request gets here, this catches the
+        # ones sent in the moment before it noticed. Forwards carry our epoch, a deposed coordinator answers STALE.
         try:
-            coord_socket.connect((coord_host, coord_port))
-        except socket.timeout:
+            return self.election.check(self.pool.request(coord_address, frame))
+        except StaleEpoch as e:
+            print(f'[NOTICE!] {coord_address} IS NO LONGER COORDINATOR: {e}')
+        except OSError:
             print('[NOTICE!] COORDINATOR HAS DIED. ELECTING NEW COORDINATOR...')
-            # Initiate leader election
-            self.execute_leader_election()
+            self.pool.discard(coord_address)
+            # Initiate leader election (a no-op if the monitor got there first)
+            self.execute_leader_election(coordinator)
         
         # Now proceed with our new coordinator!!! :)
-        coord_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)        
-        coord_socket.connect((coord_host, coord_port))
-        coord_socket.settimeout(None) # Need the timeout in order to trigger the leader election
-        coord_socket.sendall(message)
-        
-        return_message = read(coord_socket)
+        _, coord_address, frame = self.coordinator_request(message)
+        return self.pool.request(coord_address, frame)
 
-        length = pack(">Q", len(return_message))
-        return length+return_message
+    # The coordinator's index and address, and `message` stamped with our epoch for it
+    def coordinator_request(self, message):
+        coordinator = self.coordinator_index
+        return coordinator, self.connections[coordinator], message.retag(message.request, self.election.epoch)
     
     # Forward message and don't wait to receive ack
     def send_to_coordinator(self, message):
@@ -113,168 +174,242 @@ class Replica:
     def process_requests(self, conn, addr):
         # try:
         
-        req_enum_bytes = conn.recv(8)
-        if req_enum_bytes == b'':
-            conn.close()
-            return
-        req_enum, = unpack('>Q', req_enum_bytes)
-        req_enum = int(req_enum)
-        nbytes_msg = conn.recv(8)
-        if nbytes_msg != b'': # Case for a disconnecting Client socket
-            msglen, = unpack('>Q', nbytes_msg)
-  
-        message = recvall(conn, int(msglen))
-
-        length = pack('>Q', len(message))
-        request_type = pack('>Q', int(req_enum))
+        # Connections are persistent (peers pool them), so keep handling frames until the other side hangs up
+        write_lock = threading.Lock()
+        while True:
+            try:
+                frame = Frame.recv(conn)
+            except (ConnectionError, ValueError):
+                frame = None
+            if frame is None: # Case for a disconnecting Client socket
+                break
+            channel = ReplyChannel(conn, frame, write_lock, self.compress_threshold)
+            if frame.request == REQUEST_TYPE.r_TAIL: # The stream keeps this connection (and thread) for good
+                threading.Thread(target=self.read_confirmations, args=(conn,), daemon=True).start()
+                self.execute_tail(channel, frame)
+                break
+            if frame.request == REQUEST_TYPE.r_HEARTBEAT: # Answered right away, a busy worker pool isn't a dead replica
+                self.dispatch(channel, frame)
+                continue
+            if frame.request == REQUEST_TYPE.r_HELLO: # Clients and peers both send it, and it only reads local state
+                self.dispatch(channel, frame)
+                continue
+            done = self.worker_pool.submit(frame.request, self.dispatch, channel, frame)
+            if done is None:
+                print(f'Queue full, rejecting {frame.request} from {addr}')
+                send_reply(channel, BUSY)
+            elif frame.version == PROTOCOL_V0:
+                # v0 replies have no request id, so wait for this one before reading the next request. If not even an
+                # error reply could be sent, hang up rather than leave the client waiting.
+                if done.exception() is not None:
+                    break
+            # Pipelined requests run concurrently and reply out of order, tagged with their request id
+        conn.close()
 
-        packed_message = bytearray(request_type+length+message)
+    # Drops requests whose sender has already given up, and turns a deadline running out mid request into a reply
+    def dispatch(self, conn, frame):
+        if frame.expired():
+            print(f'Dropping expired {frame}')
+            send_reply(conn, DEADLINE_EXCEEDED)
+            return
+        if self.election.fenced(frame): # Sent by or for a coordinator that has been replaced since
+            print(f'Fencing off {frame} from epoch {frame.epoch}')
+            send_reply(conn, self.election.stale_reply())
+            return
+        try:
+            self.handle(conn, frame)
+        except DeadlineExceeded as e:
+            print(f'[!] {e}')
+            send_reply(conn, DEADLINE_EXCEEDED)
+        except StaleEpoch as e: # We were deposed part way through, the sender tries the new coordinator
+            print(f'[!] {e}')
+            send_reply(conn, self.election.stale_reply())
+        except Exception as e: # Still answered, or the sender would wait for a reply forever
+            print(f'[!] Error handling {frame}: {e!r}')
+            if not conn.replied:
+                send_reply(conn, error_reply(e))
+
+    def handle(self, conn, frame):
+        req_enum = frame.request
 
         # if not req_enum:
         #     break
         if req_enum == int(REQUEST_TYPE.POST):
-            self.execute_post(conn, packed_message)
+            self.execute_post(conn, frame)
         elif req_enum == int(REQUEST_TYPE.READ):
-            self.execute_read(conn, packed_message)
+            self.execute_read(conn, frame)
         # elif req_enum == int(REQUEST_TYPE.CHOOSE):
-        #     self.execute_choose(conn, packed_message)
+        #     self.execute_choose(conn, frame)
         # elif req_enum == int(REQUEST_TYPE.REPLY):
-        #     self.execute_reply(conn, packed_message)
+        #     self.execute_reply(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_WRITE):
-            self.execute_write(conn, packed_message)
+            self.execute_write(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_READ):
-            self.execute_read_data(conn)
+            self.execute_read_data(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_GET_ID):
-            self.execute_get_id(conn)
+            self.execute_get_id(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_BACKUPDATE):
-            self.execute_backup_state_update(conn, packed_message)
+            self.execute_backup_state_update(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_SYNC):
-            self.execute_sync(conn, packed_message)
+            self.execute_sync(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_NOMINATE):
             # This means we are the new Leader (Coordinator)
-            self.execute_nominate(conn)
+            self.execute_nominate(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_VOTE):
+            self.execute_vote(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_LEASE):
+            self.execute_lease(conn, frame)
         elif req_enum == int(REQUEST_TYPE.r_NEWLEADER):
             # This means we need to update our internal record of coordinator and backup
-            self.execute_new_leader(conn)
+            self.execute_new_leader(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_HEARTBEAT):
+            self.execute_heartbeat(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_HELLO):
+            self.execute_hello(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_DIGEST):
+            self.execute_digest(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_IDS):
+            self.execute_ids(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_FETCH):
+            self.execute_fetch(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_APPEND):
+            self.execute_append(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_RELAY):
+            self.execute_relay(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_MCAST_WAIT):
+            self.execute_multicast_wait(conn, frame)
+        elif req_enum == int(REQUEST_TYPE.r_NACK):
+            self.execute_nack(conn, frame)
         else:
             print('unindentified req_enum type')
-        conn.close()
+            send_reply(conn, b'UNSUPPORTED') # Don't leave the sender blocked waiting on a reply
         # except Exception as e:
         #     print(e)
 
         #     conn.close()
 
-    def execute_leader_election(self):
-        # This is only run on connection timeout during forward of message to coordinator
-        message = pack('>Q', int(REQUEST_TYPE.r_NOMINATE)) + pack('>Q', 0)
-
-        # Send r_Nominate to backup
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(self.connections[self._backup_index])
-            s.sendall(message)
-
-            # Block until ack received!
-            ack = read(s)
-    
-    def execute_nominate(self, conn):        
-        # First check if we already set ourselves as the coordinator (which means we can skip notifying everyone)
-        if not self.coordinator_flag:
-            # Update coordinator and backup fields
-            self.connections.pop(self.coordinator_index) # Blacklists the former coordinator
-            self.coordinator_index = self._backup_index # Sets both indices properly
-
-            # Then send everyone a 'r_NEWLEADER' message, except the last coordinator, and backup (self)
-            filtered = self.connections[self._backup_index+1:self.coordinator_index] if (self._backup_index < self.coordinator_index) else self.connections[:self.coordinator_index]+self.connections[self._backup_index+1:]
-
-            # Loop over filtered connection list, send notification of new leader, block and wait for an ack from each!!!
-            request_type = pack('>Q', int(REQUEST_TYPE.r_READ))
-            message = request_type+pack('>Q', 0) # Requires an 8 byte length to be handled properly
+    # Replaces the coordinator at index `suspected`, unless that already happened (see election.py)
+    def execute_leader_election(self, suspected=None, since=None):
+        self.election.replace(self.coordinator_index if suspected is None else suspected, since)
 
-            for c in filtered:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect(c)
-                    s.sendall(message)
-                    ack = read(s) # Don't need to anything with the ACK, just need to know that it was handled by the target
+    # We're asked to take over, the reply is our election state once we tried
+    def execute_nominate(self, conn, message):
+        send_reply(conn, json.dumps(self.election.nominate(message.json())).encode('utf-8'))
 
-        # Otherwise....
-        # Finally, send the replica who nominated you an ACK so they can forward their working message to you
-        conn.sendall(pack('>Q', 3)+b'ACK')
+    def execute_vote(self, conn, message):
+        send_reply(conn, json.dumps(self.election.vote(message.json())).encode('utf-8'))
 
-    def execute_new_leader(self, conn):
-        # Blacklist the last coordinator (pop? or mask?)
-        self.connections.pop(self.coordinator_index) # Old coordinator index used to pop that address from connections
+    def execute_lease(self, conn, message):
+        send_reply(conn, json.dumps(self.read_lease.grant(message.json())).encode('utf-8'))
 
-        # Update internal record 
-        self.coordinator_index = self._backup_index # updates everything accordingly (in the future could pack the new id in here to avoid assumption of backup being coordinator index + 1)
+    def execute_new_leader(self, conn, message):
+        # Update internal record, unless we already know of a newer epoch
+        self.election.adopt(message.json())
 
         # Send ACK to new leader (coordinator)
-        conn.sendall(pack('>Q', 3)+b'ACK')
+        send_reply(conn, b'ACK')
 
     def execute_sync(self, conn, message):
         if self.replica_id != self.coordinator_index:
             #Forward this to the coordinator
             return_message = self.forward_to_coordinator(message)
             print("Returned ACK: ", return_message)
-            conn.sendall(return_message)
+            send_reply(conn, return_message)
         else:
             self.execute_sync_coordinator(conn, message)
     
     def execute_sync_coordinator(self, conn, message):
         print("Executing sync as coordinator")
-        request_type = pack('>Q', int(REQUEST_TYPE.r_READ))
-        message[:8] = request_type
-
-        merged_data = {}
-        for c in self.connections:            
-            target_host, target_port = c
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((target_host, target_port))
-                s.sendall(message)
-                data = json.loads(read(s).decode('utf-8'))
-                if data:
-                    data = {int(key):value for key,value in data.items()}
-                    merged_data.update(data)
-                print("Received Data from Read Request")
-        
-        if merged_data:
-            print(f'{merged_data=}')
-            self.data = merged_data
-            req_enum = pack('>Q', int(REQUEST_TYPE.r_WRITE))
-            payload = json.dumps(self.data).encode('utf-8')
-            length = pack('>Q', len(payload))
-            for c in self.connections:            
-                target_host, target_port = c
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((target_host, target_port))
-                    s.sendall(req_enum+length+payload)
-                    ack = read(s)
-                    print(f"Received {ack} from Write Request")
-
-        conn.sendall(pack('>Q', 3)+b'ACK')
+        self.sync_replicas(message.deadline)
+        send_reply(conn, b'ACK')
         # conn.sendall(pack('>Q', len(b'Consider yourself sunk'))+b'Consider yourself sunk')
 
+    # Brings every reachable replica (and us) up to the union of all boards
+    def sync_replicas(self, deadline=None):
+        # Read what every replica changed since the last sync at once. Replicas that fail or miss the deadline are left
+        # out rather than failing the sync. The reads only get half the deadline, the writes need the rest
+        read_deadline = split_deadline(deadline)
+        reads = self.fanout.gather(self.connections, lambda c: self.fetch_changes(c, read_deadline), read_deadline)
+        haves, fetches = self.merge_sync(reads)
+        if fetches:
+            fetch_deadline = split_deadline(deadline)
+            self.merge_fetches(haves, self.fanout.gather(list(fetches), lambda c: self.fetch_articles(c, fetches[c], fetch_deadline), fetch_deadline))
+        else:
+            self.merge_fetches(haves, [])
+        print("Merged Data from Read Requests")
+
+        # Then send every replica what it hasn't been sent yet
+        version = self.data.version
+        reachable = [o.address for o in reads if o.ok]
+        if self.broadcasting:
+            writes = self.broadcast_sync_write(reachable, deadline)
+        else:
+            frames = self.sync_write_frames(reachable, {c: self.peer_features(c) for c in reachable}, haves, deadline)
+            def write_board(c):
+                if frames[c] is None: # Nothing new for it
+                    return b'ACK'
+                return self.election.check(wait_reply(self.pool.submit(c, frames[c]), frames[c]))
+            writes = self.fanout.gather(reachable, write_board, deadline)
+        return self.finish_sync(reachable, writes, version)
+
+    # Every replica runs this code, so one binary (compressed if big) delta covering the replica furthest behind goes
+    # to all of them at once
+    def broadcast_sync_write(self, reachable, deadline=None):
+        write = self.sync_write(FLAG_BINARY | FLAG_ACCEPT_COMPRESSED, min(self.sync_marks.write_mark(c) for c in reachable), deadline) if reachable else None
+        return self.broadcast(write, reachable) if write is not None else [Outcome(c, b'ACK', None) for c in reachable]
+
+    # Merges what the sync reads brought back. Returns (haves, fetches), see merge_sync_reads and plan_fetches.
+    def merge_sync(self, reads):
+        if all_expired(reads):
+            raise DeadlineExceeded('No replica answered the sync reads before the deadline.')
+        # Unreachable replicas get the merged board by hinted handoff once they're back, so they don't fail the sync
+        for failure in failures(reads):
+            self.hints.add(failure.address)
+        haves = self.merge_sync_reads(reads)
+        # Replicas we had never read only sent their id sets, pull just the articles nobody else gave us from them
+        return haves, self.plan_fetches(haves)
+
+    # After the sync writes of our board at `version`, returns the replicas that were read
+    def finish_sync(self, reachable, writes, version):
+        if not self.coordinator_flag: # A replica fenced our writes off, we're not coordinator anymore
+            raise StaleEpoch(f'Deposed during a sync, replica {self.coordinator_index} is coordinator now.')
+        for ack in successes(writes):
+            print(f"Received {bytes(ack)} from Write Request")
+        for failure in failures(writes):
+            self.hints.add(failure.address)
+        for ack in writes: # Up to date with our board as it was before the writes
+            if ack.ok:
+                self.sync_marks.set_write(ack.address, version)
+        return reachable
+
     def execute_backup_state_update(self, conn, message):
         # unpack the id
-        self.article_id = int.from_bytes(bytes(message[16:]))
+        self.article_id, = unpack('>Q', message.body)
+        send_reply(conn, b'ACK')
 
-    def execute_get_id(self, conn):
-        new_id = pack('>Q', self.get_article_id())
-        length = pack('>Q', len(new_id))
-        conn.sendall(length+new_id)
+    def execute_get_id(self, conn, message):
+        if message.body: # A lease of several ids
+            count = max(1, min(COUNT.unpack(message.body)[0], ID_BLOCK))
+            send_reply(conn, RANGE.pack(self.get_article_ids(count), count))
+        else:
+            send_reply(conn, pack('>Q', self.get_article_id()))
         
     def execute_read(self, conn, message):
         if self.replica_id != self.coordinator_index:
             #Forward this to the coordinator
             if self.mode == 'sequential':
-                payload = json.dumps(self.data).encode('utf-8')
-                length = pack('>Q', len(payload))
-                return_message = length+payload
+                return_message = self.encode_board(self.data.copy(), message.flags)
             elif self.mode == 'quorum':
                 print("Forwarding read to coordinator")
                 return_message = self.forward_to_coordinator(message)
             elif self.mode == 'read_your_write':
-                return_message = self.forward_to_coordinator(message=message)
-            conn.sendall(return_message)
+                token = session_token(message.body)
+                if token is None:
+                    return_message = self.forward_to_coordinator(message=message)
+                else: # Served here once we've seen the session's writes
+                    self.catch_up(token, message.deadline)
+                    return_message = self.encode_board(self.data.copy(), message.flags)
+            send_reply(conn, return_message)
         else:
             self.execute_read_coordinator(conn, message)
     
@@ -292,55 +427,62 @@ class Replica:
     def execute_read_sequential(self, conn, message):
         print("Hey, its me, coordinator, I'm reading Sequentially again...")
         # Send it all
-        print(self.data)
-        payload = json.dumps(self.data).encode('utf-8')
-        length = pack('>Q', len(payload))
-        conn.sendall(length+payload)
+        board = self.data.copy()
+        print(board)
+        send_reply(conn, self.encode_board(board, message.flags))
 
     def execute_read_quorum(self, conn, message):
         print("Hey, its me, coordinator, I'm reading again...")
-        # read_replicas = random.sample(range(0,len(self.connections)), len(self.connections)//2 + 1)
-        read_replicas = random.sample(range(0,len(self.connections)), len(self.connections)// 1)
+        if self.read_lease.held(): # No one else can have been elected or had a write acknowledged, our board is the read
+            send_reply(conn, self.encode_board(self.data.copy(), message.flags))
+            return
+        # Only digests from the sampled replicas, then the full board from the freshest one alone
+        digests = self.fanout.gather(self.quorum_read_targets(), lambda c: self.fetch_digest(c, message.deadline), message.deadline)
+        for candidate in self.read_candidates(digests):
+            payload = self.held_board(candidate)
+            if payload is None:
+                try:
+                    payload = self.fetch_board(candidate.address, message.deadline)
+                except (OSError, ValueError) as e: # Try the next freshest
+                    print(f"[!] Read from {candidate.address} failed: {e}")
+                    continue
+            send_reply(conn, self.encode_board(payload, message.flags))
+            self.repair_stale(digests, candidate, payload)
+            return
 
-        request_type = pack('>Q', int(REQUEST_TYPE.r_READ))
-        message[:8] = request_type
+        send_reply(conn, b"Nuthin")
 
+    # Replicas a quorum read asks for their digest
+    def quorum_read_targets(self):
+        # read_replicas = random.sample(range(0,len(self.connections)), len(self.connections)//2 + 1)
+        read_replicas = random.sample(range(0,len(self.connections)), len(self.connections)// 1)
+        read_replicas = [r for r in read_replicas if r not in self.election.members.down] # Don't wait on replicas an election found down
         print(read_replicas)
-        data_list = []
-        for replica in read_replicas:
-            
-            target_host, target_port = self.connections[replica]
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((target_host, target_port))
-                s.sendall(message)
-                data = json.loads(read(s).decode('utf-8'))
-                
-                if data:
-                    data = {int(key):value for key,value in data.items()}
-
-                    data_list.append(data)
-                    
-                print("Received Data from Read Request")
-        
-        if data_list:
-            print(f"Data List: {data_list}")
-            max_list = [max(list(d.keys())) for d in data_list]
-            print(f"Max List: {max_list}")
-            payload = data_list[max_list.index(max(max_list))]
-            payload = json.dumps(payload).encode('utf-8')
-            print(f"Payload after dumps: {payload}")
-            length = pack('>Q', len(payload))
-            
-            conn.sendall(length+payload)
-
-        else:
-            length = pack('>Q', len(b"Nuthin"))
-            conn.sendall(length + b"Nuthin")
+        return [self.connections[replica] for replica in read_replicas]
+
+    # The digests that came back, freshest first
+    def read_candidates(self, digests):
+        if all_expired(digests):
+            raise DeadlineExceeded('No replica answered the quorum read before the deadline.')
+        for failure in failures(digests):
+            print(f"[!] Digest from {failure.address} failed: {failure.error!r}")
+        candidates = sorted((o for o in digests if o.ok and o.result[1]), key=lambda o: o.result[:2], reverse=True)
+        print(f"Digests: {[(o.address, o.result) for o in candidates]}")
+        return candidates
+
+    # A snapshot of our board if it is exactly the one `candidate`'s digest describes, None if it has to be fetched
+    def held_board(self, candidate):
+        board = self.data.copy()
+        return board if candidate.result == article_codec.board_digest(board) else None
+
+    # The client has its answer, now bring the replicas that don't match it up to date
+    def repair_stale(self, digests, chosen, board):
+        for o in digests:
+            if o.ok and o.result != chosen.result:
+                self.read_repair.schedule(o.address, board)
 
     def execute_read_read_your_write(self, conn, message):
-        payload = json.dumps(self.data).encode('utf-8')
-        length = pack('>Q', len(payload))
-        conn.sendall(length+payload)
+        send_reply(conn, self.encode_board(self.data.copy(), message.flags))
         
 
     def execute_post(self, conn, message):
@@ -349,96 +491,123 @@ class Replica:
             #Forward this to the coordinator
 
             if self.mode == 'sequential':
-                print("Requesting ID from coordinator")
-                req_enum = pack('>Q', int(REQUEST_TYPE.r_GET_ID))
-                length = pack('>Q', 0)
-                new_id = self.forward_to_coordinator(req_enum+length)
-
-                new_id = int.from_bytes(bytearray(new_id)[8:])
+                new_id = self.leased_article_id(message.deadline)
 
                 print(f'{new_id=}')
 
-                new_article = json.loads(message[16:].decode('utf-8'))
-                new_article['id'] = new_id
-                
-                self.data[new_id] = new_article
-
-                length = pack('>Q', len(b'ACK'))
-                return_message = length+b'ACK'  
+                # The coordinator's log puts it in order and streams it to everyone else
+                return_message = self.forward_to_coordinator(self.leased_post(message, new_id))
             elif self.mode == 'quorum':
                 print("Forwarding Post to coordinator")
                 return_message = self.forward_to_coordinator(message)
             elif self.mode == 'read_your_write':
                 return_message = self.forward_to_coordinator(message)
-            conn.sendall(return_message)
+            send_reply(conn, return_message)
         else:
             self.execute_post_coordinator(conn, message)
             
-    # Picks the post function based on mode
+    # POSTs wait for a batch to be committed together (see group_commit.py), every client gets the batch's reply
     def execute_post_coordinator(self, conn, message):
         print("Executing post as coordinator")
-
-        request_enum = message[:8]
-        
-        new_article = json.loads(message[16:].decode('utf-8'))
-        new_article['id'] = self.get_article_id()
-        payload = json.dumps(new_article).encode('utf-8')
-
-        length = pack('>Q', len(payload))
-
-        updated_message = request_enum+length+payload
-
+        send_reply(conn, self.group_commit.submit(self.decode_article(message), message.deadline))
+
+    # Picks the post function based on mode. Commits a whole batch of new articles, their ids are handed out in one step.
+    def commit_posts(self, articles, deadline=None):
+        epoch = self.election.epoch # The writes are fenced in the epoch the ids were handed out in, not a later one we adopt
+        board = self.number_posts(articles, self.get_article_ids(len(articles)))
+        if self.writes_to_quorum():
+            written = self.quorum_write(board, deadline, epoch)
+            if written != b'ACK': # Not applied here either, so no read (not even under a read lease) sees a failed write
+                return written
+        reply = self.apply_posts(board)
+        if self.mode == 'sequential':
+            self.await_followers(self.log.end, deadline)
+        return reply
+
+    # A sequential post on a follower, numbered from our lease: kept here, and the frame that appends it to the
+    # coordinator's log
+    def leased_post(self, message, new_id):
+        new_article = self.decode_article(message)
+        new_article['id'] = new_id
+        self.data[new_id] = new_article
+        return self.append_frame(new_article, message)
+
+    # {id: article} for a batch whose ids start at `first`
+    def number_posts(self, articles, first):
+        board = {}
+        for offset, article in enumerate(articles):
+            article['id'] = first + offset
+            board[article['id']] = article
+        return board
+
+    # True if a batch has to reach W replicas before we apply it and answer
+    def writes_to_quorum(self):
+        return self.mode in ('quorum', 'read_your_write')
+
+    # Applies a numbered batch here, returns the clients' reply
+    def apply_posts(self, board):
         if self.mode == 'sequential':
-            self.execute_post_sequential(conn, updated_message)
+            return self.post_sequential(board)
         elif self.mode == 'quorum':
-            self.execute_post_quorum(conn, updated_message)
+            return self.post_quorum(board)
         elif self.mode == 'read_your_write':
-            self.execute_post_read_your_write(conn, updated_message)
-        else:
-            print(f"Unknown mode type: {self.mode}")
-    
-    def execute_post_sequential(self, conn, message):
-        print("Hey, its me, coordinator, I'm posting Sequentially again...")
-        
-        new_article = json.loads(message[16:].decode('utf-8'))
-        new_article['id'] = self.article_id
-        
-        self.data[self.article_id] = new_article
+            return self.post_read_your_write(board)
+        print(f"Unknown mode type: {self.mode}")
+        return b'UNSUPPORTED'
 
-        length = pack('>Q', len(b'ACK'))
-        return_message = length+b'ACK' 
+    def post_sequential(self, board):
+        print("Hey, its me, coordinator, I'm posting Sequentially again...")
+        self.data.update(board)
+        self.log.append(board.values())
+        return b'ACK'
 
-        conn.sendall(return_message)
-    
-    def execute_post_quorum(self, conn, message):
+    def post_quorum(self, board):
         print("Hey, its me, coordinator, I'm posting again...")
-        # post_replicas = random.sample(range(0,len(self.connections)), len(self.connections)//2 + 1)
-        post_replicas = random.sample(range(0,len(self.connections)), 1)
-
-        request_type = pack('>Q', int(REQUEST_TYPE.r_WRITE))
-        message[:8] = request_type
-
-        print(post_replicas)
-        for replica in post_replicas:
-            
-            target_host, target_port = self.connections[replica]
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((target_host, target_port))
-                s.sendall(message)
-                action_message = s.recv(1000)
-                print("Received Ack from Write Request")
-                
-        conn.sendall(action_message)
-    
-    def execute_post_read_your_write(self, conn, message):
-        request_type = pack('>Q', int(REQUEST_TYPE.r_SYNC))
-        message[:8] = request_type
-        # Here is where the message is actually posted
-        new_article = json.loads(message[16:].decode('utf-8'))
-
-        self.data[self.article_id] = new_article
-
-        self.execute_sync(conn=conn, message=message)
+        self.data.update(board) # Only once W-1 other replicas have it, reads under a read lease are answered from it
+        return b'ACK'
+
+    def post_read_your_write(self, board):
+        # Here is where the messages are actually posted. The clients get a session token, and whichever replica they
+        # read from next pulls from us until it has caught up with it. The batch is on W replicas (W-1 others and us)
+        # before anyone gets a token, so it outlives us.
+        self.data.update(board)
+        return session_ack(self.data.incarnation, self.data.version)
+
+    # One merging r_WRITE of the whole batch goes to the other N-1 replicas at once. ACK as soon as W-1 of them
+    # confirmed, we are the W-th once the caller applies it here. The rest finish in the background.
+    def quorum_write(self, board, deadline=None, epoch=None):
+        frames = {}
+        def write(c):
+            try:
+                frame = self.batch_frame(frames, self.board_flags(c, deadline), board, deadline, epoch)
+                return self.election.check(wait_reply(self.pool.submit(c, frame), frame))
+            except (OSError, DeadlineExceeded): # Hinted handoff delivers it later, stragglers included
+                self.hints.add(c, list(board.values()))
+                raise
+        return self.quorum_write_reply(self.fanout.gather(self.write_targets(), write, deadline, need=self.write_quorum_size() - 1), board)
+
+    # Every replica but us
+    def write_targets(self):
+        return [c for i, c in enumerate(self.connections) if i != self.replica_id]
+
+    # The r_WRITE of a batch in the format `flags`, encoded once per format into `frames`
+    def batch_frame(self, frames, flags, board, deadline=None, epoch=None):
+        if flags not in frames:
+            frames[flags] = self.board_write(flags, board, deadline, epoch=epoch)
+        return frames[flags]
+
+    # What a W-of-N write of `board` comes to, once `writes` are gathered
+    def quorum_write_reply(self, writes, board):
+        need = self.write_quorum_size() - 1
+        if not self.coordinator_flag: # A replica fenced our write off, the client retries with the new coordinator
+            raise StaleEpoch(f'Deposed during a write, replica {self.coordinator_index} is coordinator now.')
+        acks = successes(writes)
+        print(f"Received {len(acks)} of {need} Acks from Write Requests for {len(board)} articles")
+        if len(acks) >= need:
+            return b'ACK'
+        elif all_expired(writes):
+            raise DeadlineExceeded(f'No write quorum ({need}) before the deadline.')
+        return self.fanout_reply(failures(writes))
 
 
 
@@ -496,51 +665,448 @@ class Replica:
 
 
 
-        req_enum, = unpack('>Q', message[:8])
-        req_enum = int(req_enum)
-        # nbytes_msg = message[8:16] TODO Toss this
-        message = json.loads(message[16:].decode('utf-8'))
+        if message.flags & FLAG_DELTA: # Only what changed since the last sync, merged in
+            self.data.update(self.decode_board(message.body, message.flags))
+            send_reply(conn, b'ACK')
+            return
+
+        if message.flags & FLAG_BINARY:
+            batch = article_codec.ArticleBatch(message.body)
+            if batch.replace:
+                self.data = batch.to_dict()
+            else:
+                self.data.update(batch.to_dict())
+            send_reply(conn, b'ACK')
+            return
+
+        message = message.json()
         if 'id' in message.keys():
             self.data[int(message['id'])] = message
-            print(self.data)
+            print(self.data.copy())
         else:
             print(f"{message=}")
             message = {int(key):value for key,value in message.items()}
             self.data = message
 
 
-        message = "ACK".encode('utf-8')
-        length = pack(">Q", len(message))
-
-        conn.sendall(length+message)
+        send_reply(conn, b'ACK')
 
-    def execute_read_data(self, conn):
+    def execute_read_data(self, conn, message):
         print('Received read_data from coordinator')
-        payload = json.dumps(self.data).encode('utf-8')
-        payload_length = pack('>Q', len(payload))
+        if message.flags & FLAG_DELTA: # Only what changed since the coordinator's mark, after our own new mark
+            incarnation, version, changes = self.data.delta(*MARK.unpack(message.body))
+            payload = MARK.pack(incarnation, version) + self.encode_board(changes, message.flags)
+        else:
+            payload = self.encode_board(self.data.copy(), message.flags)
         print(f"Read payload: {payload}")
-        conn.sendall(payload_length + payload)
+        send_reply(conn, payload)
+
+    def execute_digest(self, conn, message):
+        send_reply(conn, article_codec.encode_digest(article_codec.board_digest(self.data.copy())))
+
+    def execute_ids(self, conn, message):
+        incarnation, version, ids = self.data.have()
+        send_reply(conn, MARK.pack(incarnation, version) + id_set.encode(id_set.of(ids)))
+
+    # Handles a relayed frame here, then passes it down the rest of our subtree (see relay.py)
+    def execute_relay(self, conn, message):
+        frame, subtree, fanout = relay.decode_relay(message.body)
+        channel = DeliveryChannel(frame)
+        self.dispatch(channel, frame)
+        refused = {} if channel.payload == b'ACK' else {tuple(self.connections[self.replica_id]): channel.payload}
+        failed = []
+        for o in failures(self.relay(frame, subtree, fanout) if subtree else []):
+            if isinstance(o.error, relay.Refused): # Passed on up, a STALE has to reach the coordinator
+                refused[o.address] = o.error.reply
+            else:
+                failed.append(o.address)
+        send_reply(conn, relay.encode_failed(failed, refused))
+
+    # An article another replica numbered from its lease, into the log after everything before it
+    def execute_append(self, conn, message):
+        article = self.decode_article(message)
+        self.data[int(article['id'])] = article
+        self.log.append([article])
+        send_reply(conn, b'ACK')
+
+    # Blocks until a follower confirmed the log up to `end`, so a sequential post isn't ACKed while only we have it
+    def await_followers(self, end, deadline=None):
+        if len(self.connections) == 1: # No one else to lose it to
+            return
+        timeout = CONFIRM_TIMEOUT if deadline is None else max(0.0, deadline - time.monotonic())
+        if not self.log.wait_confirmed(end, timeout):
+            raise DeadlineExceeded(f'No follower confirmed log offset {end} in time.')
+
+    # The positions a follower confirms on its log stream, until it closes
+    def read_confirmations(self, sock):
+        while True:
+            try:
+                frame = Frame.recv(sock)
+            except (OSError, ValueError):
+                return
+            if frame is None:
+                return
+            self.log.confirm(*POSITION.unpack(frame.body))
+
+    # Streams the log to a follower from the position it asked for, for as long as we're the coordinator
+    def execute_tail(self, conn, message):
+        log_id, offset = POSITION.unpack(message.body)
+        print(f'Streaming the log from {offset} to a follower')
+        try:
+            while self.coordinator_flag:
+                offset, articles = self.log.batch(log_id, offset, self.data)
+                log_id = self.log.id
+                send_reply(conn, POSITION.pack(log_id, offset) + self.encode_board(articles, message.flags))
+                self.log.wait(offset, TAIL_IDLE)
+        except OSError as e:
+            print(f'Log stream ended: {e}')
+
+    # The requested articles we hold, the body is an id set
+    def execute_fetch(self, conn, message):
+        board = self.data.copy()
+        articles = {i: board[i] for i in id_set.to_list(id_set.decode(message.body)) if i in board}
+        send_reply(conn, self.encode_board(articles, message.flags))
+
+    # The body is the sender's id, which is evidently up
+    def execute_heartbeat(self, conn, message):
+        if message.body:
+            self.election.members.down.discard(unpack('>Q', message.body)[0])
+        send_reply(conn, b'ACK')
+
+    def execute_hello(self, conn, message):
+        offered = message.json().get('features', [])
+        send_reply(conn, json.dumps({'features': [f for f in SUPPORTED_FEATURES if f in offered]}).encode('utf-8'))
+
+    # Blocks until a multicast broadcast has been handled here, NACKing the sender for anything that got lost
+    def execute_multicast_wait(self, conn, message):
+        if self.mcast_receiver is None:
+            send_reply(conn, b'UNSUPPORTED')
+            return
+        wait = message.json()
+        session, sender = wait['session'], tuple(wait['sender'])
+        nack = lambda seq: self.pool.request(sender, Frame(REQUEST_TYPE.r_NACK, pack('>IQ', session, seq), deadline=message.deadline))
+        send_reply(conn, self.mcast_receiver.wait(session, wait['seq'], nack, message.deadline))
+
+    # Retransmits a broadcast over TCP
+    def execute_nack(self, conn, message):
+        session, seq = unpack('>IQ', message.body)
+        payload = None
+        if self.mcast_sender is not None and self.mcast_sender.session == session:
+            payload = self.mcast_sender.retransmit(seq)
+        send_reply(conn, payload if payload is not None else b'GONE')
 
     ###################################################################################
     # Utilities
 
-    def get_article_id(self):
-        self.article_id += 1
+    # Sends one frame to every target by multicast or down a relay tree, returns an Outcome per target
+    def broadcast(self, frame, targets):
+        if self.mcast_sender is None:
+            outcomes = self.relay(frame, targets)
+        else:
+            # Multicast to the group, then collect every target's reply with an r_MCAST_WAIT over TCP
+            seq = self.mcast_sender.send(frame)
+            wait = Frame(REQUEST_TYPE.r_MCAST_WAIT, wait_body(self.mcast_sender.session, seq, self.connections[self.replica_id]), deadline=frame.deadline)
+            outcomes = self.fanout.gather(targets, lambda c: bytes(wait_reply(self.pool.submit(c, wait), wait)), frame.deadline)
+        return [self.check_outcome(o) for o in outcomes]
+
+    # Fences broadcasts like unicast writes: a STALE reply makes us follow the newer leader, and only ACK is a success
+    def check_outcome(self, outcome):
+        reply = outcome.error.reply if isinstance(outcome.error, relay.Refused) else outcome.result
+        if reply is None: # Never got there
+            return outcome
+        try:
+            self.election.check(reply)
+        except StaleEpoch as e:
+            return Outcome(outcome.address, None, e)
+        if bytes(reply) != b'ACK':
+            return Outcome(outcome.address, None, outcome.error or relay.Refused(outcome.address, reply))
+        return outcome
+
+    # We only reach the first replica of each of relay_fanout subtrees, they pass the frame on down theirs
+    def relay(self, frame, targets, fanout=None):
+        fanout = fanout or self.relay_fanout
+        def send_subtree(subtree):
+            failed = []
+            for i, root in enumerate(subtree): # A root we can't reach is skipped, the next replica takes over its subtree
+                message = Frame(REQUEST_TYPE.r_RELAY, relay.encode_relay(frame, subtree[i+1:], fanout), deadline=frame.deadline)
+                try:
+                    below, refused = relay.decode_failed(wait_reply(self.pool.submit(root, message), message))
+                    return failed + below, refused
+                except (OSError, DeadlineExceeded) as e:
+                    print(f'[!] Relay to {root} failed: {e}')
+                    failed.append(root)
+            return failed, {}
+        me = tuple(self.connections[self.replica_id])
+        # We go last, as a leaf, so we don't relay to a subtree of our own on top of the ones we start
+        subtrees = relay.split(sorted((tuple(t) for t in targets), key=lambda t: t == me), fanout)
+        outcomes = []
+        for sent in self.fanout.gather(subtrees, send_subtree, frame.deadline):
+            failed, refused = (set(sent.result[0]), sent.result[1]) if sent.ok else (set(sent.address), {})
+            for address in sent.address:
+                if address in failed:
+                    outcomes.append(Outcome(address, None, sent.error or ConnectionError(f'Relay broadcast did not reach {address}.')))
+                elif address in refused:
+                    outcomes.append(Outcome(address, None, relay.Refused(address, refused[address])))
+                else:
+                    outcomes.append(Outcome(address, b'ACK', None))
+        return outcomes
+
+    def write_quorum_size(self):
+        n = len(self.connections)
+        return n // 2 + 1 if self.write_quorum is None else max(1, min(self.write_quorum, n))
+
+    # ACK if every peer in a fan-out answered, otherwise PARTIAL and who didn't
+    def fanout_reply(self, failed):
+        if not failed:
+            return b'ACK'
+        for failure in failed:
+            print(f"[!] {failure.address} failed: {failure.error}")
+        return PARTIAL + b' ' + json.dumps({'failed': [list(f.address) for f in failed]}).encode('utf-8')
+
+    # Features both sides agreed on, asked once per peer and cached. Peers that don't know r_HELLO get plain JSON.
+    def peer_features(self, address, deadline=None):
+        address = tuple(address)
+        if address not in self._peer_features:
+            reply = self.pool.request(address, Frame(REQUEST_TYPE.r_HELLO, json.dumps({'features': SUPPORTED_FEATURES}).encode('utf-8'), deadline=deadline))
+            try:
+                self._peer_features[address] = set(load_json(reply).get('features', []))
+            except (ValueError, AttributeError):
+                self._peer_features[address] = set()
+        return self._peer_features[address]
+
+    def board_flags(self, address, deadline=None):
+        features = self.peer_features(address, deadline)
+        return (FLAG_BINARY if 'binary' in features else 0) | (FLAG_ACCEPT_COMPRESSED if 'zlib' in features else 0)
+
+    # Boards go out as binary batches when FLAG_BINARY is set, JSON otherwise (compression is handled by the frame)
+    def encode_board(self, data, flags, replace=False):
+        if flags & FLAG_BINARY:
+            return article_codec.encode_board(data, replace=replace)
+        return json.dumps(data).encode('utf-8')
+
+    def decode_board(self, body, flags):
+        if flags & FLAG_BINARY:
+            return article_codec.ArticleBatch(body).to_dict()
+        data = load_json(body)
+        return {int(key):value for key,value in data.items()} if data else {}
+
+    def encode_article(self, article, flags):
+        if flags & FLAG_BINARY:
+            return article_codec.encode_articles([article])
+        return json.dumps(article).encode('utf-8')
+
+    def decode_article(self, message):
+        if message.flags & FLAG_BINARY:
+            return article_codec.ArticleBatch(message.body).article(0)
+        return message.json()
+
+    # Pipelined r_READ of a peer's whole board in the best format it speaks, raising DeadlineExceeded if it doesn't arrive
+    # before `deadline`
+    def fetch_board(self, address, deadline=None):
+        flags = self.board_flags(address)
+        frame = Frame(REQUEST_TYPE.r_READ, flags=flags, deadline=deadline)
+        return self.decode_board(wait_reply(self.pool.submit(address, frame), frame), flags)
+
+    # Sync read of a peer: with the 'delta' feature only what it changed since our read mark, otherwise its whole board.
+    # Returns (mark, articles), mark is the peer's new (incarnation, version) or None for a whole board.
+    def fetch_changes(self, address, deadline=None):
+        frame = self.sync_read_frame(address, self.peer_features(address), self.board_flags(address), deadline)
+        return self.decode_sync_read(wait_reply(self.pool.submit(address, frame), frame), frame)
+
+    def sync_read_frame(self, address, features, flags, deadline=None):
+        if 'delta' not in features:
+            return Frame(REQUEST_TYPE.r_READ, flags=flags, deadline=deadline)
+        mark = self.sync_marks.read_mark(address)
+        if mark is None: # Never read it, find out what it has first
+            return Frame(REQUEST_TYPE.r_IDS, deadline=deadline)
+        return Frame(REQUEST_TYPE.r_READ, MARK.pack(*mark), flags=flags | FLAG_DELTA, deadline=deadline)
+
+    # (mark, articles, have): the peer's new (incarnation, version) or None for a whole board, the articles read, and
+    # the peer's id set for an r_IDS (its articles are fetched once we know who has what)
+    def decode_sync_read(self, reply, frame):
+        if frame.request == REQUEST_TYPE.r_IDS:
+            reply = bytes(reply)
+            return MARK.unpack_from(reply), {}, id_set.decode(reply[MARK.size:])
+        if not frame.flags & FLAG_DELTA:
+            return None, self.decode_board(reply, frame.flags), None
+        reply = bytes(reply)
+        return MARK.unpack_from(reply), self.decode_board(reply[MARK.size:], frame.flags), None
+
+    # Merges sync reads into our board. Read marks only move once their articles are in, a read that came back too late
+    # for the sync is simply read again next time. Returns {address: (mark, id set)} of the peers that sent id sets.
+    def merge_sync_reads(self, reads):
+        haves = {}
+        for read in reads:
+            if read.ok:
+                mark, articles, have = read.result
+                self.data.update(articles)
+                if have is not None:
+                    haves[read.address] = (mark, have)
+                elif mark is not None:
+                    self.sync_marks.set_read(read.address, *mark)
+        return haves
+
+    # address -> ids to fetch from it: what the id sets have and we don't, each id from the first peer that has it
+    def plan_fetches(self, haves):
+        if not haves:
+            return {}
+        lacking = id_set.difference(id_set.union(have for _, have in haves.values()), id_set.of(self.data.copy()))
+        fetches = {}
+        for address, (_, have) in haves.items():
+            if not len(lacking):
+                break
+            wanted = id_set.intersection(lacking, have)
+            if len(wanted):
+                fetches[address] = wanted
+                lacking = id_set.difference(lacking, wanted)
+        return fetches
+
+    # Merges fetched articles, a peer is read up to its id set's mark once nothing is left to fetch from it
+    def merge_fetches(self, haves, fetched):
+        failed = {o.address for o in failures(fetched)}
+        for articles in successes(fetched):
+            self.data.update(articles)
+        for address, (mark, _) in haves.items():
+            if address not in failed:
+                self.sync_marks.set_read(address, *mark)
+
+    def fetch_articles(self, address, ids, deadline=None):
+        flags = self.board_flags(address)
+        frame = Frame(REQUEST_TYPE.r_FETCH, id_set.encode(ids), flags=flags, deadline=deadline)
+        return self.decode_board(wait_reply(self.pool.submit(address, frame), frame), flags)
+
+    # address -> the r_WRITE it needs after a sync, or None if it is up to date. Peers that sent id sets get the articles
+    # they lack, other peers with the 'delta' feature what changed since their write mark, the rest our whole board.
+    # Each (format, mark) is encoded once and shared.
+    def sync_write_frames(self, targets, features, haves, deadline=None):
+        frames, shared = {}, {}
+        board = self.data.copy() if haves else None
+        held = id_set.of(board) if haves else None
+        for c in targets:
+            flags = (FLAG_BINARY if 'binary' in features[c] else 0) | (FLAG_ACCEPT_COMPRESSED if 'zlib' in features[c] else 0)
+            if c in haves:
+                missing = id_set.difference(held, haves[c][1])
+                frames[c] = self.board_write(flags, {i: board[i] for i in id_set.to_list(missing)}, deadline)
+                continue
+            since = self.sync_marks.write_mark(c) if 'delta' in features[c] else None
+            if (flags, since) not in shared:
+                shared[(flags, since)] = self.sync_write(flags, since, deadline)
+            frames[c] = shared[(flags, since)]
+        return frames
+
+    # Delta r_WRITE of our changes after version `since`, a replacing one of the whole board for None
+    def sync_write(self, flags, since, deadline=None):
+        if since is None:
+            return self.board_write(flags, self.data.copy(), deadline, replace=True)
+        return self.board_write(flags, self.data.changes_since(since), deadline)
+
+    # r_WRITE of `articles`, merged in (FLAG_DELTA) unless it should `replace` the board. None if there is nothing to merge.
+    # Stamped with `epoch`, ours by default.
+    def board_write(self, flags, articles, deadline=None, replace=False, epoch=None):
+        if not articles and not replace:
+            return None
+        payload = self.encode_board(articles, flags, replace=replace)
+        flags |= 0 if replace else FLAG_DELTA
+        if flags & FLAG_ACCEPT_COMPRESSED: # Peer speaks zlib
+            flags |= compression_flag(len(payload), self.compress_threshold)
+        return Frame(REQUEST_TYPE.r_WRITE, payload, flags=flags, deadline=deadline, epoch=self.election.epoch if epoch is None else epoch)
+
+    def append_frame(self, article, message):
+        flags = message.flags & FLAG_BINARY
+        return Frame(REQUEST_TYPE.r_APPEND, self.encode_article(article, flags), flags=flags, deadline=message.deadline)
+
+    # Pulls what the coordinator changed since we last read it, unless we already have its board up to the session token
+    def catch_up(self, token, deadline=None):
+        coordinator = self.connections[self.coordinator_index]
+        if self.caught_up(coordinator, token):
+            return
+        frame = self.pull_frame(coordinator, self.board_flags(coordinator), deadline)
+        self.merge_pull(coordinator, wait_reply(self.pool.submit(coordinator, frame), frame), frame)
+        if not self.caught_up(coordinator, token): # The token is from a coordinator that has been replaced since
+            self.pull_majority(deadline)
+
+    # Pulls from enough replicas that, with us, they are a majority. Every token's writes are on W of them.
+    def pull_majority(self, deadline=None):
+        def pull(c):
+            frame = self.pull_frame(c, self.board_flags(c), deadline)
+            self.merge_pull(c, wait_reply(self.pool.submit(c, frame), frame), frame)
+        others, need = self.majority_pull_targets()
+        self.check_majority(self.fanout.gather(others, pull, deadline, need=need), need)
+
+    # The other live replicas, and how many of them make a majority with us
+    def majority_pull_targets(self):
+        return [self.connections[i] for i in self.election.members.successors(self.replica_id)], self.election.members.majority() - 1
+
+    def check_majority(self, pulls, need):
+        if len(successes(pulls)) >= need:
+            return
+        if all_expired(pulls):
+            raise DeadlineExceeded(f'Fewer than {need} replicas answered a session read before the deadline.')
+        raise ConnectionError(f'Only {len(successes(pulls))} of the {need} replicas a session read needs answered.')
 
-        # Update state of Backup replica
-        self.update_backup_state(self.article_id)
+    def caught_up(self, address, token):
+        mark = self.sync_marks.read_mark(address)
+        return mark is not None and mark[0] == token[0] and mark[1] >= token[1]
 
-        return self.article_id
+    # Delta r_READ from our read mark, everything if we never read it
+    def pull_frame(self, address, flags, deadline=None):
+        return Frame(REQUEST_TYPE.r_READ, MARK.pack(*(self.sync_marks.read_mark(address) or (0, 0))), flags=flags | FLAG_DELTA, deadline=deadline)
+
+    def merge_pull(self, address, reply, frame):
+        mark, articles, _ = self.decode_sync_read(reply, frame)
+        self.data.update(articles)
+        self.sync_marks.set_read(address, *mark)
+
+    # (max id, count, hash) of a peer's board, see article_codec.board_digest
+    def fetch_digest(self, address, deadline=None):
+        frame = Frame(REQUEST_TYPE.r_DIGEST, deadline=deadline)
+        return article_codec.decode_digest(wait_reply(self.pool.submit(address, frame), frame))
+
+    def get_article_id(self):
+        return self.get_article_ids(1)
+
+    # Hands out `count` consecutive ids and returns the first. The backup only hears about a new block's high-water mark.
+    def get_article_ids(self, count):
+        # Pipelined requests are handled concurrently, so hand out ids one at a time
+        with self._id_lock:
+            ceiling = self.ceiling_for(count)
+            if ceiling is not None:
+                # Update state of Backup replica
+                self.update_backup_state(ceiling)
+                self._id_ceiling = ceiling
+            return self.take_ids(count)
+
+    # The ceiling the backup has to record before `count` more ids can be handed out, None while they're below ours
+    def ceiling_for(self, count):
+        if self.article_id + count > self._id_ceiling:
+            return self.article_id + count + ID_BLOCK
+        return None
+
+    # Hands out the next `count` ids, returns the first
+    def take_ids(self, count):
+        first = self.article_id + 1
+        self.article_id += count
+        return first
+
+    # Id for a sequential post on a non-coordinator, from our lease. A used up lease is renewed from the coordinator.
+    def leased_article_id(self, deadline=None):
+        with self._lease_lock:
+            new_id = self.id_lease.take()
+            if new_id is None:
+                print("Leasing IDs from coordinator")
+                self.id_lease.refill(*decode_range(self.forward_to_coordinator(self.lease_request(deadline))))
+                new_id = self.id_lease.take()
+        return new_id
+
+    def lease_request(self, deadline=None):
+        return Frame(REQUEST_TYPE.r_GET_ID, COUNT.pack(LEASE_SIZE), deadline=deadline)
 
     def update_backup_state(self, id):
-        request_type = pack('>Q', int(REQUEST_TYPE.r_BACKUPDATE))
-        payload = pack('>Q', id) # id is a 8 byte
-        length = pack('>Q', len(payload))
+        # Block for the backup's ack so the id is durable before anyone sees it (and raise StaleEpoch if we're deposed)
+        self.election.check(self.pool.request(self.connections[self.backup_index], self.backup_frame(id)))
 
-        target_host, target_port = self.connections[self._backup_index]
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((target_host, target_port))
-            s.sendall(request_type+length+payload)
+    def backup_frame(self, id):
+        return Frame(REQUEST_TYPE.r_BACKUPDATE, pack('>Q', id), epoch=self.election.epoch) # id is a 8 byte
 
     def run_server(self):
         while True:
@@ -551,25 +1117,54 @@ class Replica:
             threading.Thread(target = self.process_requests, args=(conn,addr)).start()
 
     def run(self):
+        if self.multicast is not None:
+            group, port = self.multicast
+            interface = self.connections[self.replica_id][0] or '0.0.0.0' # Multicast on the interface we serve on
+            self.mcast_receiver = MulticastReceiver(group, port, self.dispatch, interface)
+            self.mcast_sender = MulticastSender(group, port, interface)
+
+        if self.mode == 'sequential':
+            self.tailer.start()
+        elif self.mode == 'quorum' and self.write_quorum_size() + self.election.members.majority() > len(self.connections):
+            self.read_lease.start() # Only while every acknowledged write reaches a majority a new coordinator syncs with
+        self.monitor.start()
+
+        if self.engine == 'asyncio':
+            self.async_engine = AsyncEngine(self)
+            self.async_engine.start()
+            self.server_thread = self.async_engine.thread
+            return
+
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         my_host_name, my_host_port = self.connections[self.replica_id]
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((my_host_name, my_host_port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.queue_depth)
+        self.worker_pool = WorkerPool(self.workers, self.queue_depth)
         print(f"Node {self.replica_id} listening on {my_host_port}")
-        threading.Thread(target=self.run_server).start()
+        self.server_thread = threading.Thread(target=self.run_server)
+        self.server_thread.start()
+
+    # Blocks for as long as we serve. run() returns right away, so a process that only runs a replica has to wait here:
+    # once its main thread is done, the fan-out executor refuses new work and every quorum request, sync and election fails.
+    def wait(self):
+        self.server_thread.join()
 
 if __name__=="__main__":
     args = sys.argv
     node_id = args[1]
     mode = args[2]
+    engine = args[3] if len(args) > 3 else 'threaded'
+    multicast = TEST_MULTICAST_GROUP if 'multicast' in args[4:] else None
+    relay_fanout = next((int(a.split('=', 1)[1]) for a in args[4:] if a.startswith('relay=')), None)
     
 
     connections_list = TEST_CONNECTION_LIST
-    node_1 = Replica(replica_id=0, connections=connections_list, mode=mode)
-    node_2 = Replica(replica_id=1, connections=connections_list, mode=mode)
-    node_3 = Replica(replica_id=2, connections=connections_list, mode=mode)
+    node_1 = Replica(replica_id=0, connections=connections_list, mode=mode, engine=engine, multicast=multicast, relay_fanout=relay_fanout)
+    node_2 = Replica(replica_id=1, connections=connections_list, mode=mode, engine=engine, multicast=multicast, relay_fanout=relay_fanout)
+    node_3 = Replica(replica_id=2, connections=connections_list, mode=mode, engine=engine, multicast=multicast, relay_fanout=relay_fanout)
 
     replicas = [node_1, node_2, node_3]
 
-    replicas[int(node_id)].run()
\ No newline at end of file
+    replicas[int(node_id)].run()
+    replicas[int(node_id)].wait()
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+Bounded, prioritised executor for incoming requests.
+
+Connection threads only read frames, the work itself is queued here for a fixed number of worker threads. Requests
+between replicas (the r_* types) are served before client requests, and a few workers are reserved for them: client
+handlers block on peers, so if clients could take every worker two replicas waiting on each other would deadlock.
+Client requests are refused (the caller replies BUSY) once `queue_depth` requests are waiting, peer requests are always
+queued since rejecting them would leave a write or an election half done. Clients send r_SYNC too, and a SYNC waits on
+every replica (the coordinator included), so it is admitted and limited like a client request.
+"""
+
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+from msg_utils import REQUEST_TYPE
+
+DEFAULT_WORKERS = 16
+DEFAULT_QUEUE_DEPTH = 64
+
+PEER_PRIORITY = 0
+DEFAULT_PRIORITIES = {int(r): (PEER_PRIORITY if r.name.startswith('r_') else 2) for r in REQUEST_TYPE}
+DEFAULT_PRIORITIES[int(REQUEST_TYPE.POST)] = 1 # Writes before client reads
+DEFAULT_PRIORITIES[int(REQUEST_TYPE.r_SYNC)] = 1 # Sent by clients, or forwarded for one
+
+def request_priority(request, priorities=DEFAULT_PRIORITIES):
+    '''Lower runs first, unknown request types go last'''
+    return priorities.get(request, max(priorities.values()) + 1)
+
+
+class WorkerPool:
+    def __init__(self, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH, reserved=None, priorities=DEFAULT_PRIORITIES):
+        if reserved is None:
+            reserved = max(1, workers // 4)
+        if not 0 <= reserved < workers:
+            raise ValueError(f'reserved workers must be in [0, {workers}), not {reserved}')
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.reserved = reserved
+        self.priorities = priorities
+        self._heap = []                     # (priority, sequence, future, fn, args)
+        self._seq = itertools.count()       # FIFO within a priority
+        self._cond = threading.Condition()
+        self._client_active = 0             # client requests currently running
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Queue fn(*args) for the given request type. Returns a Future, or None if the request was refused.
+    def submit(self, request, fn, *args):
+        priority = request_priority(request, self.priorities)
+        future = Future()
+        with self._cond:
+            if priority != PEER_PRIORITY and len(self._heap) >= self.queue_depth:
+                return None
+            heapq.heappush(self._heap, (priority, next(self._seq), future, fn, args))
+            self._cond.notify()
+        return future
+
+    # The heap top is the best runnable item, a client request at the top means there is no peer work waiting
+    def _runnable(self):
+        if not self._heap:
+            return False
+        return self._heap[0][0] == PEER_PRIORITY or self._client_active < self.workers - self.reserved
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._runnable)
+                priority, _, future, fn, args = heapq.heappop(self._heap)
+                client = priority != PEER_PRIORITY
+                if client:
+                    self._client_active += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        print(f'Request handler failed: {e!r}')
+                        future.set_exception(e)
+            finally:
+                if client:
+                    with self._cond:
+                        self._client_active -= 1
+                        self._cond.notify()
@@ -0,0 +1,87 @@
+"""Stand-ins for the replicas on the other end of a coordinator's requests"""
+
+import json
+import socket
+import threading
+
+import id_set
+from board import MARK
+from conn_pool import PeerPool
+from election import Election
+from msg_utils import FLAG_BINARY, REQUEST_TYPE, Frame, ReplyChannel
+
+
+class FakePeer:
+    '''Answers r_IDS, r_HELLO, r_WRITE and r_LEASE like a replica holding `held`, or never answers anything if `hang` is set'''
+    def __init__(self, held=(), features=('binary',), hang=False, write_reply=b'ACK', granted=True):
+        self.held = list(held)
+        self.features = list(features)
+        self.hang = hang
+        self.write_reply = write_reply
+        self.granted = granted
+        self.frames = [] # Every frame received, bodies copied
+        self.written = threading.Event()
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        lock = threading.Lock()
+        with conn:
+            while True:
+                try:
+                    frame = Frame.recv(conn)
+                except (OSError, ValueError):
+                    return
+                if frame is None:
+                    return
+                self.frames.append(Frame(frame.request, bytes(frame.body), flags=frame.flags, epoch=frame.epoch))
+                if self.hang:
+                    continue
+                ReplyChannel(conn, frame, lock).reply(self.answer(frame))
+                if frame.request == REQUEST_TYPE.r_WRITE:
+                    self.written.set()
+
+    def answer(self, frame):
+        if frame.request == REQUEST_TYPE.r_IDS:
+            return MARK.pack(0, 0) + id_set.encode(id_set.of(self.held))
+        if frame.request == REQUEST_TYPE.r_HELLO:
+            return json.dumps({'features': self.features}).encode('utf-8')
+        if frame.request == REQUEST_TYPE.r_WRITE:
+            return self.write_reply
+        if frame.request == REQUEST_TYPE.r_LEASE:
+            return json.dumps({'granted': self.granted}).encode('utf-8')
+        return b'UNSUPPORTED'
+
+    def writes(self):
+        return [f for f in self.frames if f.request == REQUEST_TYPE.r_WRITE]
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeReplica:
+    '''The parts of a Replica that read repair and hinted handoff use, as replica 0 of `n` and coordinator'''
+    def __init__(self, n=3, epoch=1):
+        self.replica_id = 0
+        self.coordinator_index = 0
+        self.connections = [('127.0.0.1', 1 + i) for i in range(n)]
+        self.pool = PeerPool(connect_timeout=1)
+        self.election = Election(self)
+        self.election.epoch = epoch
+        self.data = {}
+
+    @property
+    def coordinator_flag(self):
+        return self.coordinator_index == self.replica_id
+
+    def board_flags(self, address, deadline=None):
+        return FLAG_BINARY # Every FakePeer speaks it
@@ -0,0 +1,106 @@
+import struct
+import threading
+
+import pytest
+
+import article_codec
+from article_codec import ArticleBatch, board_digest, decode_digest, encode_articles, encode_board, encode_digest
+from board import VersionedBoard
+
+BOARD = {
+    1: {'id': 1, 'parent': None, 'title': 'first', 'content': 'hello', 'user': 'ann'},
+    2: {'id': 2, 'parent': 1, 'title': 'reply', 'content': '', 'user': 'bob'},
+    7: {'id': 7, 'parent': 2, 'title': 'ünïcödé ✓', 'content': '日本語のテキスト 🚀', 'user': 'zoë'},
+}
+
+
+def test_board_round_trip():
+    batch = ArticleBatch(encode_board(BOARD))
+    assert len(batch) == 3
+    assert batch.ids() == [1, 2, 7]
+    assert batch.max_id() == 7
+    assert batch.to_dict() == BOARD
+    assert not batch.replace
+
+def test_replace_flag():
+    assert ArticleBatch(encode_board(BOARD, replace=True)).replace
+
+def test_empty_batch():
+    buf = encode_articles([])
+    assert len(buf) == article_codec.BATCH_HEADER.size
+    batch = ArticleBatch(buf)
+    assert len(batch) == 0
+    assert batch.ids() == []
+    assert batch.max_id() == 0
+    assert batch.to_dict() == {}
+
+def test_unicode_lengths_are_bytes():
+    article = {'id': 3, 'parent': None, 'title': '✓' * 5, 'content': '🚀', 'user': 'é'}
+    assert ArticleBatch(encode_articles([article])).article(0) == article
+
+# Articles that haven't been given an id (or parent) yet
+def test_missing_ids_decode_as_none():
+    article = ArticleBatch(encode_articles([{'title': 't', 'content': 'c', 'user': 'u'}])).article(0)
+    assert article == {'id': None, 'parent': None, 'title': 't', 'content': 'c', 'user': 'u'}
+
+def test_negative_ids_decode_as_missing():
+    article = ArticleBatch(encode_articles([{'id': -5, 'parent': -1, 'title': 't', 'content': 'c', 'user': 'u'}])).article(0)
+    assert article['id'] is None and article['parent'] is None
+
+def test_missing_strings_encode_empty():
+    assert ArticleBatch(encode_articles([{'id': 1, 'title': None}])).article(0) == {'id': 1, 'parent': None, 'title': '', 'content': '', 'user': ''}
+
+def test_trailing_bytes_are_malformed():
+    with pytest.raises(ValueError):
+        ArticleBatch(encode_board(BOARD) + b'\x00')
+
+def test_truncated_strings_are_malformed():
+    with pytest.raises(ValueError):
+        ArticleBatch(encode_board(BOARD)[:-1])
+
+def test_count_beyond_records_is_malformed():
+    buf = encode_board(BOARD)
+    flags, count = article_codec.BATCH_HEADER.unpack_from(buf)
+    with pytest.raises(struct.error):
+        ArticleBatch(article_codec.BATCH_HEADER.pack(flags, count + 1) + buf[article_codec.BATCH_HEADER.size:])
+
+def test_digest_ignores_order():
+    assert board_digest(BOARD) == board_digest(dict(reversed(list(BOARD.items()))))
+
+def test_digest_tells_boards_apart():
+    changed = dict(BOARD)
+    changed[2] = dict(BOARD[2], content='edited')
+    digest = board_digest(BOARD)
+    assert board_digest(changed)[:2] == digest[:2]
+    assert board_digest(changed) != digest
+
+def test_digest_round_trip():
+    digest = board_digest(BOARD)
+    assert digest[:2] == (7, 3)
+    assert decode_digest(encode_digest(digest)) == digest
+    assert decode_digest(memoryview(encode_digest(digest))) == digest
+
+def test_empty_board_digest():
+    assert board_digest({}) == (0, 0, 0)
+    assert decode_digest(encode_digest(board_digest({}))) == (0, 0, 0)
+
+# Replicas encode their board while POST, tailer and repair threads write to it, so they encode a snapshot
+def test_encode_a_board_being_written():
+    board = VersionedBoard({i: {'id': i, 'parent': None, 'title': 't', 'content': 'c', 'user': 'u'} for i in range(1, 20001)})
+    stop = threading.Event()
+    def write():
+        i = 20001
+        while not stop.is_set(): # Changes the board's size all the time without growing it
+            board[i] = {'id': i, 'parent': None, 'title': 't', 'content': 'c', 'user': 'u'}
+            board.pop(i - 1000, None)
+            i += 1
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(5):
+            snapshot = board.copy()
+            assert type(snapshot) is dict
+            assert len(ArticleBatch(encode_board(snapshot))) == len(snapshot) >= 19000
+    finally:
+        stop.set()
+        writer.join()
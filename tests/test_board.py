@@ -0,0 +1,96 @@
+from board import SyncMarks, VersionedBoard
+
+
+def article(i, content='c'):
+    return {'id': i, 'parent': None, 'title': f't{i}', 'content': content, 'user': 'u'}
+
+
+def test_changes_bump_the_version():
+    board = VersionedBoard()
+    assert board.version == 0 and board.changes_since(0) == {}
+    board[1] = article(1)
+    board[2] = article(2)
+    assert board.version == 2
+    assert board.changes_since(0) == {1: article(1), 2: article(2)}
+    assert board.changes_since(1) == {2: article(2)}
+    assert board.changes_since(2) == {}
+
+def test_unchanged_writes_are_not_changes():
+    board = VersionedBoard({1: article(1)})
+    board[1] = article(1)
+    board.update({1: article(1)})
+    board.setdefault(1, article(1, 'other'))
+    assert board.version == 1
+
+def test_rewrite_moves_to_the_end():
+    board = VersionedBoard({1: article(1), 2: article(2)})
+    board[1] = article(1, 'edited')
+    assert list(board.changes_since(0)) == [2, 1]
+    assert board.changes_since(2) == {1: article(1, 'edited')}
+
+def test_removed_articles_leave_the_changes():
+    board = VersionedBoard({1: article(1), 2: article(2), 3: article(3)})
+    del board[1]
+    board.pop(2)
+    assert board.pop(9, None) is None
+    assert board.changes_since(0) == {3: article(3)}
+    board.clear()
+    assert board.changes_since(0) == {}
+
+def test_changes_after_replace():
+    board = VersionedBoard({1: article(1), 2: article(2), 3: article(3)})
+    version = board.version
+    board.replace({2: article(2), 3: article(3, 'edited'), 4: article(4)})
+    assert dict(board) == {2: article(2), 3: article(3, 'edited'), 4: article(4)}
+    # Only the articles that actually changed are stamped
+    assert board.changes_since(version) == {3: article(3, 'edited'), 4: article(4)}
+    assert board.version == version + 2
+    assert set(board.changes_since(0)) == {2, 3, 4}
+
+def test_replace_with_the_same_board():
+    board = VersionedBoard({1: article(1)})
+    board.replace({1: article(1)})
+    assert board.version == 1
+
+def test_replace_with_an_empty_board():
+    board = VersionedBoard({1: article(1)})
+    board.replace({})
+    assert board == {} and board.changes_since(0) == {}
+
+def test_delta():
+    board = VersionedBoard({1: article(1), 2: article(2)})
+    assert board.delta(board.incarnation, 1) == (board.incarnation, 2, {2: article(2)})
+    # Another incarnation's version means nothing here, so it gets everything
+    other = board.incarnation ^ 1
+    assert board.delta(other, 1) == (board.incarnation, 2, {1: article(1), 2: article(2)})
+
+def test_incarnations_differ():
+    assert VersionedBoard().incarnation != VersionedBoard().incarnation
+
+def test_have():
+    board = VersionedBoard({1: article(1), 5: article(5)})
+    assert board.have() == (board.incarnation, 2, [1, 5])
+
+
+def test_sync_marks():
+    marks = SyncMarks()
+    peer = ['127.0.0.1', 9000]
+    assert marks.read_mark(peer) is None and marks.write_mark(peer) == 0
+    marks.set_read(peer, 42, 3)
+    marks.set_write(peer, 5)
+    marks.set_write(tuple(peer), 4) # Never goes back
+    assert marks.read_mark(tuple(peer)) == (42, 3)
+    assert marks.write_mark(peer) == 5
+
+def test_new_incarnation_loses_the_write_mark():
+    marks = SyncMarks()
+    peer = ('127.0.0.1', 9000)
+    marks.set_read(peer, 42, 3)
+    marks.set_write(peer, 5)
+    marks.set_read(peer, 42, 4)
+    assert marks.write_mark(peer) == 5
+    marks.set_read(peer, 43, 1)
+    assert marks.read_mark(peer) == (43, 1) and marks.write_mark(peer) == 0
+    marks.set_write(peer, 5)
+    marks.forget(peer)
+    assert marks.read_mark(peer) is None and marks.write_mark(peer) == 0
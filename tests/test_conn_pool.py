@@ -0,0 +1,93 @@
+import socket
+import time
+
+import pytest
+
+import conn_pool
+from conn_pool import ConnectionPool, PeerPool
+from msg_utils import REQUEST_TYPE, DeadlineExceeded, Frame, deadline_in
+from pipeline import wait_reply
+
+from peers import FakePeer
+
+
+def hello(deadline=None):
+    return Frame(REQUEST_TYPE.r_HELLO, b'{}', deadline=deadline)
+
+
+def test_request_reuses_the_socket():
+    peer = FakePeer()
+    pool = ConnectionPool(peer.address)
+    assert b'features' in bytes(pool.request(hello()))
+    assert len(pool._idle) == 1
+    sock = pool._idle[0]
+    pool.request(hello())
+    assert list(pool._idle) == [sock]
+
+
+def test_closed_socket_is_reconnected():
+    peer = FakePeer()
+    pool = ConnectionPool(peer.address)
+    pool.request(hello())
+    pool._idle[0].shutdown(socket.SHUT_RDWR)
+    assert b'features' in bytes(pool.request(hello()))
+
+
+def test_hung_peer_runs_out_the_deadline():
+    pool = ConnectionPool(FakePeer(hang=True).address)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        pool.request(hello(deadline_in(0.2)))
+    assert time.monotonic() - start < 1
+    assert not pool._idle # The late reply can't be read as the next one's
+
+
+def test_busy_pool_times_out():
+    pool = ConnectionPool(FakePeer().address, max_size=1, connect_timeout=0.1)
+    with pool.connection():
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+        with pytest.raises(DeadlineExceeded):
+            pool.request(hello(deadline_in(0.05)))
+
+
+def test_expired_frame_is_not_sent():
+    peer = FakePeer()
+    pool = PeerPool()
+    frame = hello(deadline_in(0))
+    with pytest.raises(DeadlineExceeded):
+        pool.request(peer.address, frame)
+    with pytest.raises(DeadlineExceeded):
+        pool.submit(peer.address, frame)
+    time.sleep(0.05)
+    assert not peer.frames
+
+
+def test_pipeline_connects_within_the_deadline(monkeypatch):
+    timeouts = []
+    class Recorded(conn_pool.PipelinedConnection):
+        def __init__(self, address, connect_timeout=10):
+            timeouts.append(connect_timeout)
+            super().__init__(address, connect_timeout)
+    monkeypatch.setattr(conn_pool, 'PipelinedConnection', Recorded)
+    pool = PeerPool(connect_timeout=10)
+    pool.submit(FakePeer().address, hello(deadline_in(0.5)))
+    pool.submit(FakePeer().address, hello())
+    assert 0 < timeouts[0] <= 0.5
+    assert timeouts[1] == 10
+
+
+def test_pipelined_requests_to_a_hung_peer_time_out():
+    pool = PeerPool()
+    frame = hello(deadline_in(0.2))
+    future = pool.submit(FakePeer(hang=True).address, frame)
+    with pytest.raises(DeadlineExceeded):
+        wait_reply(future, frame)
+
+
+def test_pipelined_replies():
+    peer = FakePeer()
+    pool = PeerPool()
+    futures = [pool.submit(peer.address, hello()) for _ in range(5)]
+    assert all(b'features' in bytes(f.result(2)) for f in futures)
+    assert len(pool._pipelines) == 1
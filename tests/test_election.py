@@ -0,0 +1,18 @@
+from election import Election
+from id_lease import ID_BLOCK
+
+
+def test_first_free_id_from_the_backup_ceiling():
+    ballots = [{'article_id': 0, 'max_id': 7}, {'article_id': 100, 'max_id': 9}]
+    assert Election.first_free_id(ballots) == 100
+
+def test_first_free_id_without_a_ceiling():
+    # Nobody holds the old backup's ceiling, skip a whole block past the highest id seen
+    ballots = [{'article_id': 0, 'max_id': 7}, {'article_id': 3, 'max_id': 12}]
+    assert Election.first_free_id(ballots) == 12 + ID_BLOCK
+
+def test_first_free_id_at_the_ceiling():
+    assert Election.first_free_id([{'article_id': 12, 'max_id': 12}]) == 12
+
+def test_first_free_id_of_an_empty_cluster():
+    assert Election.first_free_id([{'article_id': 0, 'max_id': 0}, {'article_id': 0, 'max_id': 0}]) == 0
@@ -0,0 +1,73 @@
+import socket
+import threading
+import types
+
+from failure_detector import BOOTSTRAP_TIMEOUT, MIN_SAMPLES, PHI_THRESHOLD, HeartbeatMonitor, PhiAccrual
+
+
+def steady(interval=0.1, beats=50, **kwargs):
+    detector = PhiAccrual(now=0.0, **kwargs)
+    for i in range(beats):
+        detector.heartbeat(now=i * interval)
+    return detector, (beats - 1) * interval
+
+
+# A peer that never answers is suspected after the fixed timeout, counted from when we started watching it
+def test_never_heard_from():
+    detector = PhiAccrual(now=10.0)
+    assert detector.phi(now=10.0 + BOOTSTRAP_TIMEOUT / 2) == 0.0
+    assert detector.phi(now=10.0 + BOOTSTRAP_TIMEOUT * 2) > PHI_THRESHOLD
+    assert detector.last_heard() == 10.0
+
+def test_too_few_intervals():
+    detector = PhiAccrual(now=0.0)
+    for i in range(MIN_SAMPLES):
+        detector.heartbeat(now=i * 0.1)
+    last = (MIN_SAMPLES - 1) * 0.1
+    assert detector.last_heard() == last
+    assert detector.phi(now=last + BOOTSTRAP_TIMEOUT / 2) == 0.0
+    assert detector.phi(now=last + BOOTSTRAP_TIMEOUT * 2) > PHI_THRESHOLD
+
+def test_on_time_is_not_suspected():
+    detector, last = steady()
+    assert detector.phi(now=last + 0.1) < 1
+
+def test_suspicion_grows_with_silence():
+    detector, last = steady()
+    phis = [detector.phi(now=last + t) for t in (0.1, 0.3, 0.5, 1.0)]
+    assert phis == sorted(phis)
+    assert phis[-1] > PHI_THRESHOLD
+
+def test_jitter_delays_suspicion():
+    regular, last = steady()
+    jittery = PhiAccrual(now=0.0)
+    now = 0.0
+    for i in range(50):
+        jittery.heartbeat(now=now)
+        now += 0.2 if i % 2 else 0.0
+    # Same mean interval and silence, a wider spread
+    assert jittery.phi(now=jittery.last + 0.4) < regular.phi(now=last + 0.4)
+
+def test_history_is_bounded():
+    detector, last = steady(beats=20, history=5)
+    assert len(detector.intervals) == 5
+
+def test_phi_stays_finite():
+    detector, last = steady()
+    assert detector.phi(now=last + 1e6) < float('inf')
+
+
+# A follower that starts while the coordinator is already down still elects a new one
+def test_monitor_suspects_a_coordinator_that_never_answered():
+    with socket.socket() as s: # A port nothing listens on
+        s.bind(('127.0.0.1', 0))
+        dead = s.getsockname()
+    elected = threading.Event()
+    replica = types.SimpleNamespace(replica_id=1, coordinator_index=0, coordinator_flag=False, connections=[dead, None],
+                                    election=types.SimpleNamespace(epoch=1))
+    def execute_leader_election(suspected, since):
+        replica.coordinator_index, replica.coordinator_flag = 1, True
+        elected.set()
+    replica.execute_leader_election = execute_leader_election
+    HeartbeatMonitor(replica).start()
+    assert elected.wait(BOOTSTRAP_TIMEOUT + 2)
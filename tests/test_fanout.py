@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+
+from fanout import FanOut, Outcome, agather, all_expired, failures, split_deadline, successes
+from msg_utils import DeadlineExceeded, deadline_in
+
+
+def answers(delays, fail=()):
+    '''A request that answers each target after its delay (or raises for targets in `fail`), and the ones that finished'''
+    finished = []
+    def request(address):
+        time.sleep(delays[address])
+        finished.append(address)
+        if address in fail:
+            raise ConnectionError(address)
+        return address * 10
+    return request, finished
+
+
+def test_outcomes_in_target_order():
+    request, _ = answers({1: 0.05, 2: 0.0, 3: 0.02}, fail={2})
+    outcomes = FanOut().gather([1, 2, 3], request)
+    assert [o.address for o in outcomes] == [1, 2, 3]
+    assert successes(outcomes) == [10, 30]
+    assert [o.address for o in failures(outcomes)] == [2]
+    assert isinstance(outcomes[1].error, ConnectionError)
+
+
+def test_late_targets_run_out_of_time():
+    request, _ = answers({1: 0.0, 2: 1.0})
+    start = time.monotonic()
+    outcomes = FanOut().gather([1, 2], request, deadline_in(0.2))
+    assert time.monotonic() - start < 0.5
+    assert successes(outcomes) == [10]
+    assert isinstance(outcomes[1].error, DeadlineExceeded)
+    assert not all_expired(outcomes)
+    assert all_expired(outcomes[1:])
+
+
+def test_need_returns_once_enough_succeeded():
+    request, finished = answers({1: 0.0, 2: 0.5, 3: 0.5})
+    start = time.monotonic()
+    outcomes = FanOut().gather([1, 2, 3], request, deadline_in(5), need=1)
+    assert time.monotonic() - start < 0.3
+    assert outcomes == [Outcome(1, 10, None)] # The others are left out, not failed
+    time.sleep(0.7)
+    assert sorted(finished) == [1, 2, 3] # and still ran to the end
+
+
+def test_need_gives_up_once_it_cant_be_reached():
+    request, _ = answers({1: 0.0, 2: 0.0, 3: 1.0}, fail={1, 2})
+    start = time.monotonic()
+    outcomes = FanOut().gather([1, 2, 3], request, deadline_in(5), need=2)
+    assert time.monotonic() - start < 0.5
+    assert [o.address for o in failures(outcomes)] == [1, 2]
+
+
+def test_need_zero_returns_right_away():
+    release = threading.Event()
+    ran = threading.Event()
+    def request(address):
+        release.wait(2)
+        ran.set()
+    assert FanOut().gather([1, 2], request, deadline_in(5), need=0) == []
+    release.set()
+    assert ran.wait(2)
+
+
+def test_need_runs_out_of_time():
+    request, _ = answers({1: 1.0, 2: 1.0})
+    outcomes = FanOut().gather([1, 2], request, deadline_in(0.2), need=1)
+    assert all_expired(outcomes) and len(outcomes) == 2
+
+
+def test_split_deadline():
+    assert split_deadline(None) is None
+    deadline = deadline_in(1)
+    assert split_deadline(deadline) < deadline
+    assert abs(split_deadline(deadline, 0.5) - (time.monotonic() + 0.5)) < 0.05
+
+
+def async_answers(delays):
+    finished = []
+    async def request(address):
+        await asyncio.sleep(delays[address])
+        finished.append(address)
+        return address * 10
+    return request, finished
+
+
+def test_agather_need_returns_once_enough_succeeded():
+    request, finished = async_answers({1: 0.0, 2: 0.3})
+    async def run():
+        start = time.monotonic()
+        outcomes = await agather([1, 2], request, deadline_in(5), need=1)
+        took = time.monotonic() - start
+        await asyncio.sleep(0.5)
+        return outcomes, took
+    outcomes, took = asyncio.run(run())
+    assert took < 0.2
+    assert outcomes == [Outcome(1, 10, None)]
+    assert finished == [1, 2]
+
+
+def test_agather_deadline_and_no_targets():
+    request, _ = async_answers({1: 0.0, 2: 1.0})
+    async def run():
+        return await agather([1, 2], request, deadline_in(0.2)), await agather([], request)
+    outcomes, none = asyncio.run(run())
+    assert successes(outcomes) == [10]
+    assert isinstance(outcomes[1].error, DeadlineExceeded)
+    assert none == []
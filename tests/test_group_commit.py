@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from group_commit import AsyncGroupCommit, GroupCommit
+from msg_utils import DeadlineExceeded, deadline_in
+
+
+class Committer:
+    '''Records every batch and the deadline it was committed by'''
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.batches = []
+
+    def __call__(self, items, deadline):
+        self.batches.append((list(items), deadline))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return f'ACK {len(items)}'
+
+
+def test_concurrent_posts_share_a_commit():
+    commit = Committer(delay=0.05)
+    group = GroupCommit(commit, window=0.02)
+    with ThreadPoolExecutor(20) as pool:
+        replies = list(pool.map(group.submit, range(20)))
+    assert len(commit.batches) < 20
+    assert sorted(i for items, _ in commit.batches for i in items) == list(range(20))
+    sizes = {len(items) for items, _ in commit.batches}
+    assert {int(r.split()[1]) for r in replies} <= sizes
+
+
+def test_batches_are_capped():
+    commit = Committer(delay=0.05)
+    group = GroupCommit(commit, window=0.5, max_batch=4)
+    with ThreadPoolExecutor(10) as pool:
+        list(pool.map(group.submit, range(10)))
+    assert max(len(items) for items, _ in commit.batches) <= 4
+
+
+def test_lone_post_waits_one_window_at_most():
+    commit = Committer()
+    group = GroupCommit(commit, window=0.05)
+    start = time.monotonic()
+    assert group.submit('a') == 'ACK 1'
+    assert time.monotonic() - start < 0.5
+
+
+def test_failed_commit_fails_the_whole_batch():
+    commit = Committer(delay=0.05, error=ConnectionError('backup down'))
+    group = GroupCommit(commit, window=0.05)
+    errors = []
+    def submit(i):
+        try:
+            group.submit(i)
+        except ConnectionError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors) == 3
+
+
+def test_expired_posts_are_left_out():
+    commit = Committer()
+    group = GroupCommit(commit, window=0.05)
+    with pytest.raises(DeadlineExceeded):
+        group.submit('late', deadline_in(0))
+    assert not commit.batches
+
+
+def test_batch_deadline_is_its_last_clients():
+    commit = Committer()
+    group = GroupCommit(commit, window=0.1)
+    deadlines = [deadline_in(5), deadline_in(10)]
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(group.submit, 'ab', deadlines))
+    assert commit.batches == [(['a', 'b'], deadlines[1])]
+    group.submit('c', None) # No deadline at all
+    assert commit.batches[-1] == (['c'], None)
+
+
+def test_async_posts_share_a_commit():
+    batches = []
+    async def commit(items, deadline):
+        batches.append(list(items))
+        await asyncio.sleep(0.05)
+        return 'ACK'
+    async def run():
+        group = AsyncGroupCommit(commit, window=0.02)
+        return await asyncio.gather(*(group.submit(i) for i in range(20)))
+    assert asyncio.run(run()) == ['ACK'] * 20
+    assert len(batches) < 20
+    assert sorted(i for items in batches for i in items) == list(range(20))
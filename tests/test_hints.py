@@ -0,0 +1,106 @@
+import socket
+import time
+
+import pytest
+
+from article_codec import ArticleBatch
+from election import StaleEpoch
+from hints import HintedHandoff
+from peers import FakePeer, FakeReplica
+
+
+def article(i):
+    return {'id': i, 'parent': None, 'title': f't{i}', 'content': 'c', 'user': 'u'}
+
+def written_ids(peer):
+    return [ArticleBatch(w.body).ids() for w in peer.writes()]
+
+# Replays only when the test calls replay(), the background worker sleeps through the test
+def handoff(replica, **kwargs):
+    return HintedHandoff(replica, interval=3600, **kwargs)
+
+def down_address():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()
+
+
+def test_replays_in_batches_in_our_epoch():
+    peer = FakePeer()
+    hints = handoff(FakeReplica(epoch=3), batch=2)
+    hints.add(peer.address, [article(i) for i in range(1, 6)])
+    assert len(hints) == 5
+    hints.replay(peer.address)
+    assert written_ids(peer) == [[1, 2], [3, 4], [5]]
+    assert {w.epoch for w in peer.writes()} == {3}
+    assert len(hints) == 0
+
+def test_latest_version_of_an_article_wins():
+    peer = FakePeer()
+    hints = handoff(FakeReplica())
+    hints.add(peer.address, [article(1), article(2)])
+    hints.add(peer.address, [dict(article(1), content='edited')])
+    hints.replay(peer.address)
+    [batch] = [ArticleBatch(w.body) for w in peer.writes()]
+    assert batch.ids() == [2, 1] and batch.article(1)['content'] == 'edited'
+
+def test_hints_kept_while_the_peer_is_down():
+    hints = handoff(FakeReplica())
+    address = down_address()
+    hints.add(address, [article(1)])
+    with pytest.raises(OSError):
+        hints.replay(address)
+    assert len(hints) == 1
+
+def test_too_many_hints_hand_over_the_board():
+    replica = FakeReplica()
+    replica.data = {i: article(i) for i in range(1, 4)}
+    peer = FakePeer()
+    hints = handoff(replica, max_hints=2)
+    hints.add(peer.address, [article(i) for i in range(1, 4)])
+    assert len(hints) == 0 # Only the flag is kept
+    hints.replay(peer.address)
+    assert written_ids(peer) == [[1, 2, 3]]
+
+def test_missed_board():
+    replica = FakeReplica()
+    replica.data = {7: article(7)}
+    peer = FakePeer()
+    hints = handoff(replica)
+    hints.add(peer.address)
+    hints.replay(peer.address)
+    hints.replay(peer.address) # Handed over once
+    assert written_ids(peer) == [[7]]
+
+# Handoff is a coordinator write like any other: a replica in a newer epoch fences it off, and we stop
+def test_fenced_off():
+    replica = FakeReplica(epoch=1)
+    peer = FakePeer(write_reply=b'STALE {"epoch": 2, "leader": 1, "down": []}')
+    hints = handoff(replica)
+    hints.add(peer.address, [article(1)])
+    with pytest.raises(StaleEpoch):
+        hints.replay(peer.address)
+    assert (replica.election.epoch, replica.coordinator_index) == (2, 1)
+    hints.replay(peer.address)
+    assert len(peer.writes()) == 1
+
+# The background worker drops the hints of a deposed coordinator
+def test_deposed_coordinator_drops_its_hints():
+    replica = FakeReplica(epoch=1)
+    peer = FakePeer(write_reply=b'STALE {"epoch": 2, "leader": 1, "down": []}')
+    hints = HintedHandoff(replica, interval=0.05)
+    hints.add(peer.address, [article(1)])
+    deadline = time.monotonic() + 5
+    while len(hints) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(hints) == 0 and not replica.coordinator_flag
+    assert len(peer.writes()) == 1
+
+def test_deposed_coordinator_hands_nothing_over():
+    replica = FakeReplica()
+    replica.coordinator_index = 1
+    peer = FakePeer()
+    hints = handoff(replica)
+    hints.add(peer.address, [article(1)])
+    hints.replay(peer.address)
+    assert peer.writes() == []
@@ -0,0 +1,82 @@
+import socket
+from struct import unpack
+
+from id_lease import COUNT, ID_BLOCK, LEASE_SIZE, RANGE, IdLease, decode_range
+from msg_utils import REQUEST_TYPE, Frame, read
+from replica import Replica
+
+from peers import FakePeer
+
+
+def test_lease_hands_out_its_range_once():
+    lease = IdLease()
+    assert lease.take() is None
+    lease.refill(100, 3)
+    assert [lease.take() for _ in range(4)] == [100, 101, 102, None]
+
+
+def test_decode_range():
+    assert decode_range(RANGE.pack(7, 32)) == (7, 32)
+    assert decode_range(COUNT.pack(7)) == (7, 1) # A coordinator without leases
+
+
+def coordinator():
+    backup = FakePeer()
+    replica = Replica(0, [('127.0.0.1', 1), backup.address, FakePeer().address], mode='sequential')
+    replica.election.epoch = 1
+    return replica, backup
+
+
+def ceilings(backup):
+    return [(unpack('>Q', f.body)[0], f.epoch) for f in backup.frames if f.request == REQUEST_TYPE.r_BACKUPDATE]
+
+
+def test_backup_hears_once_per_block():
+    replica, backup = coordinator()
+    assert [replica.get_article_ids(1) for _ in range(3)] == [1, 2, 3]
+    assert replica.get_article_ids(10) == 4
+    assert ceilings(backup) == [(1 + ID_BLOCK, 1)]
+    assert replica.get_article_ids(ID_BLOCK) == 14
+    assert ceilings(backup) == [(1 + ID_BLOCK, 1), (13 + ID_BLOCK + ID_BLOCK, 1)]
+
+
+def test_backup_carries_on_above_the_ceiling():
+    replica, backup = coordinator()
+    replica.get_article_ids(5)
+    (ceiling, _), = ceilings(backup)
+    takeover = Replica(1, replica.connections, mode='sequential')
+    a, b = socket.socketpair()
+    takeover.execute_backup_state_update(a, Frame(REQUEST_TYPE.r_BACKUPDATE, COUNT.pack(ceiling)))
+    assert bytes(read(b)) == b'ACK'
+    takeover._coordinator_index = 1
+    takeover._id_ceiling = 10 ** 6 # Its own block is recorded already
+    assert takeover.get_article_ids(1) == ceiling + 1
+
+
+def test_leases_are_capped_at_a_block():
+    replica, _ = coordinator()
+    a, b = socket.socketpair()
+    replica.execute_get_id(a, Frame(REQUEST_TYPE.r_GET_ID, COUNT.pack(10 * ID_BLOCK)))
+    assert decode_range(bytes(read(b))) == (1, ID_BLOCK)
+    replica.execute_get_id(a, Frame(REQUEST_TYPE.r_GET_ID))
+    assert decode_range(bytes(read(b))) == (1 + ID_BLOCK, 1)
+
+
+class LeasingCoordinator(FakePeer):
+    def answer(self, frame):
+        if frame.request == REQUEST_TYPE.r_GET_ID:
+            self.first = getattr(self, 'first', 100)
+            count = COUNT.unpack(frame.body)[0]
+            self.first += count
+            return RANGE.pack(self.first - count, count)
+        return super().answer(frame)
+
+
+def test_follower_asks_once_per_lease():
+    leader = LeasingCoordinator()
+    follower = Replica(1, [leader.address, ('127.0.0.1', 1)], mode='sequential')
+    ids = [follower.leased_article_id() for _ in range(LEASE_SIZE + 1)]
+    assert ids == list(range(100, 100 + LEASE_SIZE + 1))
+    asked = [f for f in leader.frames if f.request == REQUEST_TYPE.r_GET_ID]
+    assert len(asked) == 2
+    assert COUNT.unpack(asked[0].body)[0] == LEASE_SIZE
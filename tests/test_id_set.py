@@ -0,0 +1,63 @@
+import pytest
+
+import id_set
+
+
+# Every test runs against numpy arrays and against plain python sets
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(id_set, 'np', None)
+    elif id_set.np is None:
+        pytest.skip('numpy is not installed')
+    return request.param
+
+def ids(s):
+    return sorted(id_set.to_list(s))
+
+
+def test_round_trip(backend):
+    board = [5, 1, 2, 3, 10, 11, 4]
+    assert ids(id_set.decode(id_set.encode(id_set.of(board)))) == [1, 2, 3, 4, 5, 10, 11]
+
+def test_runs_are_compact(backend):
+    assert len(id_set.encode(id_set.of(range(1, 100001)))) == id_set.RUN.size
+    assert len(id_set.encode(id_set.of([1, 2, 3, 7, 8, 20]))) == 3 * id_set.RUN.size
+
+def test_encode_plain_iterables(backend):
+    assert ids(id_set.decode(id_set.encode([3, 1, 2]))) == [1, 2, 3]
+
+def test_duplicates(backend):
+    assert ids(id_set.of([2, 2, 1, 1])) == [1, 2]
+
+def test_negative_ids(backend):
+    assert ids(id_set.decode(id_set.encode(id_set.of([-3, -2, -1, 0, 5])))) == [-3, -2, -1, 0, 5]
+
+def test_empty_set(backend):
+    empty = id_set.of([])
+    assert id_set.encode(empty) == b''
+    assert ids(id_set.decode(b'')) == []
+    assert ids(id_set.union([])) == []
+    assert ids(id_set.union([empty, id_set.of([1])])) == [1]
+    assert ids(id_set.difference(id_set.of([1, 2]), empty)) == [1, 2]
+    assert ids(id_set.intersection(id_set.of([1, 2]), empty)) == []
+
+def test_malformed_length(backend):
+    with pytest.raises(ValueError):
+        id_set.decode(id_set.encode(id_set.of([1, 2, 3]))[:-1])
+
+def test_negative_run_length(backend):
+    with pytest.raises(ValueError):
+        id_set.decode(id_set.RUN.pack(10, -2))
+
+def test_zero_length_run(backend):
+    assert ids(id_set.decode(id_set.RUN.pack(10, 0) + id_set.RUN.pack(1, 2))) == [1, 2]
+
+def test_set_operations(backend):
+    a, b, c = id_set.of([1, 2, 3, 4]), id_set.of([3, 4, 5]), id_set.of([9])
+    assert ids(id_set.union([a, b, c])) == [1, 2, 3, 4, 5, 9]
+    assert ids(id_set.difference(a, b)) == [1, 2]
+    assert ids(id_set.intersection(a, b)) == [3, 4]
+
+def test_to_list_gives_python_ints(backend):
+    assert all(type(i) is int for i in id_set.to_list(id_set.of([1, 2])))
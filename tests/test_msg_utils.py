@@ -0,0 +1,32 @@
+import os
+
+from msg_utils import FLAG_BINARY, FLAG_COMPRESSED, PROTOCOL_V1, REQUEST_TYPE, Frame, deadline_in
+
+
+def round_trip(frame):
+    return Frame.decode(frame.encode())
+
+
+def test_v0_round_trip():
+    decoded = round_trip(Frame(REQUEST_TYPE.POST, b'{"title": "t"}', epoch=7))
+    assert (decoded.request, bytes(decoded.body), decoded.epoch, decoded.flags) == (int(REQUEST_TYPE.POST), b'{"title": "t"}', 7, 0)
+
+def test_v1_round_trip():
+    decoded = round_trip(Frame(REQUEST_TYPE.r_READ, b'x', version=PROTOCOL_V1, request_id=12345, flags=FLAG_BINARY))
+    assert (decoded.version, decoded.request_id, decoded.flags, bytes(decoded.body)) == (PROTOCOL_V1, 12345, FLAG_BINARY, b'x')
+
+def test_empty_body():
+    assert bytes(round_trip(Frame(REQUEST_TYPE.r_SYNC)).body) == b''
+
+def test_compressed_round_trip():
+    body = b'article ' * 100000 + os.urandom(1000)
+    frame = Frame(REQUEST_TYPE.r_WRITE, body, flags=FLAG_COMPRESSED | FLAG_BINARY)
+    encoded = frame.encode()
+    assert len(encoded) < len(body)
+    decoded = Frame.decode(encoded)
+    # The decoded body is inflated, so it no longer carries FLAG_COMPRESSED
+    assert bytes(decoded.body) == body and decoded.flags == FLAG_BINARY
+
+def test_deadline_travels():
+    decoded = round_trip(Frame(REQUEST_TYPE.r_READ, deadline=deadline_in(5)))
+    assert 4 < decoded.remaining() <= 5
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from election import Election, StaleEpoch
+from fanout import FanOut
+from msg_utils import DeadlineExceeded, deadline_in
+from read_lease import CLOCK_DRIFT, ReadLease
+from replica import Replica
+
+from peers import FakePeer, FakeReplica
+
+
+def leased(replica, peers, duration=0.2):
+    replica.connections = [replica.connections[0]] + [p.address for p in peers]
+    replica.election = Election(replica)
+    replica.election.epoch = 1
+    replica.fanout = FanOut()
+    replica.sync_replicas = lambda deadline: [p.address for p in peers]
+    return ReadLease(replica, duration=duration)
+
+
+def test_lease_runs_out_before_the_grants_do():
+    peers = [FakePeer(), FakePeer()]
+    lease = leased(FakeReplica(), peers)
+    start = time.monotonic()
+    assert lease.renew() and lease.held()
+    assert lease.expires <= start + lease.duration * (1 - CLOCK_DRIFT) + 0.01
+    time.sleep(lease.duration)
+    assert not lease.held()
+
+
+def test_no_lease_without_a_majority_of_grants():
+    peers = [FakePeer(granted=False), FakePeer(granted=False)]
+    lease = leased(FakeReplica(), peers)
+    assert not lease.renew() and not lease.held()
+
+
+def test_one_grant_is_a_majority_of_three():
+    peers = [FakePeer(), FakePeer(hang=True)]
+    lease = leased(FakeReplica(), peers)
+    assert lease.renew() and lease.held()
+
+
+def test_first_lease_in_an_epoch_waits_for_a_sync():
+    replica = FakeReplica()
+    lease = leased(replica, [FakePeer(), FakePeer()])
+    replica.sync_replicas = lambda deadline: []
+    assert not lease.renew() and not lease.held()
+    assert lease.synced is None
+
+
+def test_lease_is_only_held_by_the_coordinator_in_its_epoch():
+    replica = FakeReplica()
+    lease = leased(replica, [FakePeer(), FakePeer()])
+    assert lease.renew()
+    replica.election.epoch = 2
+    assert not lease.held()
+    replica.election.epoch = 1
+    replica.coordinator_index = 1
+    assert not lease.held()
+
+
+def test_grant_binds_the_grantor_until_it_runs_out():
+    grantor = FakeReplica()
+    grantor.replica_id = 1
+    grantor.article_id = 0
+    lease = ReadLease(grantor, duration=0.2)
+    assert lease.grant({'epoch': 1, 'leader': 0, 'down': []})['granted']
+    assert not grantor.election.vote({'epoch': 2, 'candidate': 1})['granted']
+    time.sleep(lease.duration)
+    assert grantor.election.vote({'epoch': 2, 'candidate': 1})['granted']
+
+
+def test_no_grant_for_anyone_but_our_leader():
+    grantor = FakeReplica()
+    grantor.replica_id = 1
+    lease = ReadLease(grantor)
+    assert not lease.grant({'epoch': 1, 'leader': 2, 'down': []})['granted']
+    assert grantor.election.promised == (None, 0.0)
+
+
+def quorum_coordinator(peers):
+    replica = Replica(0, [('127.0.0.1', 1)] + [p.address for p in peers], mode='quorum')
+    replica.election.epoch = 1
+    replica._id_ceiling = 1000 # Ids already recorded with the backup
+    return replica
+
+
+def test_failed_quorum_post_is_not_read_under_a_lease():
+    peers = [FakePeer(hang=True), FakePeer(hang=True)]
+    replica = quorum_coordinator(peers)
+    replica.read_lease.epoch, replica.read_lease.expires = 1, time.monotonic() + 60
+    with pytest.raises(DeadlineExceeded):
+        replica.commit_posts([{'title': 'lost'}], deadline_in(0.3))
+    assert replica.read_lease.held()
+    assert dict(replica.data) == {}
+
+
+def test_quorum_post_is_applied_once_acknowledged():
+    peers = [FakePeer(), FakePeer(hang=True)]
+    replica = quorum_coordinator(peers)
+    assert replica.commit_posts([{'title': 'kept'}], deadline_in(2)) == b'ACK'
+    assert list(replica.data) == [1]
+    assert len(peers[0].writes()) == 1
+
+
+def test_deposed_mid_post_writes_in_the_old_epoch():
+    peers = [FakePeer(), FakePeer()]
+    replica = quorum_coordinator(peers)
+    numbered = replica.get_article_ids
+    def deposed_meanwhile(count): # A straggler's STALE arrives between numbering and writing
+        first = numbered(count)
+        replica.election.adopt({'epoch': 3, 'leader': 1, 'down': []})
+        return first
+    replica.get_article_ids = deposed_meanwhile
+    with pytest.raises(StaleEpoch):
+        replica.commit_posts([{'title': 'late'}], deadline_in(2))
+    assert all(p.written.wait(2) for p in peers)
+    assert [f.epoch for p in peers for f in p.writes()] == [1, 1]
+    assert dict(replica.data) == {}
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from article_codec import ArticleBatch
+from msg_utils import FLAG_BINARY, DeadlineExceeded
+from peers import FakePeer, FakeReplica
+from read_repair import ReadRepair
+
+
+def article(i):
+    return {'id': i, 'parent': None, 'title': f't{i}', 'content': 'c', 'user': 'u'}
+
+BOARD = {i: article(i) for i in range(1, 6)}
+
+
+def test_pushes_only_missing_articles_in_our_epoch():
+    peer = FakePeer(held=[1, 2, 3])
+    replica = FakeReplica(epoch=4)
+    ReadRepair(replica).repair(peer.address, BOARD)
+    [write] = peer.writes()
+    assert write.flags & FLAG_BINARY and write.epoch == 4
+    assert ArticleBatch(write.body).ids() == [4, 5]
+
+def test_nothing_missing():
+    peer = FakePeer(held=list(BOARD))
+    ReadRepair(FakeReplica()).repair(peer.address, BOARD)
+    assert peer.writes() == []
+
+def test_a_peer_that_never_answers():
+    peer = FakePeer(hang=True)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        ReadRepair(FakeReplica(), timeout=0.5).repair(peer.address, BOARD)
+    assert time.monotonic() - start < 2
+
+# One hung peer doesn't stop the repairs queued behind it
+def test_repairs_go_on_after_a_hung_peer():
+    hung, stale = FakePeer(hang=True), FakePeer(held=[1])
+    repair = ReadRepair(FakeReplica(), timeout=0.5)
+    repair.schedule(hung.address, BOARD)
+    repair.schedule(stale.address, BOARD)
+    assert stale.written.wait(5)
+    assert ArticleBatch(stale.writes()[0].body).ids() == [2, 3, 4, 5]
+
+# A replica on a newer epoch fences the write off, and we follow its leader and stop repairing
+def test_fenced_off():
+    replica = FakeReplica(epoch=1)
+    stale = FakePeer(write_reply=b'STALE {"epoch": 2, "leader": 1, "down": []}')
+    repair = ReadRepair(replica)
+    repair.schedule(stale.address, BOARD)
+    assert stale.written.wait(5)
+    deadline = time.monotonic() + 5
+    while replica.coordinator_flag and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert (replica.election.epoch, replica.coordinator_index) == (2, 1)
+    other = FakePeer()
+    repair.schedule(other.address, BOARD)
+    time.sleep(0.3)
+    assert other.frames == []
@@ -0,0 +1,37 @@
+import relay
+from msg_utils import REQUEST_TYPE, Frame
+
+TARGETS = [('127.0.0.1', 9000 + i) for i in range(7)]
+
+
+def test_split_covers_every_target_in_order():
+    for fanout in range(1, 10):
+        subtrees = relay.split(TARGETS, fanout)
+        assert [t for subtree in subtrees for t in subtree] == TARGETS
+        assert len(subtrees) <= fanout
+        assert all(subtrees)
+
+def test_split_sizes():
+    assert [len(s) for s in relay.split(TARGETS, 2)] == [4, 3]
+    assert [len(s) for s in relay.split(TARGETS, 3)] == [3, 3, 1]
+    assert [len(s) for s in relay.split(TARGETS, 7)] == [1] * 7
+
+def test_split_more_fanout_than_targets():
+    assert relay.split(TARGETS[:2], 5) == [[TARGETS[0]], [TARGETS[1]]]
+
+def test_split_nothing():
+    assert relay.split([], 3) == []
+
+def test_split_no_fanout():
+    assert relay.split(TARGETS, 0) == [TARGETS]
+
+def test_relay_round_trip():
+    frame = Frame(REQUEST_TYPE.r_WRITE, b'board', epoch=3)
+    decoded, subtree, fanout = relay.decode_relay(relay.encode_relay(frame, TARGETS[1:], 2))
+    assert (decoded.request, bytes(decoded.body), decoded.epoch) == (int(REQUEST_TYPE.r_WRITE), b'board', 3)
+    assert subtree == TARGETS[1:] and fanout == 2
+
+def test_failed_round_trip():
+    refused = {TARGETS[1]: b'STALE {"epoch": 2}', TARGETS[2]: bytes(range(256))}
+    assert relay.decode_failed(relay.encode_failed([TARGETS[0]], refused)) == ([TARGETS[0]], refused)
+    assert relay.decode_failed(relay.encode_failed([])) == ([], {})
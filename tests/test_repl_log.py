@@ -0,0 +1,110 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from msg_utils import REQUEST_TYPE, DeadlineExceeded, Frame, deadline_in, send_reply
+from repl_log import POSITION, LogTailer, ReplicationLog
+from replica import Replica
+
+from peers import FakePeer
+
+
+def article(i):
+    return {'id': i, 'parent': None, 'title': f't{i}', 'content': '', 'user': 'ann'}
+
+
+def test_batches_are_capped():
+    log = ReplicationLog()
+    log.append([article(i) for i in range(1, 11)])
+    assert log.batch(log.id, 0, {}, limit=4) == (4, {i: article(i) for i in range(1, 5)})
+    assert log.batch(log.id, 8, {}, limit=4) == (10, {9: article(9), 10: article(10)})
+    assert log.batch(log.id, 10, {}) == (10, {})
+
+
+def test_other_log_gets_the_board():
+    log = ReplicationLog()
+    log.append([article(1)])
+    board = {1: article(1), 5: article(5)}
+    assert log.batch(0, 0, board) == (1, board)
+    assert log.batch(log.id, 2, board) == (1, board) # Ahead of the log, from another coordinator
+
+
+def test_trimmed_log_gets_the_board():
+    log = ReplicationLog(size=2)
+    for i in range(1, 6):
+        log.append([article(i)])
+    assert log.start == 3 and log.end == 5
+    board = {i: article(i) for i in range(1, 6)}
+    assert log.batch(log.id, 1, board) == (5, board)
+    assert log.batch(log.id, 3, board) == (5, {4: article(4), 5: article(5)})
+
+
+def test_wait_wakes_on_append():
+    log = ReplicationLog()
+    assert not log.wait(0, 0.05)
+    threading.Timer(0.05, log.append, ([article(1)],)).start()
+    assert log.wait(0, 2)
+
+
+def test_confirmations_only_count_for_our_log():
+    log = ReplicationLog()
+    end = log.append([article(1), article(2)])
+    log.confirm(log.id + 1, end)
+    assert not log.wait_confirmed(end, 0.05)
+    log.confirm(log.id, 1)
+    assert not log.wait_confirmed(end, 0.05)
+    threading.Timer(0.05, log.confirm, (log.id, end)).start()
+    assert log.wait_confirmed(end, 2)
+    log.confirm(log.id, 1) # Never goes back
+    assert log.confirmed == end
+
+
+def sequential_coordinator():
+    replica = Replica(0, [('127.0.0.1', 1)] + [FakePeer().address for _ in range(2)], mode='sequential')
+    replica._id_ceiling = 1000 # Ids already recorded with the backup
+    return replica
+
+
+def test_post_waits_for_a_follower():
+    replica = sequential_coordinator()
+    threading.Timer(0.1, lambda: replica.log.confirm(replica.log.id, 1)).start()
+    start = time.monotonic()
+    assert replica.commit_posts([article(0)], deadline_in(2)) == b'ACK'
+    assert time.monotonic() - start >= 0.1
+
+
+def test_post_no_follower_confirmed_is_not_acked():
+    replica = sequential_coordinator()
+    with pytest.raises(DeadlineExceeded):
+        replica.commit_posts([article(0)], deadline_in(0.2))
+
+
+def test_single_replica_posts_right_away():
+    replica = Replica(0, [('127.0.0.1', 1)], mode='sequential')
+    replica._id_ceiling = 1000
+    assert replica.commit_posts([article(0)], deadline_in(0.2)) == b'ACK'
+
+
+def test_tailer_confirms_what_it_applied():
+    server = socket.create_server(('127.0.0.1', 0))
+    follower = Replica(1, [server.getsockname(), ('127.0.0.1', 1)], mode='sequential')
+    follower.board_flags = lambda address, deadline=None: 0 # JSON
+    confirmed = []
+    def coordinator():
+        conn, _ = server.accept()
+        with conn:
+            assert Frame.recv(conn).request == REQUEST_TYPE.r_TAIL
+            send_reply(conn, POSITION.pack(7, 2) + follower.encode_board({1: article(1), 2: article(2)}, 0))
+            confirmed.append(Frame.recv(conn))
+    serving = threading.Thread(target=coordinator)
+    serving.start()
+    tailer = LogTailer(follower)
+    with pytest.raises(ConnectionError):
+        tailer.tail(server.getsockname())
+    serving.join()
+    server.close()
+    assert sorted(follower.data) == [1, 2]
+    assert confirmed[0].request == REQUEST_TYPE.r_TAIL
+    assert POSITION.unpack(confirmed[0].body) == (7, 2)
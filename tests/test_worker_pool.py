@@ -0,0 +1,109 @@
+import os
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+from msg_utils import REQUEST_TYPE
+from worker_pool import PEER_PRIORITY, WorkerPool, request_priority
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+def test_priorities():
+    assert request_priority(int(REQUEST_TYPE.r_WRITE)) == PEER_PRIORITY
+    assert request_priority(int(REQUEST_TYPE.POST)) < request_priority(int(REQUEST_TYPE.READ))
+    # Clients send SYNCs, so they queue like client requests
+    assert request_priority(int(REQUEST_TYPE.r_SYNC)) != PEER_PRIORITY
+    assert request_priority(999) > request_priority(int(REQUEST_TYPE.READ))
+
+def test_peer_requests_run_first():
+    pool = WorkerPool(workers=2, reserved=1)
+    gate = threading.Event()
+    pool.submit(int(REQUEST_TYPE.READ), gate.wait) # Holds the one unreserved worker
+    pool.submit(int(REQUEST_TYPE.r_WRITE), gate.wait) # And the reserved one
+    order = []
+    done = [pool.submit(int(r), order.append, r) for r in (REQUEST_TYPE.READ, REQUEST_TYPE.POST, REQUEST_TYPE.r_READ)]
+    gate.set()
+    for future in done:
+        future.result(5)
+    assert order == [REQUEST_TYPE.r_READ, REQUEST_TYPE.POST, REQUEST_TYPE.READ]
+
+def test_reserved_workers_only_serve_peers():
+    pool = WorkerPool(workers=3, reserved=1)
+    gate = threading.Event()
+    clients = [pool.submit(int(REQUEST_TYPE.READ), gate.wait) for _ in range(3)]
+    time.sleep(0.1)
+    assert sum(f.running() for f in clients) == 2
+    assert pool.submit(int(REQUEST_TYPE.r_READ), lambda: 'peer').result(5) == 'peer'
+    gate.set()
+    for future in clients:
+        future.result(5)
+
+def test_busy_once_the_queue_is_full():
+    pool = WorkerPool(workers=2, queue_depth=2, reserved=1)
+    gate = threading.Event()
+    pool.submit(int(REQUEST_TYPE.READ), gate.wait)
+    time.sleep(0.1)
+    queued = [pool.submit(int(REQUEST_TYPE.READ), gate.wait) for _ in range(2)]
+    assert all(queued)
+    assert pool.submit(int(REQUEST_TYPE.READ), gate.wait) is None
+    assert pool.submit(int(REQUEST_TYPE.r_SYNC), gate.wait) is None
+    assert pool.submit(int(REQUEST_TYPE.r_WRITE), lambda: 'peer') is not None # Never refused
+    gate.set()
+
+def test_reserved_must_leave_a_worker():
+    for reserved in (-1, 4):
+        try:
+            WorkerPool(workers=4, reserved=reserved)
+        except ValueError:
+            continue
+        assert False, f'{reserved} reserved workers accepted'
+
+# A SYNC waits on reads from every replica, the coordinator itself included. SYNCs must not be able to take the workers
+# those reads need.
+def test_syncs_leave_workers_for_their_own_reads():
+    pool = WorkerPool(workers=4)
+    def sync():
+        return pool.submit(int(REQUEST_TYPE.r_READ), lambda: b'ACK').result() # No deadline, like a v0 client SYNC
+    syncs = [pool.submit(int(REQUEST_TYPE.r_SYNC), sync) for _ in range(8)]
+    assert [f.result(5) for f in syncs] == [b'ACK'] * 8
+
+
+def free_ports(n):
+    socks = [socket.socket() for _ in range(n)]
+    for s in socks:
+        s.bind(('127.0.0.1', 0))
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+# The same against real replicas. Replica threads don't exit, so the cluster runs in its own process.
+def test_concurrent_client_syncs_all_finish():
+    ports = free_ports(3)
+    script = textwrap.dedent(f'''
+        import os, socket, threading
+        import replica
+        from msg_utils import *
+        connections = [('127.0.0.1', port) for port in {ports}]
+        replicas = [replica.Replica(i, list(connections), mode='quorum', workers=4) for i in range(3)]
+        for r in replicas:
+            r.run()
+        replies = []
+        def sync():
+            with socket.create_connection(connections[0], timeout=20) as s:
+                Frame(REQUEST_TYPE.r_SYNC).send(s)
+                replies.append(bytes(read(s)))
+        threads = [threading.Thread(target=sync) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print('REPLIES', replies.count(b'ACK'), len(replies), flush=True)
+        os._exit(0)
+    ''')
+    result = subprocess.run([sys.executable, '-c', script], cwd=SRC, capture_output=True, text=True, timeout=60)
+    assert 'REPLIES 8 8' in result.stdout, result.stdout[-2000:] + result.stderr[-2000:]